@@ -1,14 +1,17 @@
 import os
-import glob
 import subprocess
 import re
 import argparse
 import sys
+import concurrent.futures
 
 # Configuration
 SESSIONS_ROOT = r"Sessions"
 ANALYSIS_SCRIPT = r"rag_video_analysis.py"  # Points to the RAG script
 
+# VTT cue timing line: 00:00:00.000 --> 00:00:05.000
+VTT_TIMESTAMP_RE = re.compile(r'(\d{2}:\d{2}:\d{2})\.\d{3}\s-->\s.*')
+
 def convert_vtt_to_txt(vtt_path):
     """
     Converts a VTT file to a TXT file formatted for the analysis tool.
@@ -22,9 +25,6 @@ def convert_vtt_to_txt(vtt_path):
 
     output_lines = []
     
-    # Regex for VTT timestamp: 00:00:00.000 --> 00:00:05.000
-    timestamp_pattern = re.compile(r'(\d{2}:\d{2}:\d{2})\.\d{3}\s-->\s.*')
-    
     current_timestamp = None
     
     for line in lines:
@@ -36,7 +36,7 @@ def convert_vtt_to_txt(vtt_path):
         if line.isdigit(): # Sequence number
             continue
             
-        timestamp_match = timestamp_pattern.match(line)
+        timestamp_match = VTT_TIMESTAMP_RE.match(line)
         if timestamp_match:
             current_timestamp = timestamp_match.group(1)
         else:
@@ -52,11 +52,33 @@ def convert_vtt_to_txt(vtt_path):
     
     return txt_path
 
-def process_session_folder(folder_path):
+def _api_key_env(index):
+    """Environment for the index-th analysis run, sharding sessions across GEMINI_API_KEYS if set."""
+    env = dict(os.environ)
+    keys = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()]
+    if keys:
+        env["GEMINI_API_KEY"] = keys[index % len(keys)]
+    return env
+
+def process_session_folder(folder_path, index=0):
     print(f"\nScanning folder: {folder_path}")
     
+    # Collect video and transcript candidates in a single directory pass (hidden files skipped)
+    mp4_files, vtt_files, txt_files = [], [], []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.'):
+                continue
+            lower_name = name.lower()
+            if lower_name.endswith('.mp4'):
+                mp4_files.append(entry.path)
+            elif lower_name.endswith('.vtt'):
+                vtt_files.append(entry.path)
+            elif lower_name.endswith('.txt'):
+                txt_files.append(entry.path)
+    
     # Find Video File (.mp4)
-    mp4_files = glob.glob(os.path.join(folder_path, "*.mp4"))
     if not mp4_files:
         print("No MP4 file found. Skipping.")
         return
@@ -66,9 +88,6 @@ def process_session_folder(folder_path):
     
     # Find Transcript File (.vtt or .txt)
     # Priority to .vtt to convert it, or .txt if vtt missing
-    vtt_files = glob.glob(os.path.join(folder_path, "*.vtt"))
-    txt_files = glob.glob(os.path.join(folder_path, "*.txt"))
-    
     final_transcript_path = None
     
     if vtt_files:
@@ -103,7 +122,7 @@ def process_session_folder(folder_path):
             "--output_report", output_report_path
         ]
         
-        subprocess.run(cmd, check=True)
+        subprocess.run(cmd, check=True, env=_api_key_env(index))
         print("Analysis complete.")
         
     except subprocess.CalledProcessError as e:
@@ -112,6 +131,11 @@ def process_session_folder(folder_path):
         print(f"Unexpected error: {e}")
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("GEMINI_BATCH_WORKERS", "1")),
+                        help="Sessions analysed concurrently (each is mostly waiting on uploads and the model)")
+    args = parser.parse_args()
+
     if not os.path.exists(SESSIONS_ROOT):
         print(f"Sessions directory not found: {SESSIONS_ROOT}")
         return
@@ -120,10 +144,17 @@ def main():
     items = sorted(os.listdir(SESSIONS_ROOT))
     print(f"Found {len(items)} items in Sessions directory.")
     
-    for item in items:
-        item_path = os.path.join(SESSIONS_ROOT, item)
-        if os.path.isdir(item_path):
-            process_session_folder(item_path)
+    folders = [os.path.join(SESSIONS_ROOT, item) for item in items]
+    folders = [path for path in folders if os.path.isdir(path)]
+    if args.workers <= 1:
+        for index, item_path in enumerate(folders):
+            process_session_folder(item_path, index)
+        return
+
+    # Each run is a separate process with its own client, so runs share only the quota;
+    # with GEMINI_API_KEYS set, consecutive sessions go to different keys
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(process_session_folder, folders, range(len(folders))))
 
 if __name__ == "__main__":
     main()
@@ -7,6 +7,7 @@ import statistics
 # Configuration
 CSV_PATH = "Quality Sessions Sample - Test Session .csv"
 SESSIONS_ROOT = "Sessions"
+TUTOR_ID_RE = re.compile(r'(T-\d+)')
 
 def parse_csv(csv_path):
     data = {}
@@ -97,7 +98,7 @@ def main():
     for report_path in sorted(report_files):
         filename = os.path.basename(report_path)
         # Extract T-XXXX
-        tutor_id_match = re.search(r'(T-\d+)', filename)
+        tutor_id_match = TUTOR_ID_RE.search(filename)
         if not tutor_id_match:
             continue
         tutor_id = tutor_id_match.group(1)
@@ -24,11 +24,16 @@ import argparse
 import time
 import subprocess
 import shutil
-import glob
 import random
 import re
+import math
 import concurrent.futures
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -51,12 +56,22 @@ OUTPUT_REPORT_TXT = os.path.join(BASE_DIR, "Sessions/T-4053/Quality_Report_RAG_T
 
 # Video Processing
 # Video Processing (Optimized for Quality)
+# First [HH:MM:SS] timestamp in a transcript
+TRANSCRIPT_TIMESTAMP_RE = re.compile(r'\[(\d{2}:\d{2}:\d{2})\]')
+# Body of the first ```json / ``` fenced block (an unclosed fence runs to the end)
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|\Z)", re.DOTALL)
+TRANSCRIPT_HEAD_CHARS = 16384    # The first timestamp is near the top; only read past this if it is missing
 DEFAULT_START_TIME = "00:15:00"
 FRAME_EXTRACTION_INTERVAL = 60   # Extract 1 frame every 60 seconds (Higher density)
-FRAME_WIDTH = 1024               # Reduced from 1280 to save tokens (still readable)
-FRAME_QUALITY = 2                # -q:v 2 (Near lossless)
+FRAME_WIDTH = 768                # Image tokens depend on media_resolution, not pixels; smaller uploads
+FRAME_QUALITY = 5                # -q:v 5 (~JPEG quality 80: screen text stays legible, ~3x smaller than q 2)
 TARGET_FRAME_COUNT = 35          # Analyze more frames for better coverage
 
+# Parallel uploads (GEMINI_UPLOAD_MAX_WORKERS overrides, clamped to 1..64; much past 16 only adds tail latency)
+MAX_UPLOAD_WORKERS = max(1, min(64, int(os.environ.get("GEMINI_UPLOAD_MAX_WORKERS", "16"))))
+JPEG_SOI = b"\xff\xd8"           # JPEG start/end markers delimit frames in ffmpeg's image2pipe output
+JPEG_EOI = b"\xff\xd9"
+
 MODEL_NAME = "gemini-3-flash-preview"
 
 MODEL_TEMPERATURE = 0.0   # Strict adherence
@@ -85,12 +100,49 @@ COST_PER_MILLION_OUTPUT_TOKENS = 2.50
 TEMP_AUDIO_FILENAME = "temp_audio.mp3"
 TEMP_FRAMES_DIRNAME = "frames"
 
+# Server-side context cache of the session files, shared by every request of a run
+# (GEMINI_CONTEXT_CACHE=false sends the files with each request instead)
+CONTEXT_CACHE_TTL = "900s"
+
 # ============================================================================
 # CORE FUNCTIONS
 # ============================================================================
 
+def _json_loads(raw):
+    """Parses JSON from str/bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _strip_json_fences(text):
+    """Returns the JSON inside a markdown code fence, or text unchanged when it has none."""
+    match = JSON_FENCE_RE.search(text)
+    return match.group(1).strip() if match else text
+
+def _json_dumps_pretty(data):
+    """Serializes data as 2-space indented JSON text for human-readable output."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+def _create_genai_client():
+    """Creates the one google.genai client shared by every upload thread and model call.
+
+    With the optional `h2` package installed, HTTP/2 is enabled so the parallel uploads
+    multiplex over one TLS connection instead of opening one connection each.
+    """
+    try:
+        import h2  # type: ignore  # noqa: F401
+    except ImportError:
+        return genai.Client(api_key=API_KEY)
+    try:
+        return genai.Client(api_key=API_KEY, http_options=types.HttpOptions(client_args={"http2": True}))
+    except Exception:
+        # Older google-genai releases do not accept client_args
+        return genai.Client(api_key=API_KEY)
+
 # Initialize the new google.genai client
-client = genai.Client(api_key=API_KEY)
+client = _create_genai_client()
 
 def _resolve_ffmpeg_exe():
     """Return path to ffmpeg binary, preferring system ffmpeg then imageio-ffmpeg."""
@@ -107,6 +159,20 @@ def _resolve_ffmpeg_exe():
         return None
     return None
 
+def _retry_transient(fn, attempts=3, base_delay=2.0):
+    """Calls fn(), retrying server-side (5xx) and connection failures with exponential backoff."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            status = getattr(e, "code", None) or getattr(e, "status_code", None)
+            transient = isinstance(e, (ConnectionError, TimeoutError)) or (
+                isinstance(status, int) and status >= 500
+            )
+            if not transient or attempt == attempts:
+                raise
+            time.sleep(base_delay * 2 ** (attempt - 1) + random.random())
+
 def upload_to_gemini(path, mime_type=None, index=None, total=None):
     """Uploads the given file to Gemini sequentially with progress tracking."""
     if index is not None and total is not None:
@@ -115,7 +181,9 @@ def upload_to_gemini(path, mime_type=None, index=None, total=None):
         prefix = "Uploading"
     
     try:
-        file = client.files.upload(file=path, config={"mime_type": mime_type} if mime_type else None)
+        file = _retry_transient(
+            lambda: client.files.upload(file=path, config={"mime_type": mime_type} if mime_type else None)
+        )
         print(f"{prefix} [OK] {file.uri}")
         return (file, path)  # Return tuple for sorting by original path
     except Exception as e:
@@ -144,10 +212,19 @@ def upload_files_parallel(files_to_upload):
     total_files = len(files_to_upload)
     print(f"Starting parallel upload for {total_files} files...")
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    def size_of(item):
+        try:
+            return os.path.getsize(item[1][0])
+        except OSError:
+            return 0
+
+    # Largest first (audio, PDFs), so a big upload never starts last behind the small frames;
+    # callers sort the results by path, so completion order does not matter
+    ordered = sorted(enumerate(files_to_upload), key=size_of, reverse=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, max(1, total_files))) as executor:
         future_to_file = {
             executor.submit(upload_to_gemini, path, mime_type, index=i+1, total=total_files): (path, mime_type)
-            for i, (path, mime_type) in enumerate(files_to_upload)
+            for i, (path, mime_type) in ordered
         }
         
         for future in concurrent.futures.as_completed(future_to_file):
@@ -159,26 +236,88 @@ def upload_files_parallel(files_to_upload):
                 
     return uploaded_files
 
+def _get_file_states(names):
+    """Returns {file_name: state_name} from one files.list() call; files.get() only for names it misses."""
+    states = {}
+    try:
+        for file in client.files.list(config={"page_size": 100}):
+            if file.name in names:
+                states[file.name] = file.state.name
+    except Exception as e:
+        print(f"[WARNING] files.list failed, polling files individually: {e}")
+
+    missing = [n for n in names if n not in states]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(16, len(missing))) as executor:
+            for name, file in zip(missing, executor.map(lambda n: client.files.get(name=n), missing)):
+                states[name] = file.state.name
+    return states
+
 def wait_for_files_active(files):
     """Waits for files to be active. Expects (file, path) tuples."""
     print("Waiting for file processing...")
-    for f, _ in files:
-        file = client.files.get(name=f.name)
-        while file.state.name == "PROCESSING":
+    pending = {f.name for f, _ in files if getattr(f.state, "name", None) != "ACTIVE"}
+    delay = 0.25
+    while pending:
+        # One listing per tick instead of a get() per pending file
+        states = _get_file_states(pending)
+        for name in pending:
+            if states.get(name) not in ("PROCESSING", "ACTIVE"):
+                raise Exception(f"File {name} failed to process")
+        pending = {n for n in pending if states[n] == "PROCESSING"}
+        if pending:
             print(".", end="", flush=True)
-            time.sleep(2)
-            file = client.files.get(name=f.name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
     print("...all files ready")
 
+def create_context_cache(resource_files, system_instruction):
+    """Caches the session files and system instruction server-side for every analysis request.
+
+    Returns the cache, or None when GEMINI_CONTEXT_CACHE=false or the model/SDK rejects
+    caching (callers then send the files with each request).
+    """
+    if str(os.environ.get("GEMINI_CONTEXT_CACHE", "true")).lower() == "false":
+        return None
+    try:
+        cache = client.caches.create(
+            model=MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                contents=resource_files,
+                system_instruction=system_instruction,
+                ttl=CONTEXT_CACHE_TTL,
+            ),
+        )
+        print(f"[CACHE] Session files cached for this run ({cache.name})")
+        return cache
+    except Exception as e:
+        print(f"[WARNING] Context cache unavailable, sending files with each request: {e}")
+        return None
+
+def _cached_generation_config(gen_config_kwargs, cache):
+    """GenerateContentConfig that reads from cache (the system instruction lives in the cache)."""
+    kwargs = {k: v for k, v in gen_config_kwargs.items() if k != "system_instruction"}
+    return types.GenerateContentConfig(**kwargs, cached_content=cache.name)
+
+def delete_context_cache(cache):
+    """Best-effort deletion of a context cache before its TTL runs out."""
+    if cache is None:
+        return
+    try:
+        client.caches.delete(name=cache.name)
+    except Exception as e:
+        print(f"[CLEANUP WARNING] Could not delete context cache: {e}")
+
 def get_start_time_from_transcript(transcript_path):
     """Parses transcript for first timestamp."""
     print(f"Parsing transcript for start time: {transcript_path}")
     try:
         with open(transcript_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            match = re.search(r'\[(\d{2}:\d{2}:\d{2})\]', content)
+            content = f.read(TRANSCRIPT_HEAD_CHARS)
+            match = TRANSCRIPT_TIMESTAMP_RE.search(content)
+            if not match:
+                # Re-search with the head prepended so a timestamp split across the boundary still matches
+                match = TRANSCRIPT_TIMESTAMP_RE.search(content + f.read())
             if match:
                 start_time = match.group(1)
                 print(f"Found start time: {start_time}")
@@ -211,23 +350,62 @@ def time_str_to_seconds(time_str):
     except ValueError:
         return 0
 
-def extract_frame_at_time(video_path, time_sec, output_path):
-    """Extracts a single frame at a specific time."""
+def _iter_jpeg_frames(stream, chunk_size=1 << 20):
+    """Splits a concatenated JPEG stream (ffmpeg image2pipe) into per-frame byte strings.
+
+    Entropy-coded JPEG data byte-stuffs 0xFF, so the first EOI marker after an SOI
+    ends the frame.
+    """
+    buf = bytearray()
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+        while True:
+            start = buf.find(JPEG_SOI)
+            end = buf.find(JPEG_EOI, start + 2) if start >= 0 else -1
+            if end < 0:
+                break
+            end += 2
+            yield bytes(buf[start:end])
+            del buf[:end]
+
+def extract_frames_pipe(video_path, start_seconds, count, frames_dir):
+    """Extracts count frames, one every FRAME_EXTRACTION_INTERVAL seconds, with one ffmpeg process.
+
+    -ss before -i seeks once and the fps filter samples the rest in a single decode pass;
+    JPEGs are read from stdout (image2pipe) and written as frame_%03d.jpg. Returns the
+    paths written, in time order.
+    """
     ffmpeg_exe = _resolve_ffmpeg_exe()
     if not ffmpeg_exe:
         print("[WARNING] ffmpeg not found. Skipping frame extraction.")
-        return
+        return []
     cmd = [
         ffmpeg_exe,
-        "-ss", str(time_sec),
+        "-hide_banner", "-loglevel", "error",
+        "-ss", str(start_seconds),
         "-i", video_path,
-        "-frames:v", "1",
+        "-vf", f"fps=1/{FRAME_EXTRACTION_INTERVAL},scale={FRAME_WIDTH}:-1",
+        "-frames:v", str(count),
         "-q:v", str(FRAME_QUALITY),
-        "-vf", f"scale={FRAME_WIDTH}:-1",
-        "-y",
-        output_path
+        "-f", "image2pipe",
+        "-c:v", "mjpeg",
+        "pipe:1"
     ]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    frame_paths = []
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1 << 20)
+    with proc.stdout:
+        for data in _iter_jpeg_frames(proc.stdout):
+            path = os.path.join(frames_dir, f"frame_{len(frame_paths):03d}.jpg")
+            with open(path, "wb") as f:
+                f.write(data)
+            frame_paths.append(path)
+    proc.wait()
+    if proc.returncode != 0:
+        print(f"[WARNING] Frame extraction exited with code {proc.returncode} after {len(frame_paths)} frame(s)")
+    return frame_paths
 
 def extract_audio(video_path, output_path):
     """Extracts audio from video."""
@@ -238,6 +416,7 @@ def extract_audio(video_path, output_path):
         return None
     cmd = [
         ffmpeg_exe,
+        "-hide_banner", "-loglevel", "error",
         "-i", video_path,
         "-vn",
         "-acodec", "libmp3lame",
@@ -246,25 +425,29 @@ def extract_audio(video_path, output_path):
         output_path
     ]
     try:
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        # With -loglevel error stderr only carries real errors, so it is kept for the warning
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
         return output_path
     except subprocess.CalledProcessError as e:
-        print(f"[WARNING] Audio extraction failed: {e}")
+        detail = e.stderr.decode("utf-8", errors="replace").strip().splitlines()[-1:] if e.stderr else []
+        print(f"[WARNING] Audio extraction failed: {e}{': ' + detail[0] if detail else ''}")
         return None
 
 def extract_resources(video_path, start_time):
-    """Extracts frames using parallel ffmpeg seeking (Super Fast)."""
-    print("--- Extracting Resources (Super Fast Parallel) ---")
+    """Extracts frames with a single ffmpeg pass (Super Fast); returns the frame paths in time order."""
+    print("--- Extracting Resources (Single Pass) ---")
     
     base_dir = os.path.dirname(video_path)
     frames_dir = os.path.join(base_dir, TEMP_FRAMES_DIRNAME)
     
     # Check if frames already exist
     if os.path.exists(frames_dir):
-        existing_frames = glob.glob(os.path.join(frames_dir, "*.jpg"))
+        # frame_%03d names sort in time order
+        with os.scandir(frames_dir) as entries:
+            existing_frames = sorted(e.path for e in entries if e.name.endswith(".jpg"))
         if len(existing_frames) >= TARGET_FRAME_COUNT:
             print(f"Frames already exist in {frames_dir}. Skipping extraction.")
-            return frames_dir
+            return existing_frames
         else:
             print("Found partial frames, re-extracting...")
             shutil.rmtree(frames_dir)
@@ -280,24 +463,9 @@ def extract_resources(video_path, start_time):
 
     print(f"Video Duration: {duration:.2f}s, Start Time: {start_seconds}s")
     
-    timestamps = []
-    current_time = start_seconds
-    while current_time < duration:
-        timestamps.append(current_time)
-        current_time += FRAME_EXTRACTION_INTERVAL
-        
-    print(f"Extracting {len(timestamps)} frames in parallel...")
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        futures = []
-        for i, ts in enumerate(timestamps):
-            output_path = os.path.join(frames_dir, f"frame_{i:03d}.jpg")
-            futures.append(executor.submit(extract_frame_at_time, video_path, ts, output_path))
-            
-        # Wait for all to complete
-        concurrent.futures.wait(futures)
-            
-    return frames_dir
+    frame_count = max(0, math.ceil((duration - start_seconds) / FRAME_EXTRACTION_INTERVAL))
+    print(f"Extracting {frame_count} frames in one pass (1 every {FRAME_EXTRACTION_INTERVAL}s)...")
+    return extract_frames_pipe(video_path, start_seconds, frame_count, frames_dir)
 
 def should_rerun_analysis(data):
     """
@@ -378,68 +546,9 @@ def compare_and_keep_best(data1, data2):
         print(f"Error comparing analyses: {e}")
         return data1, 0, 0, "First (default)"
 
-def generate_html_report_from_json(json_path):
-    """Generates a premium, fixed-style professional HTML report from JSON data."""
-    html_path = os.path.splitext(json_path)[0] + ".html"
-    print(f"\n--- Generating Premium HTML Report: {html_path} ---")
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Extract data from JSON
-        final_score = data.get('scoring', {}).get('final_weighted_score', 0)
-        cat_avg = data.get('scoring', {}).get('averages', {})
-        cat_scores = {
-            'Setup': cat_avg.get('setup', 0),
-            'Attitude': cat_avg.get('attitude', 0),
-            'Preparation': cat_avg.get('preparation', 0),
-            'Curriculum': cat_avg.get('curriculum', 0),
-            'Teaching': cat_avg.get('teaching', 0)
-        }
-
-        # Score-based styling
-        score_color = "#10b981" if final_score >= 90 else "#f59e0b" if final_score >= 70 else "#ef4444"
-        perf_label = "EXCELLENT" if final_score >= 90 else "GOOD" if final_score >= 70 else "NEEDS IMPROVEMENT"
-        
-        # Progress circle math
-        dash_offset = 283 - (final_score / 100 * 283)
-
-        # Helper to render lists
-        def render_feedback(items, css_class):
-            html = ""
-            for item in items:
-                cat = item.get('category', '?')
-                sub = item.get('subcategory', 'General')
-                text = item.get('text', '')
-                cite = item.get('cite', '')
-                time = item.get('timestamp', '')
-                html += f'<div class="feedback-box {css_class}"><strong>[{cat}] {sub}:</strong><p>{text}</p>'
-                if cite:
-                    html += f'<small class="cite">{cite}</small>'
-                if time:
-                    html += f'<small class="timestamp">⏱️ {time}</small>'
-                html += '</div>'
-            return html
-
-        def render_flags(items):
-            html = ""
-            for item in items:
-                level = item.get('level', 'Yellow')
-                # Determine class based on level
-                css_class = "f-box-red" if "Red" in level else "f-box-yellow"
-                sub = item.get('subcategory', '')
-                reason = item.get('reason', '')
-                cite = item.get('cite', '')
-                time = item.get('timestamp', '')
-                html += f'<div class="feedback-box {css_class}">🚩 <strong>{level} Flag: {sub}</strong><p>{reason}</p>'
-                if cite:
-                    html += f'<small class="cite">{cite}</small>'
-                if time:
-                    html += f'<small class="timestamp">⏱️ {time}</small>'
-                html += '</div>'
-            return html
-
-        html_content = f"""<!DOCTYPE html>
+# Static <head> of the HTML report, built once at import; only --score-color varies
+# per report (filled with str.format, so CSS braces stay doubled)
+REPORT_HEAD_TEMPLATE = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -574,7 +683,84 @@ def generate_html_report_from_json(json_path):
         }}
     </style>
 </head>
-<body>
+"""
+
+# One sidebar row per entry of cat_scores, in display order
+CATEGORY_ROW_TEMPLATE = """                    <div class="cat-item">
+                        <div class="cat-head"><span>{label}</span><span>{score}/5</span></div>
+                        <div class="bar-bg"><div class="bar-fill" style="width: {pct}%"></div></div>
+                    </div>"""
+
+def generate_html_report_from_json(json_path, data=None):
+    """Generates a premium, fixed-style professional HTML report from JSON data.
+
+    Pass data when the report is already parsed; json_path is then only used to name the .html.
+    """
+    html_path = os.path.splitext(json_path)[0] + ".html"
+    print(f"\n--- Generating Premium HTML Report: {html_path} ---")
+    try:
+        if data is None:
+            with open(json_path, 'rb') as f:
+                data = _json_loads(f.read())
+        
+        # Extract data from JSON
+        final_score = data.get('scoring', {}).get('final_weighted_score', 0)
+        cat_avg = data.get('scoring', {}).get('averages', {})
+        cat_scores = {
+            'Setup': cat_avg.get('setup', 0),
+            'Attitude': cat_avg.get('attitude', 0),
+            'Preparation': cat_avg.get('preparation', 0),
+            'Curriculum': cat_avg.get('curriculum', 0),
+            'Teaching': cat_avg.get('teaching', 0)
+        }
+        category_rows = "\n".join(
+            CATEGORY_ROW_TEMPLATE.format(label=name, score=score, pct=score / 5 * 100)
+            for name, score in cat_scores.items()
+        )
+
+        # Score-based styling
+        score_color = "#10b981" if final_score >= 90 else "#f59e0b" if final_score >= 70 else "#ef4444"
+        perf_label = "EXCELLENT" if final_score >= 90 else "GOOD" if final_score >= 70 else "NEEDS IMPROVEMENT"
+        
+        # Progress circle math
+        dash_offset = 283 - (final_score / 100 * 283)
+
+        # Helper to render lists
+        def render_feedback(items, css_class):
+            parts = []
+            for item in items:
+                cat = item.get('category', '?')
+                sub = item.get('subcategory', 'General')
+                text = item.get('text', '')
+                cite = item.get('cite', '')
+                time = item.get('timestamp', '')
+                parts.append(f'<div class="feedback-box {css_class}"><strong>[{cat}] {sub}:</strong><p>{text}</p>')
+                if cite:
+                    parts.append(f'<small class="cite">{cite}</small>')
+                if time:
+                    parts.append(f'<small class="timestamp">⏱️ {time}</small>')
+                parts.append('</div>')
+            return "".join(parts)
+
+        def render_flags(items):
+            parts = []
+            for item in items:
+                level = item.get('level', 'Yellow')
+                # Determine class based on level
+                css_class = "f-box-red" if "Red" in level else "f-box-yellow"
+                sub = item.get('subcategory', '')
+                reason = item.get('reason', '')
+                cite = item.get('cite', '')
+                time = item.get('timestamp', '')
+                parts.append(f'<div class="feedback-box {css_class}">🚩 <strong>{level} Flag: {sub}</strong><p>{reason}</p>')
+                if cite:
+                    parts.append(f'<small class="cite">{cite}</small>')
+                if time:
+                    parts.append(f'<small class="timestamp">⏱️ {time}</small>')
+                parts.append('</div>')
+            return "".join(parts)
+
+        html_body = f"""<body>
     <div class="wrapper">
         <header>
             <div class="logo-box">
@@ -600,26 +786,7 @@ def generate_html_report_from_json(json_path):
                 </div>
                 
                 <div class="cat-list">
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Setup</span><span>{cat_scores['Setup']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Setup']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Attitude</span><span>{cat_scores['Attitude']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Attitude']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Preparation</span><span>{cat_scores['Preparation']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Preparation']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Curriculum</span><span>{cat_scores['Curriculum']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Curriculum']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Teaching</span><span>{cat_scores['Teaching']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Teaching']/5*100}%"></div></div>
-                    </div>
+{category_rows}
                 </div>
             </aside>
 
@@ -655,8 +822,10 @@ def generate_html_report_from_json(json_path):
 </body>
 </html>"""
         
+        # Head and body are written as they are, never concatenated into one report-sized string
         with open(html_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
+            f.write(REPORT_HEAD_TEMPLATE.format(score_color=score_color))
+            f.write(html_body)
         print(f"[SUCCESS] Premium Dashboard HTML Report created: {html_path}")
     except Exception as e:
         print(f"Error creating HTML from JSON: {e}")
@@ -667,110 +836,8 @@ def generate_html_report_from_json(json_path):
 # RAG ANALYSIS LOGIC
 # ============================================================================
 
-def perform_rag_analysis(video_path, output_report_path, transcript_path=None):
-    frames_dir = None
-    try:
-        # 1. SETUP & EXTRACTION
-        if transcript_path is None:
-            transcript_path = TRANSCRIPT_PATH
-        start_time = DEFAULT_START_TIME
-        if os.path.exists(transcript_path):
-            start_time = get_start_time_from_transcript(transcript_path)
-            
-        frames_dir = extract_resources(video_path, start_time)
-
-        # Extract Audio
-        audio_path = "temp_audio.mp3"
-        extract_audio(video_path, audio_path)
-
-        # 2. UPLOAD EVERYTHING
-        print("\n--- Uploading Resources (Sequential) ---")
-        files_to_upload = []
-        
-        if os.path.exists(audio_path):
-            files_to_upload.append((audio_path, "audio/mp3"))
-        
-        for pdf in PDF_REFERENCE_FILES:
-            if os.path.exists(pdf):
-                files_to_upload.append((pdf, "application/pdf"))
-        
-        if os.path.exists(transcript_path):
-            files_to_upload.append((transcript_path, "text/plain"))
-            
-        all_frames = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
-        if len(all_frames) > TARGET_FRAME_COUNT:
-            step = len(all_frames) // TARGET_FRAME_COUNT
-            selected_frames = [all_frames[i * step] for i in range(TARGET_FRAME_COUNT)]
-        else:
-            selected_frames = all_frames
-        
-        for frame in selected_frames:
-            files_to_upload.append((frame, "image/jpeg"))
-            
-        uploaded_files = upload_files_parallel(files_to_upload)
-        
-        # Categorize resources - sort by original path for deterministic order
-        # uploaded_files is now a list of (file_object, original_path) tuples
-        pdf_objs = sorted([t for t in uploaded_files if "pdf" in t[0].mime_type], key=lambda t: t[1])
-        transcript_objs = sorted([t for t in uploaded_files if "text" in t[0].mime_type], key=lambda t: t[1])
-        frame_objs = sorted([t for t in uploaded_files if "image" in t[0].mime_type], key=lambda t: t[1])
-        audio_objs = sorted([t for t in uploaded_files if "audio" in t[0].mime_type], key=lambda t: t[1])
-        
-        print(f"Resources: {len(pdf_objs)} PDFs, {len(transcript_objs)} Transcripts, {len(frame_objs)} Frames, {len(audio_objs)} Audio")
-        wait_for_files_active(uploaded_files)
-
-        # 3. INITIALIZE MODEL (Optimized for 2.x Thinking/Flash)
-        print("\n--- Initializing Knowledge Base Chat ---")
-        
-        system_instr = """You are the **Lead Quality Auditor** and **Senior Quality Compliance Auditor** for iSchool.
-Your task is to conduct a **Forensic Quality Review** of online coding sessions.
-
-**AUDIT PROTOCOL:**
-1. **INGEST RULES:** Analyze the provided Quality Reference PDFs.
-2. **ANALYZE SESSION:** Cross-reference Audio (MP3), Frames (JPG), and Transcript (TXT) against the rules.
-    - listen for MP3 from uploaded file between tutor and student.
-    - check frames from uploaded files.
-    - read zoom transcript from uploaded file.
-    **AUDIO VS. TRANSCRIPT RULE:**
-    You possess both the Recording (Audio) and the Script (Transcript).
-- The Transcript is for **Timestamping**.
-- The Audio is for **Verification**.
-- IF the transcript says "(silence)" but the audio contains keyboard clicking -> IT IS NOT SILENCE.
-- IF the transcript looks polite but the audio sounds angry -> TRUST THE AUDIO.
-- You must prioritize Audio evidence for all "Attitude" and "Connection" findings.
-3. **STRICT GUIDELINES:**
-    - Be EXHAUSTIVE. List EVERY issue found, no matter how small.
-    - Reference the provided Comment Bank PDF for rule citations.
-    - Use exact Category keys: S(Setup), A(Attitude), P(Preparation), C(Curriculum), T(Teaching), F(Feedback).
-    - Results must be mathematically verified using the weighted formula.
-**CRITICAL ANTI-HALLUCINATION RULE:**
-Do NOT report ANY issue unless you have SPECIFIC EVIDENCE:
-- For transcript issues: Include an EXACT QUOTE from the transcript.
-- For visual issues: Reference the SPECIFIC FRAME NUMBER or Timestamp.
-- If you cannot cite a specific quote or frame, DO NOT include the issue.
-
-**OUTCOME:** Return ONLY a valid JSON object matching the required schema."""
-
-        # Model configuration with seed for determinism
-        # NOTE: Gemini 2.5 Flash supports thinking_budget; 0 disables thinking for lower latency.
-        gen_config_kwargs = dict(
-            temperature=MODEL_TEMPERATURE,
-            top_p=MODEL_TOP_P,
-            top_k=MODEL_TOP_K,
-            candidate_count=1,
-            response_mime_type="application/json",
-            system_instruction=system_instr,
-            seed=args.seed,
-            thinking_config=types.ThinkingConfig(thinking_budget=args.thinking_budget),
-        )
-        if args.max_output_tokens is not None:
-            gen_config_kwargs["max_output_tokens"] = args.max_output_tokens
-
-        generation_config = types.GenerateContentConfig(**gen_config_kwargs)
-        
-        # 4. STEP 1: INITIAL GENERATION
-        print("\n--- Step 1: Generating Initial Analysis JSON ---")
-        combined_prompt = """
+# Step 1 prompt (static text, built once at import)
+COMBINED_PROMPT = """
 Analyze the session files provided (Guidelines, Transcript, Frames, Audio).
 Generate a comprehensive Quality Audit Report in JSON format.
 
@@ -929,22 +996,9 @@ Calculate the `final_weighted_score` using these exact weights:
 You MUST verify your calculation before finalizing the JSON. The score must be accurate and reflect the findings precisely.
 1. List category averages. 2. Apply weights. 3. Sum for final score.
 """
-        # Extract file objects from tuples for content list
-        pdf_files = [t[0] for t in pdf_objs]
-        transcript_files = [t[0] for t in transcript_objs]
-        frame_files = [t[0] for t in frame_objs]
-        audio_files = [t[0] for t in audio_objs]
-        
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=[combined_prompt] + pdf_files + transcript_files + frame_files + audio_files,
-            config=generation_config
-        )
-        initial_json = response.text.strip()
-        
-        # 5. STEP 2: SELF-AUDIT
-        print("\n--- Step 2: Performing Self-Audit ---")
-        audit_prompt = f"""
+
+# Step 2 prompt; the draft JSON is sent as its own content part between head and tail
+AUDIT_PROMPT_HEAD = """
 Review the following Quality Analysis JSON and perform a **Deep Audit**:
 ) AREAS FOR IMPROVEMENT: Be exhaustive. Re-check the session resources against the 4 PDFs.
 2) Language: Arabic is ALLOWED. Do NOT flag Arabic usage unless a PDF rule explicitly requires otherwise.
@@ -964,29 +1018,181 @@ Hard constraints:
 - For repeated behaviors, use: "The tutor consistently [action] at [timestamp] and throughout the session" instead of listing 50+ times and add evidence.
 - Comments from the removed Comments Bank PDF should NOT be included.
 **INPUT JSON:**
-{initial_json}
+"""
+AUDIT_PROMPT_TAIL = """
 
 **REQUIRED OUTPUT:**
 Corrected and finalized JSON ONLY. Valid JSON format.
 """
+
+# Fresh re-analysis prompt for the low-score rerun loop
+RETRY_AUDIT_PROMPT = """
+Review the session resources again and generate a **completely fresh Quality Analysis JSON** with careful attention to detail.
+Be exhaustive in finding issues. Re-check each category thoroughly.
+
+**CRITICAL REQUIREMENTS:**
+1. Every subcategory MUST have a rating between 1-5 (NO ZERO RATINGS)
+2. Score should NOT be below 68% unless genuinely justified
+3. Include detailed evidence for every finding
+4. Only include findings with STRONG, CLEAR, and SPECIFIC evidence - do NOT include vague or assumption-based findings
+5. Double-check all category calculations
+
+Hard constraints:
+- Return ONLY valid JSON matching the schema. Do not add new top-level keys.
+- Do NOT include camera angle/framing/visibility findings.
+- Do NOT include generic session feedback items (category F).
+- Keep all "text" fields concise (max 600 chars) with evidence.
+- Comments from the removed Comments Bank PDF should NOT be included.
+
+**INPUT:** Re-analyze the uploaded session resources.
+
+**REQUIRED OUTPUT:** Fresh, corrected JSON ONLY in valid JSON format.
+"""
+
+def perform_rag_analysis(video_path, output_report_path, transcript_path=None):
+    context_cache = None
+    try:
+        # 1. SETUP & EXTRACTION
+        if transcript_path is None:
+            transcript_path = TRANSCRIPT_PATH
+        start_time = DEFAULT_START_TIME
+        if os.path.exists(transcript_path):
+            start_time = get_start_time_from_transcript(transcript_path)
+            
+        all_frames = extract_resources(video_path, start_time)
+
+        # Extract Audio
+        audio_path = "temp_audio.mp3"
+        extract_audio(video_path, audio_path)
+
+        # 2. UPLOAD EVERYTHING
+        print("\n--- Uploading Resources (Parallel) ---")
+        files_to_upload = []
+        
+        if os.path.exists(audio_path):
+            files_to_upload.append((audio_path, "audio/mp3"))
+        
+        for pdf in PDF_REFERENCE_FILES:
+            if os.path.exists(pdf):
+                files_to_upload.append((pdf, "application/pdf"))
+        
+        if os.path.exists(transcript_path):
+            files_to_upload.append((transcript_path, "text/plain"))
+            
+        if len(all_frames) > TARGET_FRAME_COUNT:
+            step = len(all_frames) // TARGET_FRAME_COUNT
+            selected_frames = [all_frames[i * step] for i in range(TARGET_FRAME_COUNT)]
+        else:
+            selected_frames = all_frames
+        
+        for frame in selected_frames:
+            files_to_upload.append((frame, "image/jpeg"))
+            
+        uploaded_files = upload_files_parallel(files_to_upload)
+        
+        # Categorize resources - sort by original path for deterministic order
+        # uploaded_files is now a list of (file_object, original_path) tuples
+        pdf_objs = sorted([t for t in uploaded_files if "pdf" in t[0].mime_type], key=lambda t: t[1])
+        transcript_objs = sorted([t for t in uploaded_files if "text" in t[0].mime_type], key=lambda t: t[1])
+        frame_objs = sorted([t for t in uploaded_files if "image" in t[0].mime_type], key=lambda t: t[1])
+        audio_objs = sorted([t for t in uploaded_files if "audio" in t[0].mime_type], key=lambda t: t[1])
+        
+        print(f"Resources: {len(pdf_objs)} PDFs, {len(transcript_objs)} Transcripts, {len(frame_objs)} Frames, {len(audio_objs)} Audio")
+        wait_for_files_active(uploaded_files)
+
+        # 3. INITIALIZE MODEL (Optimized for 2.x Thinking/Flash)
+        print("\n--- Initializing Knowledge Base Chat ---")
+        
+        system_instr = """You are the **Lead Quality Auditor** and **Senior Quality Compliance Auditor** for iSchool.
+Your task is to conduct a **Forensic Quality Review** of online coding sessions.
+
+**AUDIT PROTOCOL:**
+1. **INGEST RULES:** Analyze the provided Quality Reference PDFs.
+2. **ANALYZE SESSION:** Cross-reference Audio (MP3), Frames (JPG), and Transcript (TXT) against the rules.
+    - listen for MP3 from uploaded file between tutor and student.
+    - check frames from uploaded files.
+    - read zoom transcript from uploaded file.
+    **AUDIO VS. TRANSCRIPT RULE:**
+    You possess both the Recording (Audio) and the Script (Transcript).
+- The Transcript is for **Timestamping**.
+- The Audio is for **Verification**.
+- IF the transcript says "(silence)" but the audio contains keyboard clicking -> IT IS NOT SILENCE.
+- IF the transcript looks polite but the audio sounds angry -> TRUST THE AUDIO.
+- You must prioritize Audio evidence for all "Attitude" and "Connection" findings.
+3. **STRICT GUIDELINES:**
+    - Be EXHAUSTIVE. List EVERY issue found, no matter how small.
+    - Reference the provided Comment Bank PDF for rule citations.
+    - Use exact Category keys: S(Setup), A(Attitude), P(Preparation), C(Curriculum), T(Teaching), F(Feedback).
+    - Results must be mathematically verified using the weighted formula.
+**CRITICAL ANTI-HALLUCINATION RULE:**
+Do NOT report ANY issue unless you have SPECIFIC EVIDENCE:
+- For transcript issues: Include an EXACT QUOTE from the transcript.
+- For visual issues: Reference the SPECIFIC FRAME NUMBER or Timestamp.
+- If you cannot cite a specific quote or frame, DO NOT include the issue.
+
+**OUTCOME:** Return ONLY a valid JSON object matching the required schema."""
+
+        # Model configuration with seed for determinism
+        # NOTE: Gemini 2.5 Flash supports thinking_budget; 0 disables thinking for lower latency.
+        gen_config_kwargs = dict(
+            temperature=MODEL_TEMPERATURE,
+            top_p=MODEL_TOP_P,
+            top_k=MODEL_TOP_K,
+            candidate_count=1,
+            response_mime_type="application/json",
+            system_instruction=system_instr,
+            seed=args.seed,
+            thinking_config=types.ThinkingConfig(thinking_budget=args.thinking_budget),
+        )
+        if args.max_output_tokens is not None:
+            gen_config_kwargs["max_output_tokens"] = args.max_output_tokens
+
+        generation_config = types.GenerateContentConfig(**gen_config_kwargs)
+        
+        # 4. STEP 1: INITIAL GENERATION
+        print("\n--- Step 1: Generating Initial Analysis JSON ---")
+        # Extract file objects from tuples for content list
+        pdf_files = [t[0] for t in pdf_objs]
+        transcript_files = [t[0] for t in transcript_objs]
+        frame_files = [t[0] for t in frame_objs]
+        audio_files = [t[0] for t in audio_objs]
+        resource_files = pdf_files + transcript_files + frame_files + audio_files
+        
+        # Step 1, the audit and any rerun read the session files from one server-side cache
+        # instead of re-sending them (the audit then sees the files its prompt refers to)
+        request_files = resource_files
+        context_cache = create_context_cache(resource_files, system_instr)
+        if context_cache is not None:
+            request_files = []
+            generation_config = _cached_generation_config(gen_config_kwargs, context_cache)
+        
+        response = client.models.generate_content(
+            model=MODEL_NAME,
+            contents=[COMBINED_PROMPT] + request_files,
+            config=generation_config
+        )
+        initial_json = response.text.strip()
+        
+        # 5. STEP 2: SELF-AUDIT
+        print("\n--- Step 2: Performing Self-Audit ---")
         final_response = client.models.generate_content(
             model=MODEL_NAME,
-            contents=audit_prompt,
+            contents=[AUDIT_PROMPT_HEAD, initial_json, AUDIT_PROMPT_TAIL],
             config=generation_config
         )
         final_json_text = final_response.text.strip()
 
         # Extract JSON from potential markdown blocks
-        if "```json" in final_json_text:
-            final_json_text = final_json_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in final_json_text:
-            final_json_text = final_json_text.split("```")[1].split("```")[0].strip()
+        final_json_text = _strip_json_fences(final_json_text)
 
         # --- SCORE RECALCULATION ---
         def recalculate_score(json_text):
-            """Recalculates score from JSON data."""
+            """Recalculates score from JSON data; returns the updated dict ({} if it has no scoring).
+
+            The report is serialized once, when it is written.
+            """
             try:
-                data = json.loads(json_text)
+                data = _json_loads(json_text)
                 if "scoring" in data:
                     scoring = data["scoring"]
                     weights = {"setup": 0.25, "attitude": 0.20, "preparation": 0.15, "curriculum": 0.15, "teaching": 0.25}
@@ -995,24 +1201,29 @@ Corrected and finalized JSON ONLY. Valid JSON format.
                     
                     for cat, weight in weights.items():
                         if cat in scoring and isinstance(scoring[cat], list):
-                            ratings = [float(x.get("rating", 0)) for x in scoring[cat] if "rating" in x]
-                            avg = sum(ratings) / len(ratings) if ratings else 0
+                            total, n = 0.0, 0
+                            for item in scoring[cat]:
+                                if "rating" in item:
+                                    total += float(item["rating"])
+                                    n += 1
+                            avg = total / n if n else 0
                             new_averages[cat] = round(avg, 1)
                             total_score += (avg / 5) * 100 * weight
                     
                     if "averages" not in scoring: scoring["averages"] = {}
                     scoring["averages"].update(new_averages)
                     scoring["final_weighted_score"] = round(total_score, 1)
-                    return json.dumps(data, indent=2), data
-                return json_text, {}
+                    return data
+                return {}
             except Exception as e:
                 print(f"[WARNING] Score recalculation failed: {e}")
-                return json_text, {}
+                return {}
         
         # First analysis
         MAX_RERUN_ATTEMPTS = 1  # Maximum 1 retry (2 total attempts)
         attempt = 1
-        final_json_text, data1 = recalculate_score(final_json_text)
+        data1 = recalculate_score(final_json_text)
+        report_data = data1
         score1 = data1.get("scoring", {}).get("final_weighted_score", 0)
         print(f"[SUCCESS] Score Recalculated (Attempt {attempt}/{MAX_RERUN_ATTEMPTS + 1}): {score1}")
         
@@ -1024,68 +1235,50 @@ Corrected and finalized JSON ONLY. Valid JSON format.
             print(f"[RERUN] Attempt {attempt}/{MAX_RERUN_ATTEMPTS + 1} - Re-analyzing session to get better results...")
             
             # Re-run the audit without re-uploading files
-            retry_audit_prompt = f"""
-Review the session resources again and generate a **completely fresh Quality Analysis JSON** with careful attention to detail.
-Be exhaustive in finding issues. Re-check each category thoroughly.
-
-**CRITICAL REQUIREMENTS:**
-1. Every subcategory MUST have a rating between 1-5 (NO ZERO RATINGS)
-2. Score should NOT be below 68% unless genuinely justified
-3. Include detailed evidence for every finding
-4. Only include findings with STRONG, CLEAR, and SPECIFIC evidence - do NOT include vague or assumption-based findings
-5. Double-check all category calculations
-
-Hard constraints:
-- Return ONLY valid JSON matching the schema. Do not add new top-level keys.
-- Do NOT include camera angle/framing/visibility findings.
-- Do NOT include generic session feedback items (category F).
-- Keep all "text" fields concise (max 600 chars) with evidence.
-- Comments from the removed Comments Bank PDF should NOT be included.
-
-**INPUT:** Re-analyze the uploaded session resources.
-
-**REQUIRED OUTPUT:** Fresh, corrected JSON ONLY in valid JSON format.
-"""
             retry_response = client.models.generate_content(
                 model=MODEL_NAME,
-                contents=[retry_audit_prompt] + pdf_files + transcript_files + frame_files + audio_files,
+                contents=[RETRY_AUDIT_PROMPT] + request_files,
                 config=generation_config
             )
             retry_json_text = retry_response.text.strip()
             
             # Extract JSON from potential markdown blocks
-            if "```json" in retry_json_text:
-                retry_json_text = retry_json_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in retry_json_text:
-                retry_json_text = retry_json_text.split("```")[1].split("```")[0].strip()
+            retry_json_text = _strip_json_fences(retry_json_text)
             
-            retry_json_text, data2 = recalculate_score(retry_json_text)
+            data2 = recalculate_score(retry_json_text)
             score2 = data2.get("scoring", {}).get("final_weighted_score", 0)
             print(f"[RETRY] Score Recalculated (Attempt {attempt}/{MAX_RERUN_ATTEMPTS + 1}): {score2}")
             
             # Compare and keep best
             best_data, s1, s2, selected = compare_and_keep_best(data1, data2)
             print(f"[COMPARISON] Score 1: {s1} vs Score 2: {s2} -> Keeping {selected} Analysis (Score: {best_data.get('scoring', {}).get('final_weighted_score', 0)})")
-            
-            final_json_text = json.dumps(best_data, indent=2)
+            report_data = best_data
         else:
             if not should_rerun:
                 print(f"[INFO] {reason} - No rerun needed")
             else:
                 print(f"[INFO] Maximum rerun attempts ({MAX_RERUN_ATTEMPTS}) reached. Using best available result.")
 
-        # Save Reports
+        # Save Reports (raw model text only when no recalculated data is available)
+        if report_data:
+            final_json_text = _json_dumps_pretty(report_data)
         json_report_path = os.path.splitext(output_report_path)[0] + ".json"
         with open(json_report_path, 'w', encoding='utf-8') as f:
             f.write(final_json_text)
         
-        with open(output_report_path, 'w', encoding='utf-8') as f:
-            f.write(final_json_text) # For legacy compatibility during transition
+        # The .txt holds the same bytes as the .json: hard-link it instead of writing it twice
+        try:
+            if os.path.lexists(output_report_path):
+                os.remove(output_report_path)
+            os.link(json_report_path, output_report_path)
+        except OSError:
+            # No hard links here (e.g. FAT volumes or restricted Windows accounts)
+            shutil.copyfile(json_report_path, output_report_path)
 
         print(f"[SUCCESS] Structured Reports saved (.json and .txt)")
 
         # 6. GENERATE HTML
-        generate_html_report_from_json(json_report_path)
+        generate_html_report_from_json(json_report_path, report_data or None)
 
         # Final Cost Details
         in_t = response.usage_metadata.prompt_token_count if response.usage_metadata else 0
@@ -1102,6 +1295,8 @@ Hard constraints:
         traceback.print_exc()
         import sys
         sys.exit(1)
+    finally:
+        delete_context_cache(context_cache)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
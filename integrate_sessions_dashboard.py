@@ -11,17 +11,25 @@ Features:
 """
 
 import os
-import glob
+import re
 import csv
 import subprocess
 import json
 from pathlib import Path
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 # Configuration
 SESSIONS_ROOT = r"Sessions"
 DASHBOARD_CSV = r"ischool-dashboard\sessions-from-folder.csv"
 RAG_SCRIPT = r"rag_video_analysis.py"
 
+# Generated reports (e.g. *_Quality_Report_RAG.txt) share the folder with transcripts
+_REPORT_RE = re.compile(r"report", re.IGNORECASE)
+
 def scan_sessions_folder():
     """
     Scans the Sessions folder and extracts session information.
@@ -33,17 +41,32 @@ def scan_sessions_folder():
         print(f"Sessions directory not found: {SESSIONS_ROOT}")
         return sessions
     
-    # Get all subdirectories
-    session_folders = [f for f in os.listdir(SESSIONS_ROOT) 
-                      if os.path.isdir(os.path.join(SESSIONS_ROOT, f)) and f.startswith('T-')]
+    # Get all subdirectories (DirEntry carries both name and joined path)
+    with os.scandir(SESSIONS_ROOT) as entries:
+        session_folders = [e for e in entries if e.name.startswith('T-') and e.is_dir()]
     
     print(f"Found {len(session_folders)} session folders")
     
-    for folder_name in sorted(session_folders):
-        folder_path = os.path.join(SESSIONS_ROOT, folder_name)
+    for folder in sorted(session_folders, key=lambda e: e.name):
+        folder_name = folder.name
+        folder_path = folder.path
+        
+        # Collect video and transcript candidates in a single directory pass
+        mp4_files, vtt_files, txt_files = [], [], []
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                lower_name = name.lower()
+                if lower_name.endswith('.mp4'):
+                    mp4_files.append(entry.path)
+                elif lower_name.endswith('.vtt'):
+                    vtt_files.append(entry.path)
+                elif lower_name.endswith('.txt') and not _REPORT_RE.search(name):
+                    # Filter out report files
+                    txt_files.append(entry.path)
         
-        # Find video file
-        mp4_files = glob.glob(os.path.join(folder_path, "*.mp4"))
         if not mp4_files:
             print(f"  Skipping {folder_name}: No video file found")
             continue
@@ -51,13 +74,6 @@ def scan_sessions_folder():
         video_path = mp4_files[0]
         video_filename = os.path.basename(video_path)
         
-        # Find transcript
-        vtt_files = glob.glob(os.path.join(folder_path, "*.vtt"))
-        txt_files = glob.glob(os.path.join(folder_path, "*.txt"))
-        
-        # Filter out report files
-        txt_files = [f for f in txt_files if "Quality_Report" not in f and "report" not in f.lower()]
-        
         transcript_path = None
         if vtt_files:
             transcript_path = vtt_files[0]
@@ -203,6 +219,8 @@ def create_dashboard_integration_summary(sessions, analysis_results=None):
         'sessions': []
     }
     
+    results_by_id = {r['session_id']: r for r in analysis_results} if analysis_results else {}
+    
     for session in sessions:
         session_info = {
             'tutor_id': session['tutor_id'],
@@ -213,17 +231,21 @@ def create_dashboard_integration_summary(sessions, analysis_results=None):
         }
         
         # Add analysis results if available
-        if analysis_results:
-            result = next((r for r in analysis_results if r['session_id'] == session['session_id']), None)
-            if result:
-                session_info['analysis_status'] = result['status']
-                session_info['analysis_result'] = result['result_path']
+        result = results_by_id.get(session['session_id'])
+        if result:
+            session_info['analysis_status'] = result['status']
+            session_info['analysis_result'] = result['result_path']
         
         summary['sessions'].append(session_info)
     
     summary_path = os.path.join('ischool-dashboard', 'sessions-summary.json')
-    with open(summary_path, 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2)
+    # Machine-read by the dashboard, so write compact JSON (no indentation)
+    if orjson is not None:
+        with open(summary_path, 'wb') as f:
+            f.write(orjson.dumps(summary))
+    else:
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, separators=(',', ':'))
     
     print(f"✓ Dashboard integration summary saved: {summary_path}")
     return summary_path
@@ -1,10 +1,10 @@
 import os
 import re
 import time
-import glob
 import shutil
 import random
 import argparse
+import threading
 import subprocess
 import concurrent.futures
 import google.generativeai as genai
@@ -20,11 +20,19 @@ if not API_KEY:
     raise RuntimeError("Missing GEMINI_API_KEY (or GOOGLE_API_KEY) environment variable")
 
 # Ultra-Fast Processing Config
+# First [HH:MM:SS] timestamp in a transcript
+TRANSCRIPT_TIMESTAMP_RE = re.compile(r'\[(\d{2}:\d{2}:\d{2})\]')
 DEFAULT_START_TIME = "00:15:00"
 FRAME_INTERVAL = 60              # Extract 1 frame every 60 seconds
 FRAME_WIDTH = 480                # 480p is sufficient for AI reading & much faster
 FRAME_QUALITY = 6                # JPEG Quality (2-31, lower is higher quality)
 TARGET_FRAME_COUNT = 30          # 30 frames give a great overview without overloading
+# Upload the selected frames as one 1 fps MP4 instead of one file per frame
+# (GEMINI_FRAMES_AS_VIDEO=false uploads the individual JPEGs)
+FRAMES_AS_VIDEO = str(os.environ.get("GEMINI_FRAMES_AS_VIDEO", "true")).lower() != "false"
+
+# Parallel uploads (GEMINI_UPLOAD_MAX_WORKERS overrides, clamped to 1..64; much past 16 only adds tail latency)
+MAX_UPLOAD_WORKERS = max(1, min(64, int(os.environ.get("GEMINI_UPLOAD_MAX_WORKERS", "16"))))
 
 # Audio Optimization (Tiny file for fast upload)
 AUDIO_CODEC = "libmp3lame"
@@ -61,7 +69,7 @@ def get_timestamp_from_transcript(transcript_path):
         with open(transcript_path, 'r', encoding='utf-8') as f:
             # Read only first 2000 chars to find the first timestamp fast
             content = f.read(2000) 
-            match = re.search(r'\[(\d{2}:\d{2}:\d{2})\]', content)
+            match = TRANSCRIPT_TIMESTAMP_RE.search(content)
             if match:
                 return match.group(1)
     except:
@@ -69,12 +77,50 @@ def get_timestamp_from_transcript(transcript_path):
     return DEFAULT_START_TIME
 
 def run_ffmpeg(command):
-    """Helper to run ffmpeg silently."""
-    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    """Helper to run ffmpeg quietly; raises with the tail of its error output on failure."""
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        tail = result.stderr.decode("utf-8", errors="replace").strip().splitlines()[-5:]
+        raise RuntimeError(f"ffmpeg exited with {result.returncode}: {' | '.join(tail)}")
+
+def extract_audio_and_frames(video_path, start_time, audio_path, frames_dir):
+    """Writes the audio track and the sampled frames from one ffmpeg run (one demux/decode, two outputs)."""
+    frames_pattern = os.path.join(frames_dir, "frame_%03d.jpg")
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-ss", start_time, "-i", video_path,
+        # Output 1: audio only, mono and low bitrate (stereo not needed for speech)
+        "-map", "0:a:0", "-vn", "-acodec", AUDIO_CODEC, "-b:a", AUDIO_BITRATE,
+        "-ac", "1", "-ar", AUDIO_SAMPLE_RATE, audio_path,
+        # Output 2: frames; fps filter + scale=480 keep extraction and upload fast
+        "-map", "0:v:0", "-an", "-vf", f"fps=1/{FRAME_INTERVAL},scale={FRAME_WIDTH}:-1",
+        "-q:v", str(FRAME_QUALITY), frames_pattern,
+    ]
+    run_ffmpeg(cmd)
+
+def build_frames_video(frame_paths, output_path):
+    """Encodes the frames, in order, as a 1 fps H.264 clip (one second per frame)."""
+    list_path = os.path.splitext(output_path)[0] + ".ffconcat"
+    entries = [os.path.abspath(path).replace("'", "'\\''") for path in frame_paths]
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for escaped in entries:
+            f.write(f"file '{escaped}'\nduration 1\n")
+        # The concat demuxer ignores the last entry's duration; repeating it keeps the final frame
+        f.write(f"file '{entries[-1]}'\n")
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        # yuv420p needs even dimensions; the 480px-wide frames can have an odd height
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2,format=yuv420p", "-r", "1",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-an", output_path,
+    ]
+    run_ffmpeg(cmd)
+    return output_path
 
-def extract_resources_parallel(video_path, start_time):
-    """Extracts Audio and Video concurrently using ThreadPool."""
-    print(f"--- ⚡ Extracting Resources (Parallel) starting at {start_time} ---")
+def extract_resources(video_path, start_time):
+    """Extracts audio and frames in a single ffmpeg pass."""
+    print(f"--- ⚡ Extracting Resources (Single Pass) starting at {start_time} ---")
     
     base_dir = os.path.dirname(video_path)
     temp_dir = os.path.join(base_dir, "temp_processing")
@@ -82,43 +128,32 @@ def extract_resources_parallel(video_path, start_time):
     os.makedirs(temp_dir)
 
     audio_path = os.path.join(temp_dir, "audio.mp3") # MP3 is smaller than WAV
-    frames_pattern = os.path.join(temp_dir, "frame_%03d.jpg")
-
-    # Audio Command (Optimized for small size)
-    # -vn: No video
-    # -ac 1: Mono (Stereo not needed for speech)
-    cmd_audio = [
-        "ffmpeg", "-ss", start_time, "-i", video_path,
-        "-vn", "-acodec", AUDIO_CODEC, "-b:a", AUDIO_BITRATE, 
-        "-ac", "1", "-ar", AUDIO_SAMPLE_RATE,
-        audio_path, "-y"
-    ]
-
-    # Video Command (Optimized for speed)
-    # -vf fps: Fast extraction filter
-    # scale=480: Downscale to speed up processing and upload
-    cmd_frames = [
-        "ffmpeg", "-ss", start_time, "-i", video_path,
-        "-vf", f"fps=1/{FRAME_INTERVAL},scale={FRAME_WIDTH}:-1",
-        "-q:v", str(FRAME_QUALITY),
-        frames_pattern, "-y"
-    ]
 
     t0 = time.time()
-    # Run both FFmpeg processes at the same time
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        f1 = executor.submit(run_ffmpeg, cmd_audio)
-        f2 = executor.submit(run_ffmpeg, cmd_frames)
-        concurrent.futures.wait([f1, f2])
+    extract_audio_and_frames(video_path, start_time, audio_path, temp_dir)
     
     print(f"Extraction completed in {time.time() - t0:.2f}s")
     return audio_path, temp_dir
 
+def _retry_transient(fn, attempts=3, base_delay=2.0):
+    """Calls fn(), retrying server-side (5xx) and connection failures with exponential backoff."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            status = getattr(e, "code", None) or getattr(e, "status_code", None)
+            transient = isinstance(e, (ConnectionError, TimeoutError)) or (
+                isinstance(status, int) and status >= 500
+            )
+            if not transient or attempt == attempts:
+                raise
+            time.sleep(base_delay * 2 ** (attempt - 1) + random.random())
+
 def upload_single_file(file_info):
     """Helper for concurrent uploads."""
     path, mime = file_info
     print(f"Uploading: {os.path.basename(path)}")
-    return genai.upload_file(path, mime_type=mime)
+    return _retry_transient(lambda: genai.upload_file(path, mime_type=mime))
 
 def upload_resources_concurrent(audio_path, frames_dir, transcript_path, pdf_paths):
     """Uploads all files to Gemini in parallel."""
@@ -139,7 +174,9 @@ def upload_resources_concurrent(audio_path, frames_dir, transcript_path, pdf_pat
             files_to_upload.append((pdf, "application/pdf"))
 
     # 4. Frames (Random Selection)
-    all_frames = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
+    # ffmpeg's fps filter decides the frame count; scandir lists them without glob matching
+    with os.scandir(frames_dir) as entries:
+        all_frames = sorted(e.path for e in entries if e.name.endswith(".jpg"))
     if len(all_frames) > TARGET_FRAME_COUNT:
         # Uniform sampling instead of random for better timeline coverage
         step = len(all_frames) // TARGET_FRAME_COUNT
@@ -147,24 +184,44 @@ def upload_resources_concurrent(audio_path, frames_dir, transcript_path, pdf_pat
     else:
         selected_frames = all_frames
     
-    for frame in selected_frames:
-        files_to_upload.append((frame, "image/jpeg"))
+    frames_video = None
+    if FRAMES_AS_VIDEO and selected_frames:
+        # One upload (and one processed file) instead of one per frame
+        try:
+            frames_video = build_frames_video(selected_frames, os.path.join(frames_dir, "frames.mp4"))
+        except (OSError, RuntimeError) as e:
+            print(f"Could not pack frames into a video ({e}); uploading them individually")
+    if frames_video:
+        files_to_upload.append((frames_video, "video/mp4"))
+    else:
+        for frame in selected_frames:
+            files_to_upload.append((frame, "image/jpeg"))
 
-    uploaded_objects = []
-    
-    # Upload 8 files at a time
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(upload_single_file, f) for f in files_to_upload]
-        for future in concurrent.futures.as_completed(futures):
-            uploaded_objects.append(future.result())
+    # Upload MAX_UPLOAD_WORKERS files at a time; map keeps input order so the prompt lists
+    # files deterministically (audio, transcript, PDFs, frames in time order)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(files_to_upload))) as executor:
+        uploaded_objects = list(executor.map(upload_single_file, files_to_upload))
 
     # Wait for processing (usually instant for images/text, short for audio)
     print("Verifying file readiness...")
+
+    # One list_files() call per round covers every pending file (get_file() only for any it misses)
+    by_name = {f.name: f for f in uploaded_objects}
+    pending = {name for name, f in by_name.items() if f.state.name == "PROCESSING"}
+    delay = 0.25
+    while pending:
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+        listed = {f.name: f for f in genai.list_files() if f.name in pending}
+        for name in pending - listed.keys():
+            listed[name] = genai.get_file(name)
+        by_name.update(listed)
+        pending = {name for name in pending if by_name[name].state.name == "PROCESSING"}
+    # Keep the upload order for the prompt
+    ready_files = [by_name[f.name] for f in uploaded_objects]
+
     active_files = []
-    for f in uploaded_objects:
-        while f.state.name == "PROCESSING":
-            time.sleep(1)
-            f = genai.get_file(f.name)
+    for f in ready_files:
         if f.state.name == "ACTIVE":
             active_files.append(f)
         else:
@@ -238,7 +295,14 @@ def cleanup(temp_dir, uploaded_files):
     """Clean local and cloud files."""
     print("--- Cleaning up ---")
     if temp_dir and os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
+        # Rename is a single syscall; the per-frame unlinks run in the background.
+        # Non-daemon so the interpreter still finishes the delete before exiting.
+        trash_dir = f"{temp_dir}.trash.{os.getpid()}"
+        try:
+            os.rename(temp_dir, trash_dir)
+        except OSError:
+            trash_dir = temp_dir
+        threading.Thread(target=shutil.rmtree, args=(trash_dir,), kwargs={"ignore_errors": True}).start()
     
     # Delete from cloud to save storage cost
     for f in uploaded_files:
@@ -291,8 +355,8 @@ if __name__ == "__main__":
         # 1. Get Start Time
         start_time = get_timestamp_from_transcript(args.transcript)
         
-        # 2. Extract (Parallel)
-        audio_path, temp_dir = extract_resources_parallel(args.input, start_time)
+        # 2. Extract (Single Pass)
+        audio_path, temp_dir = extract_resources(args.input, start_time)
         
         # 3. Upload (Parallel)
         uploaded_files = upload_resources_concurrent(audio_path, temp_dir, args.transcript, PDF_REFERENCE_FILES)
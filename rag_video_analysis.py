@@ -16,6 +16,7 @@ WORKFLOW:
 7. Generate Report
 """
 
+import io
 import os
 from google import genai
 from google.genai import types
@@ -24,12 +25,35 @@ import argparse
 import time
 import subprocess
 import shutil
-import glob
-import random
+import random  # retry/upload jitter only; deliberately unseeded so parallel runs do not retry in lockstep
 import re
+import string
+import mmap
+import math
+import statistics
+import collections
+import copy
+import datetime
+import functools
+import glob
+import hashlib
+import itertools
+import atexit
 import concurrent.futures
+import queue
+import threading
 import sys
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+try:
+    from blake3 import blake3  # type: ignore
+except ImportError:
+    blake3 = None
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -47,6 +71,16 @@ PDF_REFERENCE_FILES = [
     os.path.join(BASE_DIR, "Comments Bank.pdf")
 ]
 
+# Uploaded reference PDFs are reused across runs (keyed by content hash) until Gemini expires them
+REFERENCE_UPLOAD_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_refs.json")
+GEMINI_FILE_TTL_SEC = 48 * 3600          # Files API retention when the response carries no expiration_time
+REFERENCE_UPLOAD_MIN_TTL_SEC = 3600      # Re-upload when less than this remains, so a run never outlives its files
+
+# With GEMINI_DELETE_UPLOADED_FILES=false, a session's frame/audio uploads are recorded here
+# (keyed by a video fingerprint and the frame timeline) so reruns skip audio extraction and uploads
+SESSION_UPLOAD_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_session_uploads.json")
+VIDEO_FINGERPRINT_BYTES = 1 << 20        # Hashed from each end of the video, plus its size
+
 # Output
 OUTPUT_REPORT_TXT = os.path.join(BASE_DIR, "Sessions/T-4053/Quality_Report_RAG_T-4053.txt")
 
@@ -55,8 +89,12 @@ OUTPUT_REPORT_TXT = os.path.join(BASE_DIR, "Sessions/T-4053/Quality_Report_RAG_T
 DEFAULT_START_TIME = "00:15:00"
 FRAME_EXTRACTION_INTERVAL = 60   # Extract 1 frame every 60 seconds (Higher density)
 FRAME_WIDTH = 1024               # Reduced from 1280 to save tokens (still readable)
-FRAME_QUALITY = 2                # -q:v 2 (Near lossless)
+FRAME_QUALITY = 5                # -q:v 5 (~JPEG quality 80: screen text stays legible, ~3x smaller than q 2)
+FRAME_JPEG_QUALITY = 80          # Same quality for frames encoded in-process (PyAV + Pillow)
+FRAME_DEDUP_MAX_DISTANCE = 8     # dHash bits within which a frame repeats an earlier one (needs Pillow)
+FRAME_DEDUP_MIN_FRAMES = 10      # Never dedup below this many frames
 TARGET_FRAME_COUNT = 35          # Analyze more frames for better coverage
+KEYFRAME_PROBE_SEC = 120         # Span after the start time checked for keyframe spacing
 
 MODEL_NAME = "gemini-3-flash-preview"
 
@@ -80,15 +118,29 @@ MODEL_TOP_K = 40          # Standard decoding: Best balance for reasoning vs con
 # - "high": Good for complex reasoning but increases variance (less deterministic).
 DEFAULT_THINKING_LEVEL = "minimal"
 
-# Gemini 2.0 Flash media resolution for vision processing
-# Controls token usage and latency for multimodal inputs
-# Options: MEDIA_RESOLUTION_LOW, MEDIA_RESOLUTION_MEDIUM, MEDIA_RESOLUTION_HIGH
-DEFAULT_MEDIA_RESOLUTION = "MEDIA_RESOLUTION_MEDIUM"
+# Step 2 only rewrites the Step 1 JSON, so it runs with minimal thinking (--audit_thinking_level) and an
+# output cap of ~len(draft)/2 tokens (JSON with Arabic quotes runs 2-4 chars/token) plus this margin
+AUDIT_THINKING_LEVEL = "minimal"
+AUDIT_OUTPUT_TOKEN_MARGIN = 4096
 
-# Gemini 2.0 Flash media resolution for vision processing
+# The lower of the two step scores is kept, so a valid Step 1 already below this floor is final
+# and the audit call is skipped (GEMINI_AUDIT_SKIP_BELOW=0 always runs it)
+AUDIT_SKIP_BELOW_SCORE = float(os.environ.get("GEMINI_AUDIT_SKIP_BELOW", "40"))
+# Also skipped when Step 1 is at or below this score with at least AUDIT_SKIP_MIN_FINDINGS
+# improvement areas + flags: the audit would only trim an already clearly failing report
+AUDIT_SKIP_FINDINGS_SCORE = float(os.environ.get("GEMINI_AUDIT_SKIP_FINDINGS_SCORE", "50"))
+AUDIT_SKIP_MIN_FINDINGS = int(os.environ.get("GEMINI_AUDIT_SKIP_MIN_FINDINGS", "10"))
+
+# GEMINI_AUDIT_PATCH=true asks Step 2 for a JSON Patch against the Step 1 draft instead of
+# the whole corrected report (output shrinks to the edits; a bad patch reruns the full audit)
+AUDIT_AS_PATCH = str(os.environ.get("GEMINI_AUDIT_PATCH", "false")).lower() == "true"
+
+# Gemini media resolution for vision processing
 # Controls token usage and latency for multimodal inputs
 # Options: MEDIA_RESOLUTION_LOW, MEDIA_RESOLUTION_MEDIUM, MEDIA_RESOLUTION_HIGH
-DEFAULT_MEDIA_RESOLUTION = "MEDIA_RESOLUTION_MEDIUM"
+# LOW roughly halves vision tokens per frame vs MEDIUM; the visual checks (screen sharing,
+# slides on screen) do not need more. Use --media_resolution MEDIA_RESOLUTION_MEDIUM for fine print.
+DEFAULT_MEDIA_RESOLUTION = "MEDIA_RESOLUTION_LOW"
 
 # Reproducibility controls
 # The seed parameter provides PARTIAL reproducibility (not guaranteed deterministic)
@@ -105,13 +157,34 @@ DEFAULT_SEED = 42
 # - Use seed parameter
 # ============================================================================
 DEFAULT_CONSISTENCY_RUNS = 1  # Single run (cost-effective)
+# --consistency_runs N > 1: the extra Step 1 drafts use seed + stride * run (retries use seed + 1, 2, ...)
+CONSISTENCY_SEED_STRIDE = 1000
+# Extra drafts in flight at once alongside the main one (GEMINI_CONSISTENCY_MAX_WORKERS overrides,
+# clamped to 1..16); keeps a large N under the per-minute request limit instead of bursting it
+MAX_CONSISTENCY_WORKERS = max(1, min(16, int(os.environ.get("GEMINI_CONSISTENCY_MAX_WORKERS", "4"))))
 
 # Output control (leave unset by default; can be overridden via CLI)
 DEFAULT_MAX_OUTPUT_TOKENS = None
 
-# Retry control for API failures / JSON parse errors
-MAX_JSON_RETRIES = 3
-MAX_EMPTY_JSON_RETRIES = 2  # Retries specifically for empty JSON responses
+# Step 1 regeneration when the response fails validation. response_schema already forces
+# complete JSON, so this only covers truncation (max_output_tokens); API errors are retried
+# by _call_genai_with_backoff without regenerating
+MAX_EMPTY_JSON_RETRIES = 1
+# Sent as its own part after the unchanged Step 1 prompt on those retries
+STEP1_RETRY_NOTE = "CRITICAL: Return a complete, valid JSON object."
+
+# Upload concurrency (GEMINI_UPLOAD_MAX_WORKERS overrides, clamped to 1..64; much past 16 only
+# adds tail latency). The pool never exceeds the file count
+MAX_UPLOAD_WORKERS = max(1, min(64, int(os.environ.get("GEMINI_UPLOAD_MAX_WORKERS", "16"))))
+
+# Files up to this size go up in one multipart request (metadata + bytes) instead of the
+# SDK's two-request resumable protocol; GEMINI_MULTIPART_UPLOADS=false turns this off
+MULTIPART_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+GEMINI_UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+
+# Category weights for final_weighted_score (must match the formula in the prompt)
+SCORE_CATEGORY_WEIGHTS = {"setup": 0.25, "attitude": 0.20, "preparation": 0.15, "curriculum": 0.15, "teaching": 0.25}
+SCORE_CATEGORIES = tuple(SCORE_CATEGORY_WEIGHTS)  # scoring keys in report order
 
 # Score variance threshold - if runs differ by more than this, flag as unreliable
 SCORE_VARIANCE_THRESHOLD = 5.0  # Points
@@ -120,1167 +193,2781 @@ SCORE_VARIANCE_THRESHOLD = 5.0  # Points
 # Pricing: ~$0.075/million input, ~$0.30/million output
 COST_PER_MILLION_INPUT_TOKENS = 0.075
 COST_PER_MILLION_OUTPUT_TOKENS = 0.30
+# --batch: Batch API requests are billed at half the interactive rate
+BATCH_COST_FACTOR = 0.5
+
+# JPEG start/end-of-image markers, used to split ffmpeg's image2pipe output into frames
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+# Server-side context cache holding the session files for both analysis steps.
+# GEMINI_CONTEXT_CACHE=rules instead caches only the system instruction and reference PDFs,
+# shared across sessions for RULES_CACHE_TTL_SEC; =false sends the files with every request
+CONTEXT_CACHE_TTL = "900s"
+# Prefill time grows with the prompt; a session context past this is worth a warning
+LARGE_CONTEXT_TOKENS = 200_000
+RULES_CACHE_TTL_SEC = 24 * 3600
+RULES_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_rules_cache.json")
+# With GEMINI_DELETE_UPLOADED_FILES=false the session cache is kept too, recorded here (keyed on
+# the content of the cached files) so reruns and re-invocations skip the media prefill
+SESSION_CONTEXT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_session_caches.json")
+SESSION_CONTEXT_CACHE_TTL_SEC = 3600
+SESSION_CONTEXT_CACHE_MIN_TTL_SEC = 600  # Recreate when less than this remains, so a run never outlives its cache
+
+# Video durations (PyAV/ffprobe) kept across runs, keyed on absolute path, mtime_ns and size
+VIDEO_METADATA_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gemini_video_metadata.json")
+
+# Model responses cached on disk, keyed on model, prompt, config and input file hashes
+RESPONSE_CACHE_DIR = ".cache"
+# Entries older than this are treated as misses and removed, so a preview model's behaviour
+# changes eventually show up (GEMINI_RESPONSE_CACHE_TTL_SEC overrides; 0 keeps entries forever)
+RESPONSE_CACHE_TTL_SEC = int(os.environ.get("GEMINI_RESPONSE_CACHE_TTL_SEC", str(7 * 24 * 3600)))
 
 # Temp Files
-TEMP_AUDIO_FILENAME = "temp_audio.mp3"
+TEMP_AUDIO_BASENAME = "temp_audio"  # extension follows the audio codec (see extract_audio)
 TEMP_FRAMES_DIRNAME = "frames"
 
+# First HH:MM:SS in a transcript (VTT cue or bracketed TXT timestamp); bytes pattern for mmap search
+TRANSCRIPT_TIMESTAMP_RE = re.compile(rb'(\d{2}:\d{2}:\d{2})')
+
+# Numeric index of an extracted frame file (frame_%03d.jpg)
+FRAME_INDEX_RE = re.compile(r'(\d+)\.jpg$')
+
 # ============================================================================
-# CORE FUNCTIONS
+# PROMPTS
 # ============================================================================
+# Module-level so every run sends byte-identical text (response and context cache keys)
 
-# Initialize the new google.genai client
-client = genai.Client(api_key=API_KEY)
-
+SYSTEM_INSTRUCTION = """You are the **Lead Quality Auditor** and **Senior Quality Compliance Auditor** for iSchool.
+Your task is to conduct a **Forensic Quality Review** of online coding sessions.
 
-def _is_quota_exhausted_error(exc: Exception) -> bool:
-    status = getattr(exc, "status_code", None)
-    if status == 429:
-        return True
-    msg = str(exc)
-    return ("RESOURCE_EXHAUSTED" in msg) or (" 429" in msg) or ("quota" in msg.lower())
+**AUDIT PROTOCOL:**
+1. **INGEST RULES:** Analyze the provided Quality Reference PDFs.
+2. **ANALYZE SESSION:** Cross-reference Audio (AAC/Opus), Frames (JPG), and Transcript (TXT) against the rules.
+    - listen to the uploaded audio between tutor and student.
+    - check frames from uploaded files.
+    - read zoom transcript from uploaded file.
+    **AUDIO VS. TRANSCRIPT RULE:**
+    You possess both the Recording (Audio) and the Script (Transcript).
+- The Transcript is for **Timestamping**.
+- The Audio is for **Verification**.
+- IF the transcript says "(silence)" but the audio contains keyboard clicking -> IT IS NOT SILENCE.
+- IF the transcript looks polite but the audio sounds angry -> TRUST THE AUDIO.
+- You must prioritize Audio evidence for all "Attitude" and "Connection" findings.
+3. **STRICT GUIDELINES:**
+    - Be EXHAUSTIVE. List EVERY issue found, no matter how small.
+    - Reference the provided PDFs for rule citations.
+    - Use exact Category keys: S(Setup), A(Attitude), P(Preparation), C(Curriculum), T(Teaching), F(Feedback).
+    - Results must be mathematically verified using the weighted formula.
+**CRITICAL ANTI-HALLUCINATION RULE:**
+Do NOT report ANY issue unless you have SPECIFIC EVIDENCE:
+- For transcript issues: Include an EXACT QUOTE from the transcript.
+- For visual issues: Reference the SPECIFIC FRAME NUMBER or Timestamp.
+- If you cannot cite a specific quote or frame, DO NOT include the issue.
 
+**OUTCOME:** Return ONLY a valid JSON object matching the required schema."""
 
-def _call_genai_with_backoff(fn, *, what: str = "genai", max_attempts: int | None = None):
-    """Call a google.genai SDK function with light backoff; exit 42 on persistent quota exhaustion.
+# Step 1 prompt; str.format syntax, rendered by render_combined_prompt(start_time=...) (JSON schema braces are doubled)
+COMBINED_PROMPT_TEMPLATE = """
+Analyze the session files provided (Guidelines, Transcript, Frames, Audio).
+Generate a comprehensive Quality Audit Report in JSON format.
 
-    Exit code 42 is intentional: the Node server detects quota exhaustion and delays retries.
-    """
-    if max_attempts is None:
-        max_attempts = max(1, int(os.environ.get("GEMINI_MAX_ATTEMPTS", "3")))
+**CRITICAL: SESSION START TIME**
+The session officially starts at timestamp **{start_time}**.
+**IGNORE** all audio, text, or visual events before **{start_time}**.
+Any "silence" or "waiting" before {start_time} is PRE-SESSION WAITING time and is NOT a violation.
 
-    base = float(os.environ.get("GEMINI_BACKOFF_BASE_SEC", "5"))
-    cap = float(os.environ.get("GEMINI_BACKOFF_MAX_SEC", "60"))
-    quota_attempts = max(1, int(os.environ.get("GEMINI_429_MAX_ATTEMPTS", "2")))
+**REQUIRED SCHEMA:**
+{{
+  "meta": {{"tutor_id": "str", "group_id": "str", "session_date": "str", "session_summary": "str"}},
+  "positive_feedback": [{{"category": "str", "subcategory": "str", "text": "str", "cite": "str", "timestamp": "str"}}],
+  "areas_for_improvement": [{{"category": "str", "subcategory": "str", "text": "str", "cite": "str", "timestamp": "str"}}],
+  "flags": [{{"level": "Yellow/Red", "subcategory": "str", "reason": "str", "cite": "str", "timestamp": "str"}}],
+  "scoring": {{
+    "setup": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
+    "attitude": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
+    "preparation": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
+    "curriculum": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
+    "teaching": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
+    "averages": {{"setup": 0, "attitude": 0, "preparation": 0, "curriculum": 0, "teaching": 0}},
+    "final_weighted_score": 0
+  }},
+  "action_plan": ["string", "string", "string"]
+}}
 
-    quota_seen = 0
-    for attempt in range(1, max_attempts + 1):
-        try:
-            return fn()
-        except Exception as e:
-            if _is_quota_exhausted_error(e):
-                quota_seen += 1
-                if quota_seen >= quota_attempts:
-                    print(f"[QUOTA_EXHAUSTED] {what}: {e}")
-                    sys.exit(42)
+**RULES:**
+- **CHAIN OF THOUGHT:** Work through the session step by step (setup, issues found with timestamps, rules verified) before writing the JSON. Keep this reasoning out of the JSON itself.
+- Category Keys: **S** (Setup), **A** (Attitude), **P** (Preparation), **C** (Curriculum), **T** (Teaching), **F** (Feedback).
+- Scoring Logic: 5 (Perfect) down to 1 (Critical). Apply weighted formula: (Setup 25%, Attitude 20%, Prep 15%, Curr 15%, Teach 25%).
+- Math Verification: Re-calculate category averages and sum them based on weights before outputting the final score.
+- **POSITIVE FEEDBACK:** You MUST include at least **3** specific positive observations in the `positive_feedback` array.
+- language English or Arabic do not put language used in area of improvement.
+- if the find with not storng and clraer evidence, do not include it.
 
-            if attempt >= max_attempts:
-                raise
+---
 
-            sleep_s = min(cap, base * (2 ** (attempt - 1)))
-            sleep_s = sleep_s * (0.7 + random.random() * 0.6)  # jitter 0.7x..1.3x
-            print(f"[RETRY] {what} attempt {attempt}/{max_attempts} failed: {e} (sleep {sleep_s:.1f}s)")
-            time.sleep(sleep_s)
+### **PHASE 1: THE AUDIT PROTOCOL (Relaxed Enforcement)**
+Check the session against these specific criteria. If a violation is found, it **MUST** be listed in "areas_for_improvement" or "flags".
+Note the exact timestamp from the transcript where the issue occurs.
 
+**IMPORTANT: 1-HOUR SESSION CONTEXT**
+Do NOT report the following as issues:
+- Brief moments of silence (under 2 min) while student is coding/thinking.
+- Tutor briefly checking slides or materials (under 30 seconds).
+- One or two instances of minor audio lag that don't disrupt flow.
+- the session could be 1 hour and 30 minutes.with the wating time for the student. 
+**1. VISUAL COMPLIANCE (Check Frames)**
+*   **Camera (IGNORE FOR REPORTING):** Do NOT add any comments, improvements, or flags about camera angle, framing, or visibility.
+    - **Specifically, ignore and do not report "S - Camera Quality" findings.**
+*   **Dress Code (IGNORE FOR REPORTING):** Do NOT add any comments, improvements, or flags about the tutor's dress code/appearance.
+    - **Specifically, ignore and do not report "S - Dress Code" findings.**
+*   **Screen Sharing (CRITICAL):**
+    *   During the "Make/Coding" phase, the **STUDENT'S** screen must be shared.
+    *   *Violation:* If the tutor explicitly says "You don't have to share your screen,"for reviweing the homework or implmenting main the project at the end of the session .
+*   **Zoom Tools Usage (MANDATORY CHECK):**
+    *   If the tutor repeatedly uses verbal directions **more than 3 times** like “look above” instead of Zoom annotations (arrow/highlighter), log:
+      **C - Tools and Methodology: Inefficient use of Zoom annotation tools**.
 
-def delete_uploaded_gemini_files(uploaded_files):
-    """Best-effort cleanup for Gemini Files API to avoid accumulating storage.
+**2. AUDITORY COMPLIANCE (Check Transcript + Audio)**
+*   **Dead Air (Silence):** Flag if silence exceeds **6 minutes** without tutor engagement or check-in. 
+*   **Rapport & Warmth (MANDATORY CHECK):**
+    * If the tutor does NOT smile, greet warmly, or initiate light friendly conversation log:
+      **A - Friendliness: Lack of warm rapport-building at session start**.
+*   **Language:** Arabic is ALLOWED.
+*   **Internet & Audio Stability (MANDATORY CHECK):**
+    - if it is more than 3 time Actively listen for lag, delayed responses, repeated “can you hear me?”, audio cuts, or desync.
+    - If connectivity issues affect flow **for more than 2 minutes** more than 3 times, log:
+      **S - Internet Quality: Internet/audio lags disrupted session flow for more than 3 minutes**.
 
-    Gemini file uploads persist server-side until deleted; leaving them will eventually
-    hit per-project storage limits.
-    """
-    enabled = str(os.environ.get("GEMINI_DELETE_UPLOADED_FILES", "true")).lower() != "false"
-    if not enabled:
-        return
+**3. PREPARATION QUALITY (MANDATORY CHECK):**
+*   **Materials Readiness:**
+    * If slides are disorganized, contain typos, or seem hastily prepared, log:
+      **P - Material Readiness: Materials were not well-organized or prepared in advance**.
+    * If the tutor lacks resources/materials for the session topic, log:
+      **P - Resource Planning: Required materials or setup were missing or not prepared**.
+*   **Lesson Planning & Roadmap:**
+    * If the tutor does not provide a clear lesson plan, roadmap, or learning objectives, log:
+      **P - Lesson Planning: No clear lesson plan or learning objectives communicated**.
+    * If the pacing is erratic (rushing parts, spending too long on others), log:
+      **P - Session Pacing: Poor time management and pacing of lesson content**.
+*   **Technical Setup Verification:**
+    * If the tutor failed to test tools/platforms before the session or has technical issues that could have been prevented, log:
+      **P - Technical Preparation: Technical tools or platforms were not tested/verified beforehand**.
 
-    if not uploaded_files:
-        return
+**4. TEACHING QUALITY (MANDATORY DEEP CHECK):**
+*   **Teaching Mode Balance:**
+    * If teaching is mostly one-directional (explaining without questioning) for >10 minutes, log:
+      **T - Student Engagement: Session was largely lecture-based with limited student interaction**.
+*   **Guided Thinking vs Direct Answers:**
+    * If the tutor provides full solutions, syntax, or logic immediately without prompting the student to think or respond first, log:
+      **T - Teaching Methodology: Over-reliance on direct answers instead of guided discovery**.
+*   **Check-for-Understanding (MANDATORY):**
+    * If the tutor explains a concept without asking the student to confirm understanding, log:
+      **T - Student Engagement: Lack of comprehension-check questions during explanation**.
 
-    deleted = 0
-    for f, original_path in uploaded_files:
-        try:
-            name = getattr(f, "name", None)
-            if not name:
-                continue
-            client.files.delete(name=name)
-            deleted += 1
-        except Exception as e:
-            # Don't fail the whole run due to cleanup
-            try:
-                base = os.path.basename(original_path or "")
-            except Exception:
-                base = ""
-            print(f"[CLEANUP WARNING] Could not delete uploaded file {base}: {e}")
+**4. PROCEDURAL COMPLIANCE (Check Transcript + Audio)**
+*   **Opening/Closing:** Roadmap explained? Summary provided? Homework assigned?
+*   **Platform:** Correct tool used ?
+*   **Tool Language:** If tools appear in Arabic when English is required, log:
+      **P - Project software & slides: Tool language not set to English as required**.
 
-    if deleted:
-        print(f"[CLEANUP] Deleted {deleted} uploaded Gemini file(s)")
+**5. PROJECT COMPLETION VS EXPLANATION (MANDATORY CHECK):**
+*   **FIRST 50 MINUTES EXEMPTION:** During the first 50 minutes of the session, it is ACCEPTABLE for the tutor to implement examples to demonstrate concepts. This is NOT a violation.
+*   **AFTER 50 MINUTES:** Verify if project was fully implemented by student, partially, or only explained verbally.
+*   If explained only (after 50 min), log:
+    **C - Slides and Project Completion: Project was explained but not implemented by the student during the session**.
+*   If tutor implements while student observes (after 50 min), log:
+    **T - Project Implementation & Activities: Tutor-led implementation limited hands-on student practice**.
 
-def _resolve_ffmpeg_exe():
-    """Return path to ffmpeg binary, preferring system ffmpeg then imageio-ffmpeg."""
-    exe = shutil.which("ffmpeg")
-    if exe:
-        return exe
-    try:
-        import imageio_ffmpeg  # type: ignore
+**6. CONCEPT ACCURACY & MISCONCEPTIONS (CRITICAL CHECK):**
+*   If the tutor explains a concept incorrectly or in a misleading way, log:
+    **C - Knowledge About Subject: Concept explained inaccurately or misleadingly**.
+*   **Examples include (but are not limited to):**
+    - Incorrect definition of widget roles (e.g., layout vs content widgets)
+    - Misuse or misinterpretation of properties 
+    - Logical inaccuracies 
+### **FINAL COMPLIANCE GATE (REQUIRED)**
+Before producing the final JSON output, explicitly ask yourself:
+“Did I check Setup, Attitude, Preparation, Curriculum, Teaching, and Feedback for at least ONE potential issue each?”
+If any category has zero findings, re-scan audio, frames, and transcript to confirm that the category is genuinely perfect — otherwise add the missing issue.
+if the find with not storng and clraer evidence, do not include it.
 
-        exe = imageio_ffmpeg.get_ffmpeg_exe()
-        if exe and os.path.exists(exe):
-            return exe
-    except Exception:
-        return None
-    return None
+---
 
-def upload_to_gemini(path, mime_type=None, index=None, total=None):
-    """Uploads the given file to Gemini sequentially with progress tracking."""
-    if index is not None and total is not None:
-        prefix = f"Counter: [{index}/{total}]"
-    else:
-        prefix = "Uploading"
-    
-    try:
-        # Small jitter to reduce request bursts under parallel uploads
-        time.sleep(float(os.environ.get("GEMINI_UPLOAD_JITTER_SEC", "0.2")) * random.random())
-        file = _call_genai_with_backoff(
-            lambda: client.files.upload(file=path, config={"mime_type": mime_type} if mime_type else None),
-            what=f"files.upload({os.path.basename(path)})",
-        )
-        print(f"{prefix} [OK] {file.uri}")
-        return (file, path)  # Return tuple for sorting by original path
-    except Exception as e:
-        print(f"{prefix} [FAIL] Failed to upload {path}: {e}")
-        raise
+### **PHASE 2: JSON GENERATION RULES**
 
-def upload_files_sequentially(files_to_upload):
-    """Uploads multiple files sequentially (One after another)."""
-    uploaded_files = []
-    total_files = len(files_to_upload)
-    print(f"Starting sequential upload for {total_files} files...")
-    
-    for i, (path, mime_type) in enumerate(files_to_upload, 1):
-        try:
-            file = upload_to_gemini(path, mime_type, index=i, total=total_files)
-            uploaded_files.append(file)
-        except Exception as e:
-            # Error is already printed in upload_to_gemini
-            pass
-                
-    return uploaded_files
+***1. THE "LIST ALL" RULE:**
+*   **DO NOT SUMMARIZE.** You must list **EVERY** single valid area for improvement found.
+*   Check the transcript for timestamps and listen for the audio to validate the findings.
+*   **EVIDENCE FILTERING:** Only include findings with STRONG, CLEAR, and SPECIFIC evidence.
+*   **EVIDENCE LANGUAGE:** Quote the specific evidence exactly as spoken/written in the session, in its original language (Arabic or English). Do NOT translate quotes.
 
-def upload_files_parallel(files_to_upload):
-    """Uploads multiple files in parallel using ThreadPoolExecutor."""
-    uploaded_files = []
-    total_files = len(files_to_upload)
-    print(f"Starting parallel upload for {total_files} files...")
 
-    max_workers = int(os.environ.get("GEMINI_UPLOAD_MAX_WORKERS", "2"))
-    max_workers = max(1, min(8, max_workers))
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {
-            executor.submit(upload_to_gemini, path, mime_type, index=i+1, total=total_files): (path, mime_type)
-            for i, (path, mime_type) in enumerate(files_to_upload)
-        }
+**2. FORMATTING RULE:**
+*   For the `"text"` field in feedback lists, use the exact format: `[Category Letter] - [Subcategory]: [Description ] - [Evidence: Specific example with 1-2 timestamps only]`
+*   **CRITICAL:** Include ONLY 1-2 representative timestamps per feedback item. DO NOT list 50+ timestamps.
+*   **EVIDENCE REQUIREMENT:** ONLY include findings with STRONG, CLEAR, and SPECIFIC evidence. If a finding lacks concrete proof or is based on assumptions, DO NOT include it.
+*   **Category Keys:** **S** = Setup, **A** = Attitude, **P** = Preparation, **C** = Curriculum, **T** = Teaching, **F** = Feedback.
+
+---
+
+### **PHASE 3: RIGOROUS SCORING LOGIC**
+**You must calculate the score based strictly on the findings from Phase 2. Do not guess.**
+
+**Step A: Determine Sub-Category Ratings (0-5)**
+For **EACH** sub-category in the JSON `scoring` object, apply this specific deduction logic:
+*   **5 (Perfect):** 0 Issues found.
+*   **4 (Good):** **1-4 "Areas for Improvement"**from the same sub-category.
+*   **3 (Fair):**5-6 "Areas for Improvement"** from the same sub-category.
+*   **2 (Weak):** 3+  Yellow Flags from the same subcategory  **OR** **6+ "Areas for Improvement"** from the same sub-category.
+*   **1 (Critical):** **10+ "Areas for Improvement"** from the same sub-category..
+*   **0 (Zero):** No show/Total failure.
+
+**Step B: Apply the Weighted Formula**
+Calculate the `final_weighted_score` using these exact weights:
+- **Setup (25%):** `(Setup Avg ÷ 5) × 100 × 0.25`
+- **Attitude (20%):** `(Attitude Avg ÷ 5) × 100 × 0.20`
+- **Preparation (15%):** `(Preparation Avg ÷ 5) × 100 × 0.15`
+- **Curriculum (15%):** `(Curriculum Avg ÷ 5) × 100 × 0.15`
+- **Teaching (25%):** `(Teaching Avg ÷ 5) × 100 × 0.25`
+
+**Step C: MANDATORY MATH VERIFICATION (SELF-AUDIT)**
+Before finalizing the JSON, you MUST internaly verify your calculations and facts:
+1) **EVIDENCE CHECK:** Ensure EVERY "area_for_improvement" and "flag" has specific evidence (timestamp/quote). Remove any that do not.
+2) **SCORE CHECK:** Re-calculate category averages and valid weights. The final score must match the individual ratings perfectly.
+3) **POSITIVE CHECK:** Ensure at least 3 distinct positive highlights are included.
+4) **LANGUAGE CHECK:** Arabic is ALLOWED. Do not flag uses of Arabic.
+5) **FORMAT CHECK:** Ensure "text" fields are concise  and evidence is clear.
+
+**Remove any comment that lacks evidence. and recale the score don't be like a robot**
+Hard constraints:
+- Return ONLY valid JSON matching the existing schema.
+- Do NOT include any camera angle/framing/visibility/camera quality findings.
+- Do NOT include generic session feedback items (category F / session feedback).
+- Keep all "text" fields concise using the format: `[Category Letter] - [Subcategory]: [Description ] - [Evidence: ...]`
+- Comments from the removed Comments Bank PDF should NOT be included.
+
+"""
+
+# Step 2 prompt; str.format syntax. The draft JSON is sent as its own content part at {initial_json}
+# (see audit_prompt_parts) rather than being formatted into the text
+AUDIT_PROMPT_TEMPLATE = """
+You are the **Senior Quality Compliance Auditor**.
+Your task is to **AUDIT and CORRECT** the "Draft Analysis JSON" provided below.
+
+**THE DRAFT MAY CONTAIN ERRORS. DO NOT TRUST IT BLINDLY.**
+You have access to the **ACTUAL** session evidence (Audio, Frames, Transcript).
+You must verify every single claim in the draft against this evidence.
+
+**AUDIT PROTOCOL:**
+1.  **VERIFY EVIDENCE:**
+    - If the draft says "Issue X at 10:00", **check the transcript/audio at 10:00**.
+    - If the evidence does NOT support the claim, **DELETE IT**.
+    - If the evidence is weak or ambiguous, **DELETE IT**.
+    - **CRITICAL:** Start Time is **{start_time}**. ANY issue cited before this timestamp is invalid and MUST be deleted.
+
+2.  **HUNT FOR MISSED ISSUES:**
+    - The draft might have missed something. Re-scan the "teaching" and "interaction" phases.
+    - Did the tutor check for understanding? Did they engage the student?
+    - If you find a new valid issue backed by strong evidence, **ADD IT**.
+
+3.  **STRICT SCORING CORRECTION:**
+    - Recalculate the score based *only* on the valid findings that remain.
+    - If you deleted issues, the score MUST go VALID (Up).
+    - If you added issues, the score MUST go DOWN.
+    - **Do not be lazy.** Do not just copy the draft score. Calculate it yourself.
+
+4.  **REFINEMENT:**
+    - **Language:** Arabic is ALLOWED. Remove any flags strictly about speaking Arabic.
+    - **Positive Highlights:** Ensure at least 3 distinct, true positives are listed.
+    - **Conciseness:** Merge repetitive points. Use "Consistently..." for recurring behaviors.
+    - **Evidence Format:** Ensure every finding has: `[Category] - [Subcategory]: [Description] - [Evidence: ...]`
+
+**INPUT DRAFT JSON:**
+{initial_json}
+
+**REQUIRED OUTPUT:**
+The clean, corrected, and finalized JSON.
+"""
+
+def _compile_prompt(template):
+    """Parses a str.format template once; the returned render(**fields) only joins the pieces.
+
+    The templates use bare {name} fields (no format specs), so substitution is plain str().
+    """
+    pieces = tuple((literal, name) for literal, name, _, _ in string.Formatter().parse(template))
+
+    def render(**fields):
+        return "".join(literal if name is None else literal + str(fields[name]) for literal, name in pieces)
+
+    return render
+
+# Appended to SYSTEM_INSTRUCTION when no audio is uploaded (the default once a transcript exists),
+# so the audio rules above are not applied to evidence the model never receives
+NO_AUDIO_NOTE = """
+**NO AUDIO IN THIS SESSION:**
+No audio is provided; the transcript is the canonical record. Wherever the rules above mention audio, use the transcript and frames instead.
+- Judge "Attitude" and "Connection" findings from the transcript wording and the frames only.
+- Report lag, audio cuts or desync only when the transcript shows them (e.g. repeated "can you hear me?").
+- Do not report any issue that could only be heard.
+"""
+
+render_combined_prompt = _compile_prompt(COMBINED_PROMPT_TEMPLATE)
+_AUDIT_PROMPT_HEAD, _AUDIT_PROMPT_TAIL = AUDIT_PROMPT_TEMPLATE.split("{initial_json}")
+render_audit_prompt_head = _compile_prompt(_AUDIT_PROMPT_HEAD)
+AUDIT_PROMPT_TAIL = _compile_prompt(_AUDIT_PROMPT_TAIL)()
+
+# Replaces AUDIT_PROMPT_TAIL when Step 2 returns a patch (GEMINI_AUDIT_PATCH)
+AUDIT_PATCH_PROMPT_TAIL = """
+
+**REQUIRED OUTPUT:**
+Do NOT re-emit the document. Return only your corrections as a JSON Patch (RFC 6902) array against the draft above:
+- "op" is "add", "remove" or "replace"; "path" is a JSON Pointer (e.g. "/areas_for_improvement/2", "/scoring/teaching/0/rating", "/positive_feedback/-" to append).
+- "value_json" is the new value encoded as JSON (use "" for "remove").
+- Operations are applied in order: remove several items of one array from the highest index down.
+- Include "/scoring/averages" and "/scoring/final_weighted_score" when they change. Return [] if the draft needs no correction.
+"""
+
+def audit_prompt_parts(start_time, initial_json, as_patch=False):
+    """Step 2 text parts: [instructions, draft JSON, output request].
+
+    Keeping the (possibly large) draft in its own part avoids copying it into the prompt string.
+    """
+    tail = AUDIT_PATCH_PROMPT_TAIL if as_patch else AUDIT_PROMPT_TAIL
+    return [render_audit_prompt_head(start_time=start_time), initial_json, tail]
+
+# --single_pass: sent after the Step 1 prompt so the draft is audited in the same call and Step 2 is skipped
+render_single_pass_note = _compile_prompt("""
+**SELF-AUDIT BEFORE ANSWERING (no separate audit step will run):**
+Draft the report internally, then audit it as a strict QA supervisor before returning it:
+1. Verify every finding against the transcript and frames; delete any without solid evidence.
+2. Delete any issue that occurs before the session start time ({start_time}).
+3. Re-scan the session for missed issues (timing, engagement, technical problems, curriculum errors) and add them with evidence.
+4. Merge repeated findings, keep at least 3 positive_feedback items and recalculate every score from the corrected findings.
+Return ONLY the final, audited JSON.
+""")
+
+def _object_schema(**properties):
+    """OBJECT schema (google.genai dict form) with every property required, in the given order."""
+    return {
+        "type": "OBJECT",
+        "properties": properties,
+        "required": list(properties),
+        "property_ordering": list(properties),
+    }
+
+def _array_schema(items, min_items=None):
+    schema = {"type": "ARRAY", "items": items}
+    if min_items is not None:
+        schema["min_items"] = min_items
+    return schema
+
+_STRING = {"type": "STRING"}
+_NUMBER = {"type": "NUMBER"}
+_FEEDBACK_ITEM = _object_schema(category=_STRING, subcategory=_STRING, text=_STRING, cite=_STRING, timestamp=_STRING)
+# Every category must come back rated, which validate_json_response would otherwise retry for
+_RATING_LIST = _array_schema(_object_schema(subcategory=_STRING, rating={"type": "INTEGER"}, reason=_STRING), min_items=1)
+
+# response_schema for both steps: mirrors REQUIRED SCHEMA in COMBINED_PROMPT_TEMPLATE, so the
+# model returns bare, complete JSON (no markdown fences) with every section present
+AUDIT_REPORT_SCHEMA = _object_schema(
+    meta=_object_schema(tutor_id=_STRING, group_id=_STRING, session_date=_STRING, session_summary=_STRING),
+    positive_feedback=_array_schema(_FEEDBACK_ITEM),
+    areas_for_improvement=_array_schema(_FEEDBACK_ITEM),
+    flags=_array_schema(_object_schema(level=_STRING, subcategory=_STRING, reason=_STRING, cite=_STRING, timestamp=_STRING)),
+    scoring=_object_schema(
+        setup=_RATING_LIST,
+        attitude=_RATING_LIST,
+        preparation=_RATING_LIST,
+        curriculum=_RATING_LIST,
+        teaching=_RATING_LIST,
+        averages=_object_schema(setup=_NUMBER, attitude=_NUMBER, preparation=_NUMBER, curriculum=_NUMBER, teaching=_NUMBER),
+        final_weighted_score=_NUMBER,
+    ),
+    action_plan=_array_schema(_STRING),
+)
+
+# response_schema for a Step 2 patch; values travel JSON-encoded since the schema has no "any" type
+AUDIT_PATCH_SCHEMA = _array_schema(_object_schema(
+    op={"type": "STRING", "enum": ["add", "remove", "replace"]},
+    path=_STRING,
+    value_json=_STRING,
+))
+
+# ============================================================================
+# HTML REPORT TEMPLATE
+# ============================================================================
+# Filled with str.format_map in generate_html_report_from_json (CSS braces are doubled)
+
+# Report label -> scoring.averages key, in display order
+REPORT_CATEGORIES = (
+    ("Setup", "setup"),
+    ("Attitude", "attitude"),
+    ("Preparation", "preparation"),
+    ("Curriculum", "curriculum"),
+    ("Teaching", "teaching"),
+)
+
+HTML_CATEGORY_ROW_TEMPLATE = """                    <div class="cat-item">
+                        <div class="cat-head"><span>{label}</span><span>{score}/5</span></div>
+                        <div class="bar-bg"><div class="bar-fill" style="width: {pct}%"></div></div>
+                    </div>"""
+
+HTML_REPORT_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>iSchool | Quality Audit Report</title>
+    <link rel="preconnect" href="https://fonts.googleapis.com">
+    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+    <link href="https://fonts.googleapis.com/css2?family=Outfit:wght@300;400;600;700&display=swap" rel="stylesheet">
+    <style>
+        :root {{
+            --primary: #4f46e5;
+            --primary-dark: #3730a3;
+            --success: #10b981;
+            --warning: #f59e0b;
+            --danger: #ef4444;
+            --text-main: #1f2937;
+            --text-muted: #6b7280;
+            --bg-body: #f9fafb;
+            --bg-card: #ffffff;
+            --score-color: {score_color};
+        }}
+
+        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
+        body {{ 
+            font-family: 'Outfit', system-ui, -apple-system, sans-serif; 
+            background-color: var(--bg-body); 
+            color: var(--text-main); 
+            line-height: 1.6;
+            overflow-x: hidden;
+        }}
+
+        /* Dynamic Background */
+        body::before {{
+            content: '';
+            position: fixed;
+            top: 0; left: 0; width: 100%; height: 350px;
+            background: linear-gradient(135deg, var(--primary-dark) 0%, #7c3aed 100%);
+            z-index: -1;
+            clip-path: polygon(0 0, 100% 0, 100% 80%, 0 100%);
+        }}
+
+        .wrapper {{ max-width: 1100px; margin: 40px auto; padding: 0 20px; }}
+
+        /* Glassmorphic Header */
+        header {{
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            padding: 30px;
+            background: rgba(255, 255, 255, 0.1);
+            backdrop-filter: blur(10px);
+            border-radius: 24px;
+            border: 1px solid rgba(255, 255, 255, 0.2);
+            color: white;
+            margin-bottom: 30px;
+            box-shadow: 0 10px 30px rgba(0,0,0,0.1);
+        }}
+
+        .logo-box img {{ height: 100px; filter: brightness(0) invert(1); }}
+        .header-info h1 {{ font-size: 1.8rem; font-weight: 700; letter-spacing: -0.5px; }}
+        .header-info p {{ opacity: 0.8; font-weight: 300; }}
+
+        /* Main Dashboard Layout */
+        .dashboard-grid {{
+            display: block;
+            margin-bottom: 30px;
+        }}
+
+        .card {{
+            background: var(--bg-card);
+            border-radius: 24px;
+            padding: 30px;
+            box-shadow: 0 4px 25px rgba(0,0,0,0.05);
+            border: 1px solid #f1f5f9;
+        }}
+
+        /* Score Card Styling */
+        .score-card {{ 
+            display: flex; 
+            flex-direction: row; 
+            align-items: center; 
+            justify-content: space-around; 
+            margin-bottom: 30px;
+        }}
+        .score-circle {{ position: relative; width: 180px; height: 180px; margin-bottom: 0; }}
+        .score-circle svg {{ transform: rotate(-90deg); width: 100%; height: 100%; }}
+        .score-circle .bg {{ fill: none; stroke: #f1f5f9; stroke-width: 8; }}
+        .score-circle .progress {{ fill: none; stroke: var(--score-color); stroke-width: 10; stroke-linecap: round; transition: 1s ease-out; }}
+        .score-val {{ position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); font-size: 3rem; font-weight: 800; color: var(--score-color); }}
+        .perf-badge {{ padding: 8px 20px; border-radius: 50px; background: var(--score-color); color: white; font-weight: 700; font-size: 0.8rem; letter-spacing: 1px; margin-top: 10px; }}
         
-        for future in concurrent.futures.as_completed(future_to_file):
-            try:
-                file = future.result()
-                uploaded_files.append(file)
-            except Exception as e:
-                print(f"Upload failed: {e}")
+        .score-left-pane {{ display: flex; flex-direction: column; align-items: center; }}
+
+        /* Category Breakdown */
+        .cat-list {{ width: 50%; margin-top: 0; }}
+        .cat-item {{ margin-bottom: 18px; }}
+        .cat-head {{ display: flex; justify-content: space-between; margin-bottom: 6px; font-weight: 600; font-size: 0.85rem; color: var(--text-muted); }}
+        .bar-bg {{ height: 8px; background: #f1f5f9; border-radius: 10px; overflow: hidden; }}
+        .bar-fill {{ height: 100%; background: linear-gradient(90deg, var(--primary) 0%, #9333ea 100%); border-radius: 10px; }}
+
+        /* Report Content Styling */
+        .report-section {{ background: white; border-radius: 24px; padding: 40px; box-shadow: 0 4px 25px rgba(0,0,0,0.05); border: 1px solid #f1f5f9; }}
+        .report-content {{ font-size: 1.05rem; color: var(--text-main); }}
+        
+        h2 {{ color: var(--primary); font-size: 1.4rem; margin: 35px 0 20px; display: flex; align-items: center; gap: 12px; border-bottom: 2px solid #f1f5f9; padding-bottom: 12px; }}
+        h2:first-child {{ margin-top: 0; }}
+        
+        .feedback-box {{ padding: 18px 22px; border-radius: 16px; margin-bottom: 15px; border-left: 6px solid; transition: transform 0.2s; }}
+        .feedback-box:hover {{ transform: translateX(5px); }}
+        .feedback-box p {{ margin: 8px 0; line-height: 1.5; }}
+        .feedback-box .cite {{ display: block; margin-top: 8px; color: #9ca3af; font-size: 0.85rem; }}
+        .feedback-box .timestamp {{ display: block; margin-top: 4px; color: #9ca3af; font-size: 0.85rem; }}
+        .p-box {{ background: #f0fdf4; border-color: var(--success); color: #065f46; }}
+        .i-box {{ background: #fffbeb; border-color: var(--warning); color: #92400e; }}
+        
+        /* Flag Colors */
+        .f-box-yellow {{ background: #FEFCE8; border-color: #EAB308; color: #713F12; font-weight: 600; }}
+        .f-box-red {{ background: #FEF2F2; border-color: #EF4444; color: #B91C1C; font-weight: 600; }}
+
+        /* Professional Tables */
+        .table-container {{ overflow-x: auto; margin: 25px 0; border-radius: 16px; border: 1px solid #f1f5f9; }}
+        table {{ width: 100%; border-collapse: collapse; text-align: left; }}
+        th {{ background: #f8fafc; padding: 16px 20px; color: var(--text-muted); font-weight: 700; text-transform: uppercase; font-size: 0.75rem; letter-spacing: 1px; border-bottom: 2px solid #f1f5f9; }}
+        td {{ padding: 16px 20px; border-bottom: 1px solid #f1f5f9; font-size: 0.95rem; }}
+        tr:last-child td {{ border-bottom: none; }}
+        
+        pre {{ white-space: pre-wrap; font-family: 'Outfit', system-ui, -apple-system, sans-serif; }}
+
+        @media (max-width: 900px) {{
+            .dashboard-grid {{ display: block; }}
+            .score-card {{ flex-direction: column; }}
+            .cat-list {{ width: 100%; margin-top: 20px; }}
+            header {{ flex-direction: column; text-align: center; gap: 20px; }}
+        }}
+    </style>
+</head>
+<body>
+    <div class="wrapper">
+        <header>
+            <div class="logo-box">
+                <img src="https://www.webit.network/img/portfolio/ischool/logo.png" alt="iSchool">
+            </div>
+            <div class="header-info">
+                <h1>QUALITY AUDIT REPORT</h1>
+                <p>Forensic Session Analysis Dashboard</p>
+            </div>
+        </header>
+
+        <div class="dashboard-grid">
+            <aside class="card score-card">
+                <div class="score-left-pane">
+                    <div class="score-circle">
+                        <svg viewBox="0 0 100 100">
+                            <circle class="bg" cx="50" cy="50" r="45"></circle>
+                            <circle class="progress" cx="50" cy="50" r="45" style="stroke-dasharray: 283; stroke-dashoffset: {dash_offset};"></circle>
+                        </svg>
+                        <div class="score-val">{final_score:.0f}</div>
+                    </div>
+                    <div class="perf-badge">{perf_label}</div>
+                </div>
                 
-    return uploaded_files
+                <div class="cat-list">
+{category_rows}
+                </div>
+            </aside>
+
+            <main class="report-section">
+                <div class="report-content">
+                    <h2>📋 Session Information</h2>
+                    <div class="feedback-box p-box">
+                        <strong>Tutor:</strong> {tutor_id}<br>
+                        <strong>Date:</strong> {session_date}<br>
+                        <strong>Summary:</strong> {session_summary}
+                    </div>
+
+                    <h2> Audit Summary</h2>
+                    <p>{audit_summary}</p>
+
+                    <h2>✅ Positive Highlights</h2>
+                    {positive_html}
+
+                    <h2>⚠️ Improvement Points</h2>
+                    {improvement_html}
+
+                    <h2>🚩 Compliance Violations</h2>
+                    {flags_html}
+
+                    <h2>🎯 Recommended Actions</h2>
+                    <ul>
+                        {action_items}
+                    </ul>
+                </div>
+            </main>
+        </div>
+    </div>
+</body>
+</html>"""
+
+# ============================================================================
+# CORE FUNCTIONS
+# ============================================================================
+
+def _create_genai_client():
+    """Creates the shared google.genai client; all upload threads reuse its connection pool.
+
+    The pool keeps a keep-alive connection for every thread that can call the API at once
+    (upload workers, consistency drafts and the main call), where httpx's default of 20
+    would close and later re-handshake the extra ones. With the optional `h2` package
+    installed, HTTP/2 is enabled so concurrent calls multiplex over one TLS connection.
+    """
+    try:
+        import httpx
+        client_args = {"limits": httpx.Limits(max_keepalive_connections=MAX_UPLOAD_WORKERS + MAX_CONSISTENCY_WORKERS + 1)}
+    except ImportError:
+        client_args = {}
+    try:
+        import h2  # type: ignore  # noqa: F401
+        client_args["http2"] = True
+    except ImportError:
+        pass
+    if not client_args:
+        return genai.Client(api_key=API_KEY)
+    try:
+        return genai.Client(api_key=API_KEY, http_options=types.HttpOptions(client_args=client_args))
+    except Exception:
+        # Older google-genai releases do not accept client_args
+        return genai.Client(api_key=API_KEY)
+
+# Initialize the new google.genai client
+client = _create_genai_client()
+
+# One pool for the short API calls (uploads, reuse lookups, state polls), so threads are started
+# once per process instead of per helper call. Only leaf calls are submitted: a task that waited
+# on another task in this pool could deadlock it.
+_io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS, thread_name_prefix="gemini-io")
+atexit.register(_io_executor.shutdown)
+
+# Cleared after the first failed multipart upload so the rest use the SDK path
+_multipart_uploads_enabled = str(os.environ.get("GEMINI_MULTIPART_UPLOADS", "true")).lower() != "false"
+
+
+def _json_loads(raw):
+    """Parses JSON from str/bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 
-def wait_for_files_active(files):
-    """Waits for files to be active. Expects (file, path) tuples."""
-    print("Waiting for file processing...")
-    for f, _ in files:
-        file = _call_genai_with_backoff(lambda: client.files.get(name=f.name), what=f"files.get({f.name})")
-        while file.state.name == "PROCESSING":
-            print(".", end="", flush=True)
-            time.sleep(2)
-            file = _call_genai_with_backoff(lambda: client.files.get(name=f.name), what=f"files.get({f.name})")
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
-    print("...all files ready")
+def _json_dumps_compact(data):
+    """Serializes data as compact JSON text (orjson when installed; same output either way)."""
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
 
-def get_start_time_from_transcript(transcript_path):
-    """Parses transcript for first timestamp."""
-    print(f"Parsing transcript for start time: {transcript_path}")
-    try:
-        with open(transcript_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Try VTT format first: 00:13:17.540 --> 00:13:18.659
-            match = re.search(r'(\d{2}:\d{2}:\d{2})', content)
-            if match:
-                start_time = match.group(1)
-                print(f"Found start time: {start_time}")
-                return start_time
-    except Exception as e:
-        print(f"Error parsing transcript: {e}")
-    return DEFAULT_START_TIME
 
-def get_video_duration(video_path):
-    """Gets video duration in seconds using ffprobe."""
-    cmd = [
-        "ffprobe", 
-        "-v", "error", 
-        "-show_entries", "format=duration", 
-        "-of", "default=noprint_wrappers=1:nokey=1", 
-        video_path
-    ]
+def _json_dumps_pretty(data):
+    """Serializes data as 2-space indented JSON text for human-readable output."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+
+def _write_text_file(path, text):
+    """Writes text as UTF-8 with one encode and a single write syscall (looped on short writes)."""
+    data = memoryview(text.encode("utf-8"))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
     try:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        return float(result.stdout.strip())
-    except Exception as e:
-        print(f"Error getting duration: {e}")
-        return 0
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
-def time_str_to_seconds(time_str):
-    """Converts HH:MM:SS to seconds."""
+def _replace_text_file(path, text):
+    """Writes text to a temp file and renames it over path, so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    _write_text_file(tmp_path, text)
+    os.replace(tmp_path, path)
+
+
+def _replace_with_link(source_path, path):
+    """Makes path a hard link to source_path (a copy where links are unsupported), atomically."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        h, m, s = map(int, time_str.split(':'))
-        return h * 3600 + m * 60 + s
-    except ValueError:
-        return 0
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
 
-def extract_frame_at_time(video_path, time_sec, output_path):
-    """Extracts a single frame at a specific time."""
-    ffmpeg_exe = _resolve_ffmpeg_exe()
-    if not ffmpeg_exe:
-        print("[WARNING] ffmpeg not found. Skipping frame extraction.")
-        return
-    cmd = [
-        ffmpeg_exe,
-        "-ss", str(time_sec),
-        "-i", video_path,
-        "-frames:v", "1",
-        "-q:v", str(FRAME_QUALITY),
-        "-vf", f"scale={FRAME_WIDTH}:-1",
-        "-y",
-        output_path
-    ]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-def extract_audio(video_path, output_path):
-    """Extracts audio from video."""
-    print(f"Extracting audio to {output_path}...")
-    ffmpeg_exe = _resolve_ffmpeg_exe()
-    if not ffmpeg_exe:
-        print(f"[WARNING] ffmpeg not found. Skipping audio extraction.")
-        return None
-    cmd = [
-        ffmpeg_exe,
-        "-i", video_path,
-        "-vn",
-        "-acodec", "libmp3lame",
-        "-q:a", "2",
-        "-y",
-        output_path
-    ]
+# Stand-in for a generate_content response (restored from the response cache, or
+# assembled from a streamed call)
+ModelResponse = collections.namedtuple("ModelResponse", ["text", "usage_metadata", "finish_reason"], defaults=(None,))
+
+
+def _file_digest(path):
+    """Returns the hex content digest of a file (memoized on path, mtime and size).
+
+    BLAKE3 when the blake3 package is installed, SHA-256 otherwise; both are 64 hex chars.
+    """
+    st = os.stat(path)
+    return _file_digest_cached(path, st.st_mtime, st.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _file_digest_cached(path, mtime, size):
+    if blake3 is not None:
+        # Multithreaded SIMD hashing over an mmap of the file
+        hasher = blake3(max_threads=blake3.AUTO)
+        if size:
+            hasher.update_mmap(path)
+        return hasher.hexdigest()
+    if size == 0:
+        return hashlib.sha256(b"").hexdigest()
+    with open(path, "rb") as f:
+        # Hash straight from the page cache instead of copying the file into Python buffers
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+def _response_cache_key(*parts):
+    """Hashes the inputs that determine a model response (non-JSON values via repr).
+
+    Stays on stdlib json so keys are identical whether or not orjson is installed.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _response_cache_path(step, key):
+    return os.path.join(RESPONSE_CACHE_DIR, step, f"{key}.json")
+
+
+def _load_cached_response(step, key):
+    """Returns a ModelResponse for a previous identical call, or None on a miss.
+
+    usage_metadata is None because a cache hit spends no tokens. Entries past
+    RESPONSE_CACHE_TTL_SEC are deleted and count as misses.
+    """
+    path = _response_cache_path(step, key)
     try:
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-        return output_path
-    except subprocess.CalledProcessError as e:
-        print(f"[WARNING] Audio extraction failed: {e}")
+        with open(path, "rb") as f:
+            if RESPONSE_CACHE_TTL_SEC > 0 and time.time() - os.fstat(f.fileno()).st_mtime > RESPONSE_CACHE_TTL_SEC:
+                expired = True
+            else:
+                expired = False
+                payload = _json_loads(f.read())
+    except (OSError, ValueError):
         return None
+    if expired:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return ModelResponse(text=payload["text"], usage_metadata=None)
+
+
+def _store_cached_response(step, key, response):
+    """Saves a response under its cache key (write-then-rename, so readers never see a partial file)."""
+    path = _response_cache_path(step, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    usage = response.usage_metadata
+    payload = {
+        "text": response.text,
+        "usage_metadata": {
+            "prompt_token_count": usage.prompt_token_count,
+            "candidates_token_count": usage.candidates_token_count,
+        } if usage else None,
+    }
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    _write_text_file(tmp_path, _json_dumps_compact(payload))
+    os.replace(tmp_path, path)
+
+
+def _http_status(exc: Exception):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        # httpx.HTTPStatusError and google.genai APIError carry the status on their response
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
 
-def extract_resources(video_path, start_time):
-    """Extracts frames using parallel ffmpeg seeking (Super Fast)."""
-    print("--- Extracting Resources (Super Fast Parallel) ---")
-    
-    base_dir = os.path.dirname(video_path)
-    frames_dir = os.path.join(base_dir, TEMP_FRAMES_DIRNAME)
-    
-    # Check if frames already exist
-    if os.path.exists(frames_dir):
-        existing_frames = glob.glob(os.path.join(frames_dir, "*.jpg"))
-        if len(existing_frames) >= TARGET_FRAME_COUNT:
-            print(f"Frames already exist in {frames_dir}. Skipping extraction.")
-            return frames_dir
-        else:
-            print("Found partial frames, re-extracting...")
-            shutil.rmtree(frames_dir)
-            
-    os.makedirs(frames_dir)
-    
-    start_seconds = time_str_to_seconds(start_time)
-    duration = get_video_duration(video_path)
-    
-    if duration == 0:
-        print("Could not determine duration, using default range...")
-        duration = start_seconds + 3600 # Default to 1 hour if unknown
 
-    print(f"Video Duration: {duration:.2f}s, Start Time: {start_seconds}s")
-    
-    timestamps = []
-    current_time = start_seconds
-    while current_time < duration:
-        timestamps.append(current_time)
-        current_time += FRAME_EXTRACTION_INTERVAL
-        
-    print(f"Extracting {len(timestamps)} frames in parallel...")
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        futures = []
-        for i, ts in enumerate(timestamps):
-            output_path = os.path.join(frames_dir, f"frame_{i:03d}.jpg")
-            futures.append(executor.submit(extract_frame_at_time, video_path, ts, output_path))
-            
-        # Wait for all to complete
-        concurrent.futures.wait(futures)
-            
-    return frames_dir
+def _is_permanent_error(exc: Exception) -> bool:
+    """True for 4xx responses a retry cannot fix (bad request, auth, not found); 408/429 stay retryable."""
+    status = _http_status(exc)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
 
-def should_rerun_analysis(data):
+
+def _is_quota_exhausted_error(exc: Exception) -> bool:
+    status = _http_status(exc)
+    if status == 429:
+        return True
+    msg = str(exc)
+    return ("RESOURCE_EXHAUSTED" in msg) or (" 429" in msg) or ("quota" in msg.lower())
+
+
+def _call_genai_with_backoff(fn, *, what: str = "genai", max_attempts: int | None = None):
+    """Call a google.genai SDK function with light backoff; exit 42 on persistent quota exhaustion.
+
+    Permanent 4xx errors (see _is_permanent_error) are raised at once instead of retried.
+    Exit code 42 is intentional: the Node server detects quota exhaustion and delays retries.
     """
-    Checks if analysis should be re-run due to quality concerns:
-    1. Any subcategory rating being 0 (indicates incomplete evaluation)
-    2. Final weighted score being less than 68% (below acceptable threshold)
-    
-    This acts as a quality gate to ensure all sessions are properly evaluated.
-    If either condition is triggered, the analysis is re-run to get a more accurate assessment.
-    
-    Args:
-        data (dict): Parsed JSON data from the initial analysis
-        
-    Returns:
-        tuple: (should_rerun: bool, reason: str)
-        
-    Example:
-        >>> data = {"scoring": {"final_weighted_score": 65, "setup": [{"rating": 0}]}}
-        >>> should_rerun, reason = should_rerun_analysis(data)
-        >>> should_rerun
-        True
-        >>> reason
-        "Category 'setup' subcategory 'Unknown' has rating 0"
+    if max_attempts is None:
+        max_attempts = max(1, int(os.environ.get("GEMINI_MAX_ATTEMPTS", "3")))
+
+    base = float(os.environ.get("GEMINI_BACKOFF_BASE_SEC", "5"))
+    cap = float(os.environ.get("GEMINI_BACKOFF_MAX_SEC", "60"))
+    quota_attempts = max(1, int(os.environ.get("GEMINI_429_MAX_ATTEMPTS", "2")))
+
+    quota_seen = 0
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if _is_quota_exhausted_error(e):
+                quota_seen += 1
+                if quota_seen >= quota_attempts:
+                    print(f"[QUOTA_EXHAUSTED] {what}: {e}")
+                    sys.exit(42)
+
+            # Rate limits, 5xx and network errors are transient; a rejected request is not
+            if attempt >= max_attempts or _is_permanent_error(e):
+                raise
+
+            sleep_s = min(cap, base * (2 ** (attempt - 1)))
+            sleep_s = sleep_s * (0.7 + random.random() * 0.6)  # jitter 0.7x..1.3x
+            print(f"[RETRY] {what} attempt {attempt}/{max_attempts} failed: {e} (sleep {sleep_s:.1f}s)")
+            time.sleep(sleep_s)
+
+
+def generate_content_streamed(**kwargs):
+    """generate_content via generate_content_stream, joined into a single ModelResponse.
+
+    Output arrives as it is generated (a dot per chunk shows progress) and the connection
+    never sits idle while a long response is produced. usage_metadata comes from the
+    final chunk, finish_reason from the last chunk that carries one. Wrap it in
+    _call_genai_with_backoff: a failure mid-stream restarts the call.
+    """
+    parts = []
+    usage = finish_reason = None
+    for chunk in client.models.generate_content_stream(**kwargs):
+        if chunk.text:
+            parts.append(chunk.text)
+            print(".", end="", flush=True)
+        if chunk.usage_metadata is not None:
+            usage = chunk.usage_metadata
+        finish_reason = _finish_reason(chunk) or finish_reason
+    print()
+    return ModelResponse(text="".join(parts), usage_metadata=usage, finish_reason=finish_reason)
+
+BATCH_JOB_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_POLL_MAX_SEC = 60
+
+def generate_content_batched(*, model, contents, config):
+    """generate_content as a one-request Batch API job, waited on and returned as a ModelResponse.
+
+    Jobs finish within 24 hours at half the price, so this suits unattended runs. Polling backs
+    off from 5s to BATCH_POLL_MAX_SEC. Raises RuntimeError if the job or its request fails;
+    wrap it in _call_genai_with_backoff like generate_content_streamed.
+    """
+    job = _call_genai_with_backoff(
+        lambda: client.batches.create(
+            model=model,
+            src=[types.InlinedRequest(contents=contents, config=config)],
+        ),
+        what="batches.create",
+    )
+    print(f"[BATCH] Submitted {job.name}; waiting for it to finish", end="", flush=True)
+    delay = 5.0
+    state = getattr(job.state, "name", job.state)
+    while state not in BATCH_JOB_DONE_STATES:
+        time.sleep(delay)
+        delay = min(BATCH_POLL_MAX_SEC, delay * 2)
+        job = _call_genai_with_backoff(lambda: client.batches.get(name=job.name), what="batches.get")
+        state = getattr(job.state, "name", job.state)
+        print(".", end="", flush=True)
+    print()
+    if state != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {job.name} ended in {state}: {job.error}")
+    inlined = job.dest.inlined_responses[0]
+    if inlined.error is not None or inlined.response is None:
+        raise RuntimeError(f"Batch job {job.name} request failed: {inlined.error}")
+    response = inlined.response
+    return ModelResponse(text=response.text or "", usage_metadata=response.usage_metadata, finish_reason=_finish_reason(response))
+
+def _add_usage(totals, step, response):
+    """Adds a response's token counts to totals["in_<step>"], ["out_<step>"] and ["thoughts_<step>"].
+
+    totals is a Counter. Thinking tokens are billed as output but not included in
+    candidates_token_count, so out counts both. Cache hits carry no usage_metadata and add nothing.
+    """
+    usage = response.usage_metadata
+    if usage is not None:
+        thoughts = getattr(usage, "thoughts_token_count", None) or 0
+        totals[f"in_{step}"] += usage.prompt_token_count or 0
+        totals[f"out_{step}"] += (usage.candidates_token_count or 0) + thoughts
+        totals[f"thoughts_{step}"] += thoughts
+
+def _finish_reason(response):
+    """Name of the first candidate's finish reason (e.g. "STOP", "MAX_TOKENS"), or None."""
+    reason = getattr(response, "finish_reason", None)
+    if reason is None:
+        candidates = getattr(response, "candidates", None) or ()
+        reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason)
+
+def _doubled_output_cap(config_kwargs, limit=None):
+    """config_kwargs with max_output_tokens doubled (capped at limit), or None if it cannot grow."""
+    cap = config_kwargs.get("max_output_tokens")
+    if cap is None or (limit is not None and cap >= limit):
+        return None
+    return {**config_kwargs, "max_output_tokens": cap * 2 if limit is None else min(cap * 2, limit)}
+
+
+def _keep_uploaded_files():
+    return str(os.environ.get("GEMINI_DELETE_UPLOADED_FILES", "true")).lower() == "false"
+
+def delete_uploaded_gemini_files(uploaded_files):
+    """Best-effort cleanup for Gemini Files API to avoid accumulating storage.
+
+    Gemini file uploads persist server-side until deleted; leaving them will eventually
+    hit per-project storage limits.
+    """
+    if _keep_uploaded_files():
+        return
+
+    if not uploaded_files:
+        return
+
+    deleted = 0
+    for f, original_path in uploaded_files:
+        try:
+            name = getattr(f, "name", None)
+            if not name:
+                continue
+            client.files.delete(name=name)
+            deleted += 1
+        except Exception as e:
+            # Don't fail the whole run due to cleanup
+            try:
+                base = os.path.basename(original_path or "")
+            except Exception:
+                base = ""
+            print(f"[CLEANUP WARNING] Could not delete uploaded file {base}: {e}")
+
+    if deleted:
+        print(f"[CLEANUP] Deleted {deleted} uploaded Gemini file(s)")
+
+def create_context_cache(resource_files, gen_config_kwargs, ttl=CONTEXT_CACHE_TTL):
+    """Caches the session files and system instruction server-side for both analysis steps.
+
+    Returns the cache, or None if the model or SDK rejects caching (callers then send
+    the files with each request as before).
     """
     try:
-        scoring = data.get("scoring", {})
-        final_score = scoring.get("final_weighted_score", 0)
-        
-        # Check if score is below 68%
-        if final_score < 68:
-            return True, f"Score {final_score} is below 68% threshold"
-        
-        # Check if any subcategory has rating 0
-        categories = ["setup", "attitude", "preparation", "curriculum", "teaching"]
-        for cat in categories:
-            if cat in scoring and isinstance(scoring[cat], list):
-                for item in scoring[cat]:
-                    rating = item.get("rating", 0)
-                    if rating == 0:
-                        subcategory = item.get("subcategory", "Unknown")
-                        return True, f"Category '{cat}' subcategory '{subcategory}' has rating 0"
-        
-        return False, "Analysis meets quality threshold"
+        cache = _call_genai_with_backoff(
+            lambda: client.caches.create(
+                model=MODEL_NAME,
+                config=types.CreateCachedContentConfig(
+                    contents=resource_files,
+                    system_instruction=gen_config_kwargs.get("system_instruction"),
+                    tools=gen_config_kwargs.get("tools"),
+                    ttl=ttl,
+                ),
+            ),
+            what="caches.create",
+            max_attempts=1,
+        )
     except Exception as e:
-        return False, f"Error checking analysis: {e}"
+        print(f"[WARNING] Context cache unavailable, sending files with each request: {e}")
+        return None
+    # The cache reports its size for free, so every request's shared prefix is known up front
+    cached_tokens = getattr(getattr(cache, "usage_metadata", None), "total_token_count", None)
+    if cached_tokens:
+        print(f"[INFO] Context cache holds {cached_tokens} tokens")
+        if cached_tokens > LARGE_CONTEXT_TOKENS:
+            print(f"[WARNING] Over {LARGE_CONTEXT_TOKENS} context tokens: expect slow responses "
+                  "(fewer reference PDFs or a lower --media_resolution shrink it)")
+    return cache
+
+def _audit_config_overrides(initial_json, max_output_tokens=None, thinking_level=AUDIT_THINKING_LEVEL):
+    """GenerateContentConfig overrides for the Step 2 audit pass."""
+    output_cap = len(initial_json) // 2 + AUDIT_OUTPUT_TOKEN_MARGIN
+    if max_output_tokens is not None:
+        output_cap = min(output_cap, max_output_tokens)
+    overrides = {"max_output_tokens": output_cap}
+    try:
+        overrides["thinking_config"] = types.ThinkingConfig(thinking_level=thinking_level)
+    except Exception:
+        # Older google-genai releases have no thinking_level; keep the model default
+        pass
+    return overrides
 
-def validate_json_response(json_text):
+def _get_shared_context_cache(index_path, key, files, gen_config_kwargs, ttl_sec, min_ttl_sec, label):
+    """Returns a context cache of files recorded under key in index_path, creating it on a miss.
+
+    A recorded cache is reused until less than min_ttl_sec remains; expired
+    entries are evicted whenever a new one is recorded. Returns None if caching is unavailable.
     """
-    Validates that the JSON response is complete and properly structured.
-    Returns (is_valid, data_or_error_msg)
-    
-    A valid response must have:
-    1. Valid JSON syntax
-    2. Non-empty object (not {})
-    3. Required top-level keys: meta, scoring
-    4. Scoring section with at least one category
+    entries = _load_json_cache(index_path)
+    now = time.time()
+    entry = entries.get(key)
+    if entry and entry.get("expires_at", 0) - now > min_ttl_sec:
+        try:
+            cache = client.caches.get(name=entry["name"])
+            print(f"[CACHE] Reusing {label} context cache ({cache.name})")
+            return cache
+        except Exception:
+            pass
+
+    cache = create_context_cache(files, gen_config_kwargs, ttl=f"{ttl_sec}s")
+    if cache is not None:
+        entries = {k: v for k, v in entries.items() if v.get("expires_at", 0) > now}
+        entries[key] = {"name": cache.name, "expires_at": now + ttl_sec}
+        _save_json_cache(index_path, entries)
+    return cache
+
+def get_rules_context_cache(reference_files, gen_config_kwargs):
+    """Returns a context cache of the system instruction and reference PDFs shared across sessions.
+
+    reference_files are (file, path) tuples. The cache name is kept in RULES_CACHE_PATH,
+    keyed on the model, system instruction, tools and PDF content hashes, and reused
+    until it is close to expiry. Returns None if caching is unavailable.
     """
+    key = _response_cache_key(
+        MODEL_NAME,
+        gen_config_kwargs.get("system_instruction"),
+        repr(gen_config_kwargs.get("tools")),
+        [_file_digest(path) for _, path in reference_files],
+    )
+    return _get_shared_context_cache(
+        RULES_CACHE_PATH, key, [f for f, _ in reference_files], gen_config_kwargs,
+        RULES_CACHE_TTL_SEC, REFERENCE_UPLOAD_MIN_TTL_SEC, "reference rules",
+    )
+
+def get_session_context_cache(session_files, gen_config_kwargs):
+    """Returns a context cache of all of a session's files, kept for later runs of the same session.
+
+    session_files are (file, path) tuples in prompt order. Like get_rules_context_cache, but
+    keyed on every file's content hash (in order), so a rerun with re-uploaded but identical
+    files still hits. Returns None if caching is unavailable.
+    """
+    key = _response_cache_key(
+        MODEL_NAME,
+        gen_config_kwargs.get("system_instruction"),
+        repr(gen_config_kwargs.get("tools")),
+        [_file_digest(path) for _, path in session_files],
+    )
+    return _get_shared_context_cache(
+        SESSION_CONTEXT_CACHE_PATH, key, [f for f, _ in session_files], gen_config_kwargs,
+        SESSION_CONTEXT_CACHE_TTL_SEC, SESSION_CONTEXT_CACHE_MIN_TTL_SEC, "session",
+    )
+
+def _cached_generation_config(gen_config_kwargs, cache):
+    """GenerateContentConfig that reads from cache (system instruction and tools live in the cache)."""
+    kwargs = {k: v for k, v in gen_config_kwargs.items() if k not in ("system_instruction", "tools")}
+    return types.GenerateContentConfig(**kwargs, cached_content=cache.name)
+
+def delete_context_cache(cache):
+    """Best-effort deletion of a context cache before its TTL runs out."""
+    if cache is None:
+        return
     try:
-        # Check for empty or whitespace-only response
-        if not json_text or not json_text.strip():
-            return False, "Empty response received"
-        
-        # Parse JSON
-        data = json.loads(json_text)
-        
-        # Check for empty object
-        if not data or data == {}:
-            return False, "Empty JSON object received ({})"
-        
-        # Check required top-level keys
-        required_keys = ["meta", "scoring"]
-        missing_keys = [k for k in required_keys if k not in data]
-        if missing_keys:
-            return False, f"Missing required keys: {missing_keys}"
-        
-        # Check scoring has content
-        scoring = data.get("scoring", {})
-        if not scoring:
-            return False, "Scoring section is empty"
-        
-        # Check at least one category has ratings
-        categories = ["setup", "attitude", "preparation", "curriculum", "teaching"]
-        has_ratings = False
-        for cat in categories:
-            if cat in scoring and isinstance(scoring[cat], list) and len(scoring[cat]) > 0:
-                has_ratings = True
-                break
-        
-        if not has_ratings:
-            return False, "No category ratings found in scoring"
-        
-        return True, data
-    except json.JSONDecodeError as e:
-        return False, f"Invalid JSON syntax: {e}"
+        client.caches.delete(name=cache.name)
     except Exception as e:
-        return False, f"Validation error: {e}"
+        print(f"[CLEANUP WARNING] Could not delete context cache: {e}")
+
+@functools.lru_cache(maxsize=1)
+def _resolve_ffmpeg_exe():
+    """Return path to ffmpeg binary, preferring system ffmpeg then imageio-ffmpeg."""
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    try:
+        import imageio_ffmpeg  # type: ignore
+
+        exe = imageio_ffmpeg.get_ffmpeg_exe()
+        if exe and os.path.exists(exe):
+            return exe
+    except Exception:
+        return None
+    return None
 
-def compute_median_score(scores):
+@functools.lru_cache(maxsize=2)
+def _ffmpeg_hwaccels(ffmpeg_exe):
+    """Returns the hardware decode methods this ffmpeg build lists (`ffmpeg -hwaccels`)."""
+    if str(os.environ.get("GEMINI_FFMPEG_HWACCEL", "true")).lower() == "false":
+        return ()
+    try:
+        result = subprocess.run([ffmpeg_exe, "-hide_banner", "-hwaccels"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=10)
+    except Exception:
+        return ()
+    lines = result.stdout.splitlines()
+    # First line is the "Hardware acceleration methods:" header
+    return tuple(line.strip() for line in lines[1:] if line.strip())
+
+@functools.lru_cache(maxsize=2)
+def _resolve_ffprobe_exe(ffmpeg_exe=None):
+    """Return path to ffprobe binary if available."""
+    exe = shutil.which("ffprobe")
+    if exe:
+        return exe
+    if ffmpeg_exe:
+        candidate = os.path.join(os.path.dirname(ffmpeg_exe), "ffprobe")
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+@functools.lru_cache(maxsize=1)
+def _upload_http_client():
+    """Pooled keep-alive HTTP client for multipart uploads, shared by all upload threads.
+
+    One connection per upload worker is kept open, and failed connection attempts are
+    retried by the transport; other failures fall back to the SDK upload with backoff.
     """
-    Computes the median score from a list of scores.
-    The median is more robust to outliers than the mean.
+    import httpx
+    transport_kwargs = dict(
+        retries=3,
+        limits=httpx.Limits(max_connections=MAX_UPLOAD_WORKERS, max_keepalive_connections=MAX_UPLOAD_WORKERS),
+    )
+    try:
+        transport = httpx.HTTPTransport(http2=True, **transport_kwargs)
+    except ImportError:
+        # h2 is not installed
+        transport = httpx.HTTPTransport(**transport_kwargs)
+    return httpx.Client(transport=transport, timeout=120)
+
+def _upload_bytes_multipart(data, mime_type, display_name):
+    """Uploads a small file to the Files API in a single multipart/related request."""
+    boundary = f"=={os.urandom(12).hex()}=="
+    metadata = _json_dumps_compact({"file": {"displayName": display_name, "mimeType": mime_type}})
+    body = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{metadata}\r\n".encode("utf-8"),
+        f"--{boundary}\r\nContent-Type: {mime_type}\r\n\r\n".encode("utf-8"),
+        data,
+        f"\r\n--{boundary}--\r\n".encode("utf-8"),
+    ])
+    response = _upload_http_client().post(
+        GEMINI_UPLOAD_URL,
+        params={"uploadType": "multipart"},
+        headers={"x-goog-api-key": API_KEY, "Content-Type": f"multipart/related; boundary={boundary}"},
+        content=body,
+    )
+    response.raise_for_status()
+    return types.File.model_validate(response.json()["file"])
+
+def upload_to_gemini(path, mime_type=None, index=None, total=None, data=None, quiet=False):
+    """Uploads the given file to Gemini sequentially with progress tracking.
+
+    If data (bytes) is given it is uploaded from memory and path only labels the upload.
+    quiet suppresses the per-file [OK] line (failures are always printed).
     """
-    if not scores:
-        return 0
-    sorted_scores = sorted(scores)
-    n = len(sorted_scores)
-    if n % 2 == 1:
-        return sorted_scores[n // 2]
+    global _multipart_uploads_enabled
+    if index is not None and total is not None:
+        prefix = f"Counter: [{index}/{total}]"
     else:
-        return (sorted_scores[n // 2 - 1] + sorted_scores[n // 2]) / 2
+        prefix = "Uploading"
+    
+    try:
+        # Small jitter to reduce request bursts under parallel uploads
+        time.sleep(float(os.environ.get("GEMINI_UPLOAD_JITTER_SEC", "0.2")) * random.random())
+        file = None
+        if _multipart_uploads_enabled and mime_type:
+            if data is None and os.path.getsize(path) <= MULTIPART_UPLOAD_MAX_BYTES:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            if data is not None and len(data) <= MULTIPART_UPLOAD_MAX_BYTES:
+                try:
+                    file = _upload_bytes_multipart(data, mime_type, os.path.basename(path))
+                except Exception as e:
+                    # Quota errors are left to the backoff path below (exit 42 handling)
+                    if not _is_quota_exhausted_error(e):
+                        _multipart_uploads_enabled = False
+                        print(f"[WARNING] Multipart upload failed ({e}); falling back to resumable uploads")
+        if file is None:
+            file = _call_genai_with_backoff(
+                lambda: client.files.upload(
+                    file=io.BytesIO(data) if data is not None else path,
+                    config={"mime_type": mime_type} if mime_type else None,
+                ),
+                what=f"files.upload({os.path.basename(path)})",
+            )
+        if not quiet:
+            print(f"{prefix} [OK] {file.uri}")
+        return (file, path)  # Return tuple for sorting by original path
+    except Exception as e:
+        print(f"{prefix} [FAIL] Failed to upload {path}: {e}")
+        raise
 
-def select_best_analysis_by_median(analyses):
-    """
-    Given multiple analysis results, selects the one closest to the median score.
-    This ensures we pick a representative analysis, not an outlier.
+def upload_files_sequentially(files_to_upload):
+    """Uploads multiple files sequentially (One after another)."""
+    uploaded_files = []
+    total_files = len(files_to_upload)
+    print(f"Starting sequential upload for {total_files} files...")
     
-    Args:
-        analyses: List of (json_text, data_dict, score) tuples
-        
-    Returns:
-        tuple: (best_json_text, best_data, median_score, all_scores, variance)
+    for i, (path, mime_type) in enumerate(files_to_upload, 1):
+        try:
+            file = upload_to_gemini(path, mime_type, index=i, total=total_files)
+            uploaded_files.append(file)
+        except Exception as e:
+            # Error is already printed in upload_to_gemini
+            pass
+                
+    return uploaded_files
+
+def upload_files_parallel(files_to_upload, streamed_files=None, streamed_count=0):
+    """Uploads multiple files in parallel on the shared I/O thread pool.
+
+    streamed_files is an optional iterable of (path, mime_type, data) that is consumed while
+    the pool is already uploading, so a producer (frame extraction) overlaps with uploads.
+    data holds the file bytes when already in memory, otherwise None to read from path.
+    streamed_count is the expected number of streamed files, used for progress output.
     """
-    if not analyses:
-        return None, {}, 0, [], 0
-    
-    scores = [a[2] for a in analyses]
-    median = compute_median_score(scores)
-    
-    # Calculate variance
-    variance = max(scores) - min(scores) if len(scores) > 1 else 0
-    
-    # Find analysis closest to median
-    best_idx = 0
-    min_diff = abs(scores[0] - median)
-    for i, score in enumerate(scores):
-        diff = abs(score - median)
-        if diff < min_diff:
-            min_diff = diff
-            best_idx = i
-    
-    best_json, best_data, best_score = analyses[best_idx]
+    total_files = len(files_to_upload)
+    print(f"Starting parallel upload for {total_files} files...")
+
+    # Workers share one counter; progress is printed about 20 times instead of per file
+    expected_total = total_files + streamed_count
+    report_every = max(1, expected_total // 20)
+    completed = itertools.count(1)
+    progress_lock = threading.Lock()
+
+    def report_progress(future):
+        if future.exception() is not None:
+            return
+        with progress_lock:
+            n = next(completed)
+            if n % report_every == 0 or n == expected_total:
+                print(f"Uploaded [{n}/{expected_total}]", flush=True)
+
+    if not files_to_upload and streamed_files is None:
+        return []
+
+    # Each upload already retries transient failures via _call_genai_with_backoff
+    futures = []
+    for i, (path, mime_type) in enumerate(files_to_upload):
+        futures.append(_io_executor.submit(upload_to_gemini, path, mime_type, index=i+1, total=total_files, quiet=True))
+        futures[-1].add_done_callback(report_progress)
+    if streamed_files is not None:
+        for path, mime_type, data in streamed_files:
+            futures.append(_io_executor.submit(upload_to_gemini, path, mime_type, data=data, quiet=True))
+            futures[-1].add_done_callback(report_progress)
     
-    # Update the score in data to be the median for consistency
-    if "scoring" in best_data:
-        best_data["scoring"]["final_weighted_score"] = round(median, 1)
-        best_data["scoring"]["_consistency_info"] = {
-            "individual_scores": scores,
-            "median_score": round(median, 1),
-            "score_variance": round(variance, 1),
-            "runs": len(scores),
-            "reliable": variance <= SCORE_VARIANCE_THRESHOLD
+    # Keep submission order so callers do not need to re-sort
+    uploaded_files = []
+    for future in futures:
+        try:
+            uploaded_files.append(future.result())
+        except Exception as e:
+            print(f"Upload failed: {e}")
+    return uploaded_files
+
+def _reference_cache_enabled():
+    return str(os.environ.get("GEMINI_REFERENCE_CACHE", "true")).lower() != "false"
+
+def _load_json_cache(path):
+    """Reads a small JSON cache file; missing or corrupt files read as empty."""
+    try:
+        with open(path, "rb") as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def _save_json_cache(path, data):
+    """Writes a JSON cache file atomically (best effort; a failure only costs a cache miss)."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        _write_text_file(tmp_path, _json_dumps_compact(data))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[WARNING] Could not save {path}: {e}")
+
+def reuse_reference_uploads(pdf_paths):
+    """Looks up earlier uploads of the reference PDFs (or any kept file) by content hash.
+
+    Returns (reused, to_upload): reused holds (file, path) tuples for files whose Gemini
+    file is still ACTIVE and not close to expiry; to_upload lists the paths to upload.
+    """
+    if not _reference_cache_enabled() or not pdf_paths:
+        return [], list(pdf_paths)
+
+    cache = _load_json_cache(REFERENCE_UPLOAD_CACHE_PATH)
+    now = time.time()
+
+    def _lookup(path):
+        entry = cache.get(_file_digest(path))
+        if not entry or entry.get("expires_at", 0) - now < REFERENCE_UPLOAD_MIN_TTL_SEC:
+            return None
+        try:
+            # A deleted or expired file raises (404), which simply means re-upload
+            file = client.files.get(name=entry["name"])
+        except Exception:
+            return None
+        return file if getattr(file.state, "name", None) == "ACTIVE" else None
+
+    found = list(_io_executor.map(_lookup, pdf_paths))
+
+    reused = [(file, path) for file, path in zip(found, pdf_paths) if file is not None]
+    to_upload = [path for file, path in zip(found, pdf_paths) if file is None]
+    if reused:
+        print(f"[CACHE] Reusing {len(reused)} previously uploaded file(s)")
+    return reused, to_upload
+
+def remember_reference_uploads(uploaded):
+    """Records freshly uploaded reference PDFs or kept files ((file, path) tuples) for later runs."""
+    if not _reference_cache_enabled() or not uploaded:
+        return
+    cache = _load_json_cache(REFERENCE_UPLOAD_CACHE_PATH)
+    now = time.time()
+    # Drop entries Gemini has already expired so the file does not grow without bound
+    cache = {k: v for k, v in cache.items() if v.get("expires_at", 0) > now}
+    for file, path in uploaded:
+        expiration = getattr(file, "expiration_time", None)
+        cache[_file_digest(path)] = {
+            "name": file.name,
+            "uri": file.uri,
+            "expires_at": expiration.timestamp() if expiration else now + GEMINI_FILE_TTL_SEC,
         }
-        best_json = json.dumps(best_data, indent=2)
-    
-    return best_json, best_data, median, scores, variance
+    _save_json_cache(REFERENCE_UPLOAD_CACHE_PATH, cache)
+
+def _video_fingerprint(video_path):
+    """Cheap identity for a large video: SHA-256 of its size plus its first and last MiB."""
+    size = os.path.getsize(video_path)
+    h = hashlib.sha256(str(size).encode("ascii"))
+    with open(video_path, "rb") as f:
+        h.update(f.read(VIDEO_FINGERPRINT_BYTES))
+        if size > VIDEO_FINGERPRINT_BYTES:
+            f.seek(max(VIDEO_FINGERPRINT_BYTES, size - VIDEO_FINGERPRINT_BYTES))
+            h.update(f.read())
+    return h.hexdigest()
+
+def session_media_key(video_path, start_time, include_audio):
+    """Key for a session's uploaded frames/audio: same video, timeline and frame settings."""
+    try:
+        fingerprint = _video_fingerprint(video_path)
+    except OSError:
+        return None
+    timeline = get_frame_timeline(video_path, start_time)
+    return _response_cache_key(fingerprint, timeline, FRAME_WIDTH, FRAME_QUALITY, include_audio)
 
-def compare_and_keep_best(data1, data2):
+def reuse_session_media(key):
+    """Returns the (file, path) tuples recorded for key if every one is still usable, else [].
+
+    All-or-nothing: the files are checked with one files.list() call, and a miss on any of
+    them (expired, deleted, not ACTIVE, or its local file gone) re-extracts and re-uploads.
     """
-    Compares two analysis JSON objects and returns the one with the higher score.
-    This function is used when analysis is re-run to select the best result.
-    
-    Args:
-        data1 (dict): First analysis result
-        data2 (dict): Second (retry) analysis result
-        
-    Returns:
-        tuple: (best_data: dict, score1: float, score2: float, selected: str)
-               where selected is either "First" or "Second"
-               
-    Example:
-        >>> data1 = {"scoring": {"final_weighted_score": 72}}
-        >>> data2 = {"scoring": {"final_weighted_score": 75}}
-        >>> best, s1, s2, sel = compare_and_keep_best(data1, data2)
-        >>> sel
-        "Second"
-        >>> best == data2
-        True
+    entry = _load_json_cache(SESSION_UPLOAD_CACHE_PATH).get(key) if key else None
+    if not entry or entry.get("expires_at", 0) - time.time() < REFERENCE_UPLOAD_MIN_TTL_SEC:
+        return []
+    recorded = entry.get("files", [])
+    if not recorded or not all(os.path.exists(item["path"]) for item in recorded):
+        return []
+    try:
+        listed = _call_genai_with_backoff(
+            lambda: list(client.files.list(config={"page_size": 100})),
+            what="files.list",
+        )
+    except Exception:
+        return []
+    by_name = {f.name: f for f in listed if getattr(f.state, "name", None) == "ACTIVE"}
+    if any(item["name"] not in by_name for item in recorded):
+        return []
+    print(f"[CACHE] Reusing {len(recorded)} uploaded frame/audio file(s) from an earlier run")
+    return [(by_name[item["name"]], item["path"]) for item in recorded]
+
+def remember_session_media(key, uploaded):
+    """Records a session's frame/audio uploads ((file, path) tuples, in prompt order) under key."""
+    if not key or not uploaded:
+        return
+    cache = _load_json_cache(SESSION_UPLOAD_CACHE_PATH)
+    now = time.time()
+    cache = {k: v for k, v in cache.items() if v.get("expires_at", 0) > now}
+    expirations = [getattr(f, "expiration_time", None) for f, _ in uploaded]
+    cache[key] = {
+        "files": [{"name": f.name, "path": path} for f, path in uploaded],
+        # The first file to expire ends the entry
+        "expires_at": min(e.timestamp() if e else now + GEMINI_FILE_TTL_SEC for e in expirations),
+    }
+    _save_json_cache(SESSION_UPLOAD_CACHE_PATH, cache)
+
+def _get_file_states(names):
+    """Returns {file_name: state_name} for the given names.
+
+    Uses one paged files.list() call for all files; anything the listing does not
+    return falls back to parallel files.get() calls.
     """
+    states = {}
     try:
-        score1 = data1.get("scoring", {}).get("final_weighted_score", 0)
-        score2 = data2.get("scoring", {}).get("final_weighted_score", 0)
-        
-        if score1 >= score2:
-            return data1, score1, score2, "First"
-        else:
-            return data2, score1, score2, "Second"
+        listed = _call_genai_with_backoff(
+            lambda: list(client.files.list(config={"page_size": 100})),
+            what="files.list",
+        )
+        for file in listed:
+            if file.name in names:
+                states[file.name] = file.state.name
     except Exception as e:
-        print(f"Error comparing analyses: {e}")
-        return data1, 0, 0, "First (default)"
+        print(f"[WARNING] files.list failed, polling files individually: {e}")
 
-def generate_html_report_from_json(json_path):
-    """Generates a premium, fixed-style professional HTML report from JSON data."""
-    html_path = os.path.splitext(json_path)[0] + ".html"
-    print(f"\n--- Generating Premium HTML Report: {html_path} ---")
+    missing = [n for n in names if n not in states]
+    if missing:
+        def _get(name):
+            return _call_genai_with_backoff(lambda: client.files.get(name=name), what=f"files.get({name})")
+
+        for name, file in zip(missing, _io_executor.map(_get, missing)):
+            states[name] = file.state.name
+    return states
+
+def wait_for_files_active(files):
+    """Waits for files to be active. Expects (file, path) tuples."""
+    print("Waiting for file processing...")
+    pending = {f.name for f, _ in files if getattr(f.state, "name", None) != "ACTIVE"}
+    delay = 0.25
+    while pending:
+        states = _get_file_states(pending)
+        for name in pending:
+            if states.get(name) not in ("PROCESSING", "ACTIVE"):
+                raise Exception(f"File {name} failed to process")
+        pending = {n for n in pending if states[n] == "PROCESSING"}
+        if pending:
+            print(".", end="", flush=True)
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+    print("...all files ready")
+
+def get_start_time_from_transcript(transcript_path):
+    """Parses transcript for first timestamp (memoized on path, mtime and size)."""
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Extract data from JSON
-        final_score = data.get('scoring', {}).get('final_weighted_score', 0)
-        cat_avg = data.get('scoring', {}).get('averages', {})
-        cat_scores = {
-            'Setup': cat_avg.get('setup', 0),
-            'Attitude': cat_avg.get('attitude', 0),
-            'Preparation': cat_avg.get('preparation', 0),
-            'Curriculum': cat_avg.get('curriculum', 0),
-            'Teaching': cat_avg.get('teaching', 0)
-        }
+        st = os.stat(transcript_path)
+    except OSError as e:
+        print(f"Error parsing transcript: {e}")
+        return DEFAULT_START_TIME
+    return _get_start_time_cached(transcript_path, st.st_mtime, st.st_size)
 
-        # Score-based styling
-        score_color = "#10b981" if final_score >= 90 else "#f59e0b" if final_score >= 70 else "#ef4444"
-        perf_label = "EXCELLENT" if final_score >= 90 else "GOOD" if final_score >= 70 else "NEEDS IMPROVEMENT"
-        
-        # Progress circle math
-        dash_offset = 283 - (final_score / 100 * 283)
+@functools.lru_cache(maxsize=64)
+def _get_start_time_cached(transcript_path, mtime, size):
+    print(f"Parsing transcript for start time: {transcript_path}")
+    if size == 0:
+        return DEFAULT_START_TIME
+    try:
+        with open(transcript_path, 'rb') as f:
+            # mmap so only the pages up to the first match are actually read
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # Try VTT format first: 00:13:17.540 --> 00:13:18.659
+                match = TRANSCRIPT_TIMESTAMP_RE.search(mm)
+                if match:
+                    start_time = match.group(1).decode('ascii')
+                    print(f"Found start time: {start_time}")
+                    return start_time
+    except Exception as e:
+        print(f"Error parsing transcript: {e}")
+    return DEFAULT_START_TIME
 
-        # Helper to render lists
-        def render_feedback(items, css_class):
-            html = ""
-            for item in items:
-                cat = item.get('category', '?')
-                sub = item.get('subcategory', 'General')
-                text = item.get('text', '')
-                cite = item.get('cite', '')
-                time = item.get('timestamp', '')
-                html += f'<div class="feedback-box {css_class}"><strong>[{cat}] {sub}:</strong><p>{text}</p>'
-                if cite:
-                    html += f'<small class="cite">{cite}</small>'
-                if time:
-                    html += f'<small class="timestamp">⏱️ {time}</small>'
-                html += '</div>'
-            return html
+def _read_container_duration(video_path):
+    """Reads duration from the container header in-process (PyAV, then pymediainfo).
 
-        def render_flags(items):
-            html = ""
-            for item in items:
-                level = item.get('level', 'Yellow')
-                # Determine class based on level
-                css_class = "f-box-red" if "Red" in level else "f-box-yellow"
-                sub = item.get('subcategory', '')
-                reason = item.get('reason', '')
-                cite = item.get('cite', '')
-                time = item.get('timestamp', '')
-                html += f'<div class="feedback-box {css_class}">🚩 <strong>{level} Flag: {sub}</strong><p>{reason}</p>'
-                if cite:
-                    html += f'<small class="cite">{cite}</small>'
-                if time:
-                    html += f'<small class="timestamp">⏱️ {time}</small>'
-                html += '</div>'
-            return html
+    Returns None when neither library is installed or the header has no duration.
+    """
+    try:
+        import av  # type: ignore
 
-        html_content = f"""<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>iSchool | Quality Audit Report</title>
-    <link href="https://fonts.googleapis.com/css2?family=Outfit:wght@300;400;600;700&display=swap" rel="stylesheet">
-    <style>
-        :root {{
-            --primary: #4f46e5;
-            --primary-dark: #3730a3;
-            --success: #10b981;
-            --warning: #f59e0b;
-            --danger: #ef4444;
-            --text-main: #1f2937;
-            --text-muted: #6b7280;
-            --bg-body: #f9fafb;
-            --bg-card: #ffffff;
-            --score-color: {score_color};
-        }}
+        with av.open(video_path) as container:
+            if container.duration:
+                return float(container.duration) / av.time_base
+    except Exception:
+        pass
+    try:
+        from pymediainfo import MediaInfo  # type: ignore
 
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{ 
-            font-family: 'Outfit', sans-serif; 
-            background-color: var(--bg-body); 
-            color: var(--text-main); 
-            line-height: 1.6;
-            overflow-x: hidden;
-        }}
+        for track in MediaInfo.parse(video_path).tracks:
+            if track.track_type == "General" and track.duration:
+                return float(track.duration) / 1000.0
+    except Exception:
+        pass
+    return None
 
-        /* Dynamic Background */
-        body::before {{
-            content: '';
-            position: fixed;
-            top: 0; left: 0; width: 100%; height: 350px;
-            background: linear-gradient(135deg, var(--primary-dark) 0%, #7c3aed 100%);
-            z-index: -1;
-            clip-path: polygon(0 0, 100% 0, 100% 80%, 0 100%);
-        }}
+@functools.lru_cache(maxsize=32)
+def _get_video_duration_cached(video_path, mtime_ns, size):
+    abs_path = os.path.abspath(video_path)
+    cache = _load_json_cache(VIDEO_METADATA_CACHE_PATH)
+    entry = cache.get(abs_path) or {}
+    if entry.get("mtime_ns") == mtime_ns and entry.get("size") == size and entry.get("duration"):
+        return entry["duration"]
+    duration = _read_container_duration(video_path) or _get_video_duration_ffprobe(video_path)
+    if duration:
+        # One entry per path, so a re-recorded video replaces its stale entry
+        cache[abs_path] = {"mtime_ns": mtime_ns, "size": size, "duration": duration}
+        _save_json_cache(VIDEO_METADATA_CACHE_PATH, cache)
+    return duration
 
-        .wrapper {{ max-width: 1100px; margin: 40px auto; padding: 0 20px; }}
+def get_video_duration(video_path):
+    """Gets video duration in seconds (disk-cached), from the container header if possible, else ffprobe."""
+    try:
+        st = os.stat(video_path)
+    except OSError as e:
+        print(f"Error getting duration: {e}")
+        return 0
+    return _get_video_duration_cached(video_path, st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=8)
+def _probe_video(video_path, mtime):
+    """Runs a single ffprobe over the container and streams; returns the parsed JSON or None."""
+    ffprobe_exe = _resolve_ffprobe_exe(_resolve_ffmpeg_exe())
+    if not ffprobe_exe:
+        print("Error probing video: ffprobe not found")
+        return None
+    cmd = [
+        ffprobe_exe,
+        "-v", "error",
+        "-print_format", "json",
+        "-show_format",
+        "-show_streams",
+        "-select_streams", "v:0",
+        video_path
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return _json_loads(result.stdout)
+    except Exception as e:
+        print(f"Error probing video: {e}")
+        return None
 
-        /* Glassmorphic Header */
-        header {{
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            padding: 30px;
-            background: rgba(255, 255, 255, 0.1);
-            backdrop-filter: blur(10px);
-            border-radius: 24px;
-            border: 1px solid rgba(255, 255, 255, 0.2);
-            color: white;
-            margin-bottom: 30px;
-            box-shadow: 0 10px 30px rgba(0,0,0,0.1);
-        }}
+def _get_video_duration_ffprobe(video_path):
+    """Gets video duration in seconds from the cached ffprobe result."""
+    info = _probe_video(video_path, os.path.getmtime(video_path)) or {}
+    streams = info.get("streams") or [{}]
+    for duration in (info.get("format", {}).get("duration"), streams[0].get("duration")):
+        try:
+            return float(duration)
+        except (TypeError, ValueError):
+            continue
+    print("Error getting duration: ffprobe reported no duration")
+    return 0
 
-        .logo-box img {{ height: 100px; filter: brightness(0) invert(1); }}
-        .header-info h1 {{ font-size: 1.8rem; font-weight: 700; letter-spacing: -0.5px; }}
-        .header-info p {{ opacity: 0.8; font-weight: 300; }}
+def time_str_to_seconds(time_str):
+    """Converts HH:MM:SS to seconds."""
+    try:
+        h, m, s = map(int, time_str.split(':'))
+        return h * 3600 + m * 60 + s
+    except ValueError:
+        return 0
+
+def _drain_stderr(proc, max_lines=20):
+    """Reads proc.stderr on a daemon thread so ffmpeg never blocks on a full pipe.
+
+    Only the last max_lines lines are kept; the returned function waits for the pipe to
+    close and gives them back as text for error messages.
+    """
+    tail = collections.deque(maxlen=max_lines)
 
-        /* Main Dashboard Layout */
-        .dashboard-grid {{
-            display: block;
-            margin-bottom: 30px;
-        }}
+    def drain():
+        with proc.stderr:
+            for line in proc.stderr:
+                tail.append(line.decode("utf-8", "replace").rstrip())
 
-        .card {{
-            background: var(--bg-card);
-            border-radius: 24px;
-            padding: 30px;
-            box-shadow: 0 4px 25px rgba(0,0,0,0.05);
-            border: 1px solid #f1f5f9;
-        }}
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
 
-        /* Score Card Styling */
-        .score-card {{ 
-            display: flex; 
-            flex-direction: row; 
-            align-items: center; 
-            justify-content: space-around; 
-            margin-bottom: 30px;
-        }}
-        .score-circle {{ position: relative; width: 180px; height: 180px; margin-bottom: 0; }}
-        .score-circle svg {{ transform: rotate(-90deg); width: 100%; height: 100%; }}
-        .score-circle .bg {{ fill: none; stroke: #f1f5f9; stroke-width: 8; }}
-        .score-circle .progress {{ fill: none; stroke: var(--score-color); stroke-width: 10; stroke-linecap: round; transition: 1s ease-out; }}
-        .score-val {{ position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); font-size: 3rem; font-weight: 800; color: var(--score-color); }}
-        .perf-badge {{ padding: 8px 20px; border-radius: 50px; background: var(--score-color); color: white; font-weight: 700; font-size: 0.8rem; letter-spacing: 1px; margin-top: 10px; }}
-        
-        .score-left-pane {{ display: flex; flex-direction: column; align-items: center; }}
+    def result():
+        thread.join()
+        return "\n".join(tail)
 
-        /* Category Breakdown */
-        .cat-list {{ width: 50%; margin-top: 0; }}
-        .cat-item {{ margin-bottom: 18px; }}
-        .cat-head {{ display: flex; justify-content: space-between; margin-bottom: 6px; font-weight: 600; font-size: 0.85rem; color: var(--text-muted); }}
-        .bar-bg {{ height: 8px; background: #f1f5f9; border-radius: 10px; overflow: hidden; }}
-        .bar-fill {{ height: 100%; background: linear-gradient(90deg, var(--primary) 0%, #9333ea 100%); border-radius: 10px; }}
+    return result
 
-        /* Report Content Styling */
-        .report-section {{ background: white; border-radius: 24px; padding: 40px; box-shadow: 0 4px 25px rgba(0,0,0,0.05); border: 1px solid #f1f5f9; }}
-        .report-content {{ font-size: 1.05rem; color: var(--text-main); }}
-        
-        h2 {{ color: var(--primary); font-size: 1.4rem; margin: 35px 0 20px; display: flex; align-items: center; gap: 12px; border-bottom: 2px solid #f1f5f9; padding-bottom: 12px; }}
-        h2:first-child {{ margin-top: 0; }}
-        
-        .feedback-box {{ padding: 18px 22px; border-radius: 16px; margin-bottom: 15px; border-left: 6px solid; transition: transform 0.2s; }}
-        .feedback-box:hover {{ transform: translateX(5px); }}
-        .feedback-box p {{ margin: 8px 0; line-height: 1.5; }}
-        .feedback-box .cite {{ display: block; margin-top: 8px; color: #9ca3af; font-size: 0.85rem; }}
-        .feedback-box .timestamp {{ display: block; margin-top: 4px; color: #9ca3af; font-size: 0.85rem; }}
-        .p-box {{ background: #f0fdf4; border-color: var(--success); color: #065f46; }}
-        .i-box {{ background: #fffbeb; border-color: var(--warning); color: #92400e; }}
-        
-        /* Flag Colors */
-        .f-box-yellow {{ background: #FEFCE8; border-color: #EAB308; color: #713F12; font-weight: 600; }}
-        .f-box-red {{ background: #FEF2F2; border-color: #EF4444; color: #B91C1C; font-weight: 600; }}
+def _run_ffmpeg(cmd):
+    """Runs an ffmpeg command with stdout discarded; returns (returncode, stderr tail)."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr_tail = _drain_stderr(proc)
+    proc.wait()
+    return proc.returncode, stderr_tail()
 
-        /* Professional Tables */
-        .table-container {{ overflow-x: auto; margin: 25px 0; border-radius: 16px; border: 1px solid #f1f5f9; }}
-        table {{ width: 100%; border-collapse: collapse; text-align: left; }}
-        th {{ background: #f8fafc; padding: 16px 20px; color: var(--text-muted); font-weight: 700; text-transform: uppercase; font-size: 0.75rem; letter-spacing: 1px; border-bottom: 2px solid #f1f5f9; }}
-        td {{ padding: 16px 20px; border-bottom: 1px solid #f1f5f9; font-size: 0.95rem; }}
-        tr:last-child td {{ border-bottom: none; }}
-        
-        pre {{ white-space: pre-wrap; font-family: 'Outfit', sans-serif; }}
+def extract_audio(video_path, output_base):
+    """Extracts the audio track; returns (path, mime_type) or None.
 
-        @media (max-width: 900px) {{
-            .dashboard-grid {{ display: block; }}
-            .score-card {{ flex-direction: column; }}
-            .cat-list {{ width: 100%; margin-top: 20px; }}
-            header {{ flex-direction: column; text-align: center; gap: 20px; }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="wrapper">
-        <header>
-            <div class="logo-box">
-                <img src="https://www.webit.network/img/portfolio/ischool/logo.png" alt="iSchool">
-            </div>
-            <div class="header-info">
-                <h1>QUALITY AUDIT REPORT</h1>
-                <p>Forensic Session Analysis Dashboard</p>
-            </div>
-        </header>
+    AAC tracks (the usual in MP4) are stream-copied into an ADTS .aac file with no
+    re-encode. Anything else is encoded to 32 kbps mono Opus, which keeps speech
+    intelligible at a fraction of the MP3 size.
+    """
+    ffmpeg_exe = _resolve_ffmpeg_exe()
+    if not ffmpeg_exe:
+        print(f"[WARNING] ffmpeg not found. Skipping audio extraction.")
+        return None
+    attempts = [
+        (output_base + ".aac", "audio/aac", ["-c:a", "copy", "-f", "adts"]),
+        (output_base + ".ogg", "audio/ogg", ["-c:a", "libopus", "-b:a", "32k", "-ac", "1", "-application", "voip"]),
+    ]
+    for output_path, mime_type, codec_args in attempts:
+        print(f"Extracting audio to {output_path}...")
+        cmd = [ffmpeg_exe, "-hide_banner", "-loglevel", "error", "-i", video_path, "-vn", *codec_args, "-y", output_path]
+        returncode, stderr_tail = _run_ffmpeg(cmd)
+        if returncode == 0:
+            return output_path, mime_type
+        print(f"[WARNING] Audio extraction failed (exit {returncode}): {stderr_tail}")
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+    return None
 
-        <div class="dashboard-grid">
-            <aside class="card score-card">
-                <div class="score-left-pane">
-                    <div class="score-circle">
-                        <svg viewBox="0 0 100 100">
-                            <circle class="bg" cx="50" cy="50" r="45"></circle>
-                            <circle class="progress" cx="50" cy="50" r="45" style="stroke-dasharray: 283; stroke-dashoffset: {dash_offset};"></circle>
-                        </svg>
-                        <div class="score-val">{final_score:.0f}</div>
-                    </div>
-                    <div class="perf-badge">{perf_label}</div>
-                </div>
-                
-                <div class="cat-list">
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Setup</span><span>{cat_scores['Setup']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Setup']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Attitude</span><span>{cat_scores['Attitude']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Attitude']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Preparation</span><span>{cat_scores['Preparation']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Preparation']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Curriculum</span><span>{cat_scores['Curriculum']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Curriculum']/5*100}%"></div></div>
-                    </div>
-                    <div class="cat-item">
-                        <div class="cat-head"><span>Teaching</span><span>{cat_scores['Teaching']}/5</span></div>
-                        <div class="bar-bg"><div class="bar-fill" style="width: {cat_scores['Teaching']/5*100}%"></div></div>
-                    </div>
-                </div>
-            </aside>
+def _frame_path(frames_dir, index):
+    return os.path.join(frames_dir, f"frame_{index:03d}.jpg")
 
-            <main class="report-section">
-                <div class="report-content">
-                    <h2>📋 Session Information</h2>
-                    <div class="feedback-box p-box">
-                        <strong>Tutor:</strong> {data.get('meta', {}).get('tutor_id', 'N/A')}<br>
-                        <strong>Date:</strong> {data.get('meta', {}).get('session_date', 'N/A')}<br>
-                        <strong>Summary:</strong> {data.get('meta', {}).get('session_summary', 'N/A')}
-                    </div>
+def _iter_jpeg_frames(stream, chunk_size=1 << 16):
+    """Splits a concatenated JPEG stream (ffmpeg image2pipe) into per-frame byte strings.
 
-                    <h2> Audit Summary</h2>
-                    <p>{data.get('meta', {}).get('session_summary', 'Analysis completed successfully.')}</p>
+    Entropy-coded JPEG data byte-stuffs 0xFF, so the first EOI marker after an SOI
+    ends the frame.
+    """
+    buf = bytearray()
+    scan_from = 0
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            return
+        buf += chunk
+        while True:
+            start = buf.find(JPEG_SOI)
+            if start < 0:
+                break
+            end = buf.find(JPEG_EOI, max(start + 2, scan_from))
+            if end < 0:
+                # Resume the EOI search where it stopped (minus one byte for a split marker)
+                scan_from = len(buf) - 1
+                break
+            end += 2
+            yield bytes(buf[start:end])
+            del buf[:end]
+            scan_from = 0
 
-                    <h2>✅ Positive Highlights</h2>
-                    {render_feedback(data.get('positive_feedback', []), 'p-box')}
+def _max_keyframe_gap(video_path, start_seconds):
+    """Largest gap (seconds) between keyframes in the KEYFRAME_PROBE_SEC after start_seconds.
 
-                    <h2>⚠️ Improvement Points</h2>
-                    {render_feedback(data.get('areas_for_improvement', []), 'i-box')}
+    Reads packet flags only (demux, no decode). Returns None if ffprobe is unavailable or
+    fewer than two keyframes are found.
+    """
+    ffprobe_exe = _resolve_ffprobe_exe(_resolve_ffmpeg_exe())
+    if not ffprobe_exe:
+        return None
+    cmd = [
+        ffprobe_exe,
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-read_intervals", f"{start_seconds}%+{KEYFRAME_PROBE_SEC}",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        video_path
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True)
+    except Exception:
+        return None
+    times = []
+    for line in result.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            times.append(float(pts))
+    if len(times) < 2:
+        return None
+    times.sort()
+    return max(b - a for a, b in zip(times, times[1:]))
 
-                    <h2>🚩 Compliance Violations</h2>
-                    {render_flags(data.get('flags', []))}
+def get_frame_timeline(video_path, start_time):
+    """Returns (start_seconds, duration, frame_interval, frame_count) for frame extraction.
 
-                    <h2>🎯 Recommended Actions</h2>
-                    <ul>
-                        {"".join([f"<li>{x}</li>" for x in data.get('action_plan', [])])}
-                    </ul>
-                </div>
-            </main>
-        </div>
-    </div>
-</body>
-</html>"""
-        
-        with open(html_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        print(f"[SUCCESS] Premium Dashboard HTML Report created: {html_path}")
-    except Exception as e:
-        print(f"Error creating HTML from JSON: {e}")
-        import traceback
-        traceback.print_exc()
+    frame_interval is FRAME_EXTRACTION_INTERVAL times the stride that spreads at most
+    TARGET_FRAME_COUNT frames over the clip, so ffmpeg emits only the frames that are
+    uploaded; frame_count is how many it emits.
+    """
+    start_seconds = time_str_to_seconds(start_time)
+    duration = get_video_duration(video_path)
+    
+    if duration == 0:
+        print("Could not determine duration, using default range...")
+        duration = start_seconds + 3600 # Default to 1 hour if unknown
 
-# ============================================================================
-# RAG ANALYSIS LOGIC
-# ============================================================================
+    expected_frames = max(0, math.ceil((duration - start_seconds) / FRAME_EXTRACTION_INTERVAL))
+    step = expected_frames // TARGET_FRAME_COUNT if expected_frames > TARGET_FRAME_COUNT else 1
+    frame_count = min(TARGET_FRAME_COUNT, math.ceil(expected_frames / step))
+    return start_seconds, duration, FRAME_EXTRACTION_INTERVAL * step, frame_count
 
-def recalculate_score(json_text):
-    """Recalculates score from JSON data."""
+def _iter_frames_ffmpeg(video_path, seek_seconds, frame_interval, count):
+    """Yields JPEG bytes for count frames, one every frame_interval seconds from seek_seconds."""
+    ffmpeg_exe = _resolve_ffmpeg_exe()
+    if not ffmpeg_exe:
+        print("[WARNING] ffmpeg not found. Skipping frame extraction.")
+        return
+    
+    # One demuxer/decoder for the whole clip instead of one ffmpeg per frame.
+    # -ss before -i seeks the input once; the fps filter then emits one frame per interval
+    # and -frames:v stops decoding once the last sampled frame is out.
+    cmd = [ffmpeg_exe, "-hide_banner", "-loglevel", "error"]
+    # With keyframes well inside the sampling interval, decode keyframes only: every
+    # sampled frame is then at most one keyframe gap off. Sparse or irregular keyframes
+    # (long-GOP screen recordings) keep full decoding so frames are not duplicated.
+    keyframe_gap = _max_keyframe_gap(video_path, seek_seconds)
+    if keyframe_gap is not None and keyframe_gap <= frame_interval / 4:
+        print(f"Decoding keyframes only (max keyframe gap {keyframe_gap:.1f}s)")
+        cmd += ["-skip_frame", "nokey"]
+    if seek_seconds > 0:
+        cmd += ["-ss", str(seek_seconds)]
+    cmd += [
+        "-i", video_path,
+        "-vf", f"fps=1/{frame_interval},scale={FRAME_WIDTH}:-1",
+        "-frames:v", str(count),
+        "-q:v", str(FRAME_QUALITY),
+        "-f", "image2pipe",
+        "-c:v", "mjpeg",
+        "-"
+    ]
+    # Decode on the GPU when the build has an accelerator; frames are downloaded for the
+    # CPU scale filter and mjpeg encode. A failed hwaccel init is retried in software.
+    attempts = [[]]
+    if _ffmpeg_hwaccels(ffmpeg_exe):
+        attempts.insert(0, ["-hwaccel", "auto"])
+    emitted = 0
+    for hwaccel_args in attempts:
+        proc = subprocess.Popen(cmd[:1] + hwaccel_args + cmd[1:], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr_tail = _drain_stderr(proc)
+        with proc.stdout:
+            for data in _iter_jpeg_frames(proc.stdout):
+                emitted += 1
+                yield data
+        proc.wait()
+        if proc.returncode == 0 or emitted:
+            break
+        if hwaccel_args:
+            print(f"[WARNING] Hardware-accelerated decoding failed; retrying in software: {stderr_tail()}")
+    if proc.returncode != 0:
+        print(f"[WARNING] Frame extraction exited with code {proc.returncode} after {emitted} frame(s): {stderr_tail()}")
+
+def _iter_frames_pyav(video_path, seek_seconds, frame_interval, count):
+    """Same samples as _iter_frames_ffmpeg, decoded in-process with PyAV (no ffmpeg spawn).
+
+    Each sample is a keyframe seek followed by decoding up to its timestamp, so at most
+    one GOP is decoded per frame whatever the keyframe spacing. Returns None when PyAV or
+    Pillow (used for the JPEG encode) is not installed.
+    """
     try:
-        data = json.loads(json_text)
-        if "scoring" in data:
-            scoring = data["scoring"]
-            weights = {"setup": 0.25, "attitude": 0.20, "preparation": 0.15, "curriculum": 0.15, "teaching": 0.25}
-            total_score = 0
-            new_averages = {}
-            
-            for cat, weight in weights.items():
-                if cat in scoring and isinstance(scoring[cat], list):
-                    ratings = [float(x.get("rating", 0)) for x in scoring[cat] if "rating" in x]
-                    avg = sum(ratings) / len(ratings) if ratings else 0
-                    new_averages[cat] = round(avg, 1)
-                    total_score += (avg / 5) * 100 * weight
-            
-            if "averages" not in scoring: scoring["averages"] = {}
-            scoring["averages"].update(new_averages)
-            scoring["final_weighted_score"] = round(total_score, 1)
-            return json.dumps(data, indent=2), data
-        return json_text, {}
-    except Exception as e:
-        print(f"[WARNING] Score recalculation failed: {e}")
-        return json_text, {}
+        import av  # type: ignore
+        import PIL.Image  # type: ignore  # noqa: F401  (VideoFrame.to_image needs Pillow)
+    except ImportError:
+        return None
 
-def perform_rag_analysis(video_path, output_report_path, transcript_path=None):
-    frames_dir = None
-    uploaded_files = []
+    def frames():
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            for i in range(count):
+                target = seek_seconds + i * frame_interval
+                # Seeks backward to the keyframe at or before target
+                container.seek(int(target / stream.time_base), stream=stream)
+                for frame in container.decode(stream):
+                    if frame.time is not None and frame.time >= target:
+                        break
+                else:
+                    return  # past the end of the video
+                height = max(2, round(frame.height * FRAME_WIDTH / frame.width / 2) * 2)
+                buf = io.BytesIO()
+                frame.reformat(width=FRAME_WIDTH, height=height).to_image().save(buf, "JPEG", quality=FRAME_JPEG_QUALITY)
+                yield buf.getvalue()
+
+    return frames()
+
+def _frame_index(path):
+    """Sort key for frame paths: the integer frame index from the filename."""
+    match = FRAME_INDEX_RE.search(path)
+    return int(match.group(1)) if match else -1
+
+def extract_resources(video_path, start_time, frame_queue=None, force=False):
+    """Extracts the sampled frames with a single ffmpeg pass using the fps filter.
+
+    ffmpeg streams JPEGs over stdout (image2pipe). If frame_queue is given, each frame is
+    put on it as a (path, data) tuple as soon as ffmpeg emits it, followed by None once
+    extraction ends (always, even on failure). data is the in-memory JPEG so uploads skip
+    the disk read; frames already on disk are queued with data=None. Frames are still
+    written to the frames dir as a cache, and a partial cache is resumed rather than
+    re-extracted unless force is set.
+    """
+    print("--- Extracting Resources (Single Pass) ---")
+    
+    base_dir = os.path.dirname(video_path)
+    frames_dir = os.path.join(base_dir, TEMP_FRAMES_DIRNAME)
+    
     try:
-        # 1. SETUP & EXTRACTION
-        if transcript_path is None:
-            transcript_path = TRANSCRIPT_PATH
-        start_time = DEFAULT_START_TIME
-        if os.path.exists(transcript_path):
-            start_time = get_start_time_from_transcript(transcript_path)
-            
-        frames_dir = extract_resources(video_path, start_time)
+        start_seconds, duration, frame_interval, frame_count = get_frame_timeline(video_path, start_time)
+        resume_from = 0
+        # Check if frames already exist
+        if os.path.exists(frames_dir):
+            # scandir gets the file type from readdir, no per-entry stat
+            with os.scandir(frames_dir) as entries:
+                # Numeric order (not lexical) so frame_1000 sorts after frame_999
+                existing_frames = sorted(
+                    (e.path for e in entries if e.name.endswith('.jpg') and e.is_file()),
+                    key=_frame_index,
+                )
+            if existing_frames and len(existing_frames) >= frame_count:
+                print(f"Frames already exist in {frames_dir}. Skipping extraction.")
+                if frame_queue is not None:
+                    for frame in existing_frames:
+                        frame_queue.put((frame, None))
+                return frames_dir
+            elif force:
+                print("Found partial frames, re-extracting (forced)...")
+                shutil.rmtree(frames_dir)
+                os.makedirs(frames_dir)
+            else:
+                # Keep the contiguous prefix; redo its last frame in case it was cut short
+                while os.path.exists(_frame_path(frames_dir, resume_from)):
+                    resume_from += 1
+                resume_from = max(0, resume_from - 1)
+                kept = {_frame_path(frames_dir, i) for i in range(resume_from)}
+                for frame in existing_frames:
+                    if frame not in kept:
+                        os.remove(frame)
+                print(f"Found partial frames, resuming from frame {resume_from}...")
+        else:
+            os.makedirs(frames_dir)
+        
+        if frame_queue is not None:
+            for i in range(resume_from):
+                frame_queue.put((_frame_path(frames_dir, i), None))
+        
+        print(f"Video Duration: {duration:.2f}s, Start Time: {start_seconds}s")
+        if resume_from >= frame_count:
+            print("No frames left to extract after the start time.")
+            return frames_dir
+        print(f"Extracting ~{frame_count - resume_from} frames in one pass (1 every {frame_interval}s)...")
+        
+        emitted = resume_from
+
+        def store(frames):
+            nonlocal emitted
+            for data in frames:
+                frame_path = _frame_path(frames_dir, emitted)
+                # Uploads read the in-memory bytes, so hand them over before the disk write;
+                # the file only serves as the cache for reruns and resume
+                if frame_queue is not None:
+                    frame_queue.put((frame_path, data))
+                with open(frame_path, 'wb') as f:
+                    f.write(data)
+                emitted += 1
+                if emitted % 10 == 0:
+                    print(f"... {emitted}/~{frame_count} frames extracted")
+
+        frames = _iter_frames_pyav(video_path, start_seconds + resume_from * frame_interval, frame_interval, frame_count - resume_from)
+        if frames is not None:
+            try:
+                store(frames)
+            except Exception as e:
+                print(f"[WARNING] PyAV decoding failed after {emitted} frame(s) ({e}); continuing with ffmpeg")
+                frames = None
+        if frames is None:
+            store(_iter_frames_ffmpeg(video_path, start_seconds + emitted * frame_interval, frame_interval, frame_count - emitted))
+        print(f"Extracted {emitted} frames")
+                
+        return frames_dir
+    finally:
+        if frame_queue is not None:
+            frame_queue.put(None)
+
+def _dhash(image):
+    """64-bit difference hash of an image (path or file object); None without Pillow."""
+    try:
+        from PIL import Image  # type: ignore
+    except ImportError:
+        return None
+    with Image.open(image) as img:
+        # JPEG draft mode decodes straight to grayscale at 1/8 scale (DCT-domain), so the
+        # full-size RGB frame is never materialized; no-op for other formats
+        img.draft("L", (18, 16))
+        pixels = list(img.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return bits
+
+def iter_queued_frames(frame_queue, expected=None):
+    """Yields (path, mime_type, data) for each queued frame until the None sentinel.
+
+    ffmpeg already samples the frames (see get_frame_timeline). A frame whose dHash is
+    within FRAME_DEDUP_MAX_DISTANCE bits of an already yielded frame (same slide or screen)
+    is skipped, unless skipping could leave fewer than FRAME_DEDUP_MIN_FRAMES of the
+    expected frames. Without Pillow every frame is yielded.
+    """
+    kept_hashes = []
+    seen = skipped = 0
+    floor = FRAME_DEDUP_MIN_FRAMES if expected is None else min(FRAME_DEDUP_MIN_FRAMES, expected)
+    for path, data in iter(frame_queue.get, None):
+        seen += 1
+        try:
+            bits = _dhash(io.BytesIO(data) if data is not None else path)
+        except Exception:
+            bits = None
+        if bits is not None:
+            remaining = max(0, expected - seen) if expected is not None else 0
+            duplicate = any((bits ^ kept).bit_count() <= FRAME_DEDUP_MAX_DISTANCE for kept in kept_hashes)
+            if duplicate and len(kept_hashes) + remaining >= floor:
+                skipped += 1
+                continue
+            kept_hashes.append(bits)
+        yield (path, "image/jpeg", data)
+    if skipped:
+        print(f"Skipped {skipped} near-duplicate frame(s)")
 
-        # Extract Audio
-        audio_path = "temp_audio.mp3"
-        extract_audio(video_path, audio_path)
+def iter_with_deferred(stream, deferred):
+    """Yields the items of stream, interleaving the result of each deferred future once it is done.
 
-        # 2. UPLOAD EVERYTHING
-        print("\n--- Uploading Resources (Sequential) ---")
-        files_to_upload = []
+    deferred futures resolve to an upload item or None (skipped); any still pending
+    when stream ends are waited for. A slow producer such as audio extraction thus
+    starts uploading as soon as it finishes instead of after every streamed frame.
+    """
+    pending = list(deferred)
+
+    def drain(block):
+        for future in list(pending):
+            if block or future.done():
+                pending.remove(future)
+                item = future.result()
+                if item is not None:
+                    yield item
+
+    for item in stream:
+        yield from drain(False)
+        yield item
+    yield from drain(True)
+
+def should_rerun_analysis(data):
+    """
+    Checks if analysis should be re-run due to quality concerns:
+    1. Any subcategory rating being 0 (indicates incomplete evaluation)
+    2. Final weighted score being less than 68% (below acceptable threshold)
+    
+    This acts as a quality gate to ensure all sessions are properly evaluated.
+    If either condition is triggered, the analysis is re-run to get a more accurate assessment.
+    
+    Args:
+        data (dict): Parsed JSON data from the initial analysis
+        
+    Returns:
+        tuple: (should_rerun: bool, reason: str)
+        
+    Example:
+        >>> data = {"scoring": {"final_weighted_score": 65, "setup": [{"rating": 0}]}}
+        >>> should_rerun, reason = should_rerun_analysis(data)
+        >>> should_rerun
+        True
+        >>> reason
+        "Category 'setup' subcategory 'Unknown' has rating 0"
+    """
+    try:
+        scoring = data.get("scoring", {})
+        final_score = scoring.get("final_weighted_score", 0)
+        
+        # Check if score is below 68%
+        if final_score < 68:
+            return True, f"Score {final_score} is below 68% threshold"
+        
+        # Check if any subcategory has rating 0 (stops at the first one)
+        unrated = next(
+            (
+                (cat, item.get("subcategory", "Unknown"))
+                for cat in SCORE_CATEGORIES
+                if isinstance(scoring.get(cat), list)
+                for item in scoring[cat]
+                if item.get("rating", 0) == 0
+            ),
+            None,
+        )
+        if unrated:
+            return True, "Category '{}' subcategory '{}' has rating 0".format(*unrated)
+        
+        return False, "Analysis meets quality threshold"
+    except Exception as e:
+        return False, f"Error checking analysis: {e}"
+
+def validate_json_response(json_text):
+    """
+    Validates that the JSON response is complete and properly structured.
+    Returns (is_valid, data_or_error_msg)
+    
+    A valid response must have:
+    1. Valid JSON syntax
+    2. Non-empty object (not {})
+    3. Required top-level keys: meta, scoring
+    4. Scoring section with at least one category
+    """
+    try:
+        # Check for empty or whitespace-only response
+        text = json_text.strip() if json_text else ""
+        if not text:
+            return False, "Empty response received"
         
-        if os.path.exists(audio_path):
-            files_to_upload.append((audio_path, "audio/mp3"))
+        # Cheap structural checks so truncated or keyless output is rejected without a parse
+        if not (text.startswith("{") and text.endswith("}")):
+            return False, "Truncated or non-object JSON response"
+        missing_keys = [k for k in ("meta", "scoring") if f'"{k}"' not in text]
+        if missing_keys:
+            return False, f"Missing required keys: {missing_keys}"
         
-        for pdf in PDF_REFERENCE_FILES:
-            if os.path.exists(pdf):
-                files_to_upload.append((pdf, "application/pdf"))
+        # Parse JSON (callers reuse the parsed data, so this is the only parse)
+        data = _json_loads(text)
         
-        if os.path.exists(transcript_path):
-            files_to_upload.append((transcript_path, "text/plain"))
-            
-        all_frames = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
-        if len(all_frames) > TARGET_FRAME_COUNT:
-            step = len(all_frames) // TARGET_FRAME_COUNT
-            selected_frames = [all_frames[i * step] for i in range(TARGET_FRAME_COUNT)]
-        else:
-            selected_frames = all_frames
+        # Check for empty object
+        if not data or data == {}:
+            return False, "Empty JSON object received ({})"
         
-        for frame in selected_frames:
-            files_to_upload.append((frame, "image/jpeg"))
-            
-        uploaded_files = upload_files_parallel(files_to_upload)
+        # Check required top-level keys
+        required_keys = ["meta", "scoring"]
+        missing_keys = [k for k in required_keys if k not in data]
+        if missing_keys:
+            return False, f"Missing required keys: {missing_keys}"
         
-        # Categorize resources - sort by original path for deterministic order
-        # uploaded_files is now a list of (file_object, original_path) tuples
-        pdf_objs = sorted([t for t in uploaded_files if "pdf" in t[0].mime_type], key=lambda t: t[1])
-        transcript_objs = sorted([t for t in uploaded_files if "text" in t[0].mime_type], key=lambda t: t[1])
-        frame_objs = sorted([t for t in uploaded_files if "image" in t[0].mime_type], key=lambda t: t[1])
-        audio_objs = sorted([t for t in uploaded_files if "audio" in t[0].mime_type], key=lambda t: t[1])
+        # Check scoring has content
+        scoring = data.get("scoring", {})
+        if not scoring:
+            return False, "Scoring section is empty"
         
-        print(f"Resources: {len(pdf_objs)} PDFs, {len(transcript_objs)} Transcripts, {len(frame_objs)} Frames, {len(audio_objs)} Audio")
-        wait_for_files_active(uploaded_files)
-
-        # 3. INITIALIZE MODEL (Optimized for Gemini 3 Flash)
-        print("\n--- Initializing Knowledge Base Chat ---")
+        # Check at least one category has ratings
+        has_ratings = any(isinstance(scoring.get(cat), list) and scoring[cat] for cat in SCORE_CATEGORIES)
+        if not has_ratings:
+            return False, "No category ratings found in scoring"
         
-        system_instr = """You are the **Lead Quality Auditor** and **Senior Quality Compliance Auditor** for iSchool.
-Your task is to conduct a **Forensic Quality Review** of online coding sessions.
-
-**AUDIT PROTOCOL:**
-1. **INGEST RULES:** Analyze the provided Quality Reference PDFs.
-2. **ANALYZE SESSION:** Cross-reference Audio (MP3), Frames (JPG), and Transcript (TXT) against the rules.
-    - listen for MP3 from uploaded file between tutor and student.
-    - check frames from uploaded files.
-    - read zoom transcript from uploaded file.
-    **AUDIO VS. TRANSCRIPT RULE:**
-    You possess both the Recording (Audio) and the Script (Transcript).
-- The Transcript is for **Timestamping**.
-- The Audio is for **Verification**.
-- IF the transcript says "(silence)" but the audio contains keyboard clicking -> IT IS NOT SILENCE.
-- IF the transcript looks polite but the audio sounds angry -> TRUST THE AUDIO.
-- You must prioritize Audio evidence for all "Attitude" and "Connection" findings.
-3. **STRICT GUIDELINES:**
-    - Be EXHAUSTIVE. List EVERY issue found, no matter how small.
-    - Reference the provided PDFs for rule citations.
-    - Use exact Category keys: S(Setup), A(Attitude), P(Preparation), C(Curriculum), T(Teaching), F(Feedback).
-    - Results must be mathematically verified using the weighted formula.
-**CRITICAL ANTI-HALLUCINATION RULE:**
-Do NOT report ANY issue unless you have SPECIFIC EVIDENCE:
-- For transcript issues: Include an EXACT QUOTE from the transcript.
-- For visual issues: Reference the SPECIFIC FRAME NUMBER or Timestamp.
-- If you cannot cite a specific quote or frame, DO NOT include the issue.
+        return True, data
+    except json.JSONDecodeError as e:
+        return False, f"Invalid JSON syntax: {e}"
+    except Exception as e:
+        return False, f"Validation error: {e}"
 
-**OUTCOME:** Return ONLY a valid JSON object matching the required schema."""
+def compute_median_score(scores):
+    """
+    Computes the median score from a list of scores.
+    The median is more robust to outliers than the mean.
+    """
+    return statistics.median(scores) if scores else 0
 
-        # Model configuration with seed for determinism
-        # NOTE: Gemini 3.0 Flash uses thinking_level or disabled thinking
-        # "minimal" ensures the closest behavior to deterministic output.
-        gen_config_kwargs = dict(
-            temperature=MODEL_TEMPERATURE,
-            top_p=MODEL_TOP_P,
-            top_k=MODEL_TOP_K,
-            candidate_count=1,
-            response_mime_type="application/json",
-            system_instruction=system_instr,
-            seed=args.seed if hasattr(args, 'seed') else DEFAULT_SEED,
-            media_resolution=args.media_resolution if hasattr(args, 'media_resolution') else DEFAULT_MEDIA_RESOLUTION,
-        )
-        
-        # Apply Thinking Config ONLY if thinking_level is passed and supported
-        # For strict determinism, we might prefer NO thinking config (defaults to off)
-        # But if the user wants "minimal" thinking:
-        current_thinking_level = args.thinking_level if hasattr(args, 'thinking_level') else DEFAULT_THINKING_LEVEL
-        if current_thinking_level:
-             # Assuming SDK supports this parameter. If not, remove it.
-             # Based on research, Gemini 3 uses 'thinking_level' but let's be careful.
-             pass 
-             # For now, let's DISABLE active thinking injection to ensure max stability unless explicitly requested
-             # gen_config_kwargs["thinking_config"] = ... 
+def select_best_analysis_by_median(analyses, serialize=False):
+    """
+    Given multiple analysis results, selects the one closest to the median score.
+    This ensures we pick a representative analysis, not an outlier. The selected
+    analysis keeps its own final_weighted_score (the one its ratings add up to); the
+    median is only recorded in scoring._consistency_info.
+    
+    Args:
+        analyses: List of (json_text, data_dict, score) tuples
+        serialize: Re-serialize the updated data to JSON text; otherwise best_json_text
+            is None when the data was updated (callers that only need best_data skip the encode)
         
-        # Enable Google Search (Community Search) if requested
-        if hasattr(args, 'use_google_search') and args.use_google_search:
-            print("--- Googling Search (Community Search) ENABLED ---")
-            gen_config_kwargs["tools"] = [types.Tool(google_search=types.GoogleSearch())]
-            
-        if args.max_output_tokens is not None:
-            gen_config_kwargs["max_output_tokens"] = args.max_output_tokens
+    Returns:
+        tuple: (best_json_text, best_data, median_score, all_scores, variance)
+    """
+    if not analyses:
+        return None, {}, 0, [], 0
+    
+    scores = [a[2] for a in analyses]
+    median = compute_median_score(scores)
+    
+    # Calculate variance
+    variance = max(scores) - min(scores) if len(scores) > 1 else 0
+    
+    # Find analysis closest to median (first one wins on ties)
+    best_idx = min(range(len(scores)), key=lambda i: abs(scores[i] - median))
+    
+    best_json, best_data, best_score = analyses[best_idx]
+    
+    if "scoring" in best_data:
+        best_data["scoring"]["_consistency_info"] = {
+            "individual_scores": scores,
+            "median_score": round(median, 1),
+            "selected_score": best_score,
+            "score_rule": "final_weighted_score is the selected run's own score (the run closest to the median)",
+            "score_variance": round(variance, 1),
+            "runs": len(scores),
+            "reliable": variance <= SCORE_VARIANCE_THRESHOLD
+        }
+        best_json = _json_dumps_compact(best_data) if serialize else None
+    
+    return best_json, best_data, median, scores, variance
 
-        generation_config = types.GenerateContentConfig(**gen_config_kwargs)
+def compare_and_keep_best(data1, data2):
+    """
+    Compares two analysis JSON objects and returns the one with the higher score.
+    This function is used when analysis is re-run to select the best result.
+    
+    Args:
+        data1 (dict): First analysis result
+        data2 (dict): Second (retry) analysis result
         
-        # 4. STEP 1: INITIAL GENERATION
-        print("\n--- Step 1: Generating Initial Analysis JSON ---")
-        combined_prompt = f"""
-Analyze the session files provided (Guidelines, Transcript, Frames, Audio).
-Generate a comprehensive Quality Audit Report in JSON format.
+    Returns:
+        tuple: (best_data: dict, score1: float, score2: float, selected: str)
+               where selected is either "First" or "Second"
+               
+    Example:
+        >>> data1 = {"scoring": {"final_weighted_score": 72}}
+        >>> data2 = {"scoring": {"final_weighted_score": 75}}
+        >>> best, s1, s2, sel = compare_and_keep_best(data1, data2)
+        >>> sel
+        "Second"
+        >>> best == data2
+        True
+    """
+    try:
+        score1 = data1.get("scoring", {}).get("final_weighted_score", 0)
+        score2 = data2.get("scoring", {}).get("final_weighted_score", 0)
+        
+        if score1 >= score2:
+            return data1, score1, score2, "First"
+        else:
+            return data2, score1, score2, "Second"
+    except Exception as e:
+        print(f"Error comparing analyses: {e}")
+        return data1, 0, 0, "First (default)"
 
-**CRITICAL: SESSION START TIME**
-The session officially starts at timestamp **{start_time}**.
-**IGNORE** all audio, text, or visual events before **{start_time}**.
-Any "silence" or "waiting" before {start_time} is PRE-SESSION WAITING time and is NOT a violation.
+@functools.lru_cache(maxsize=128)
+def _score_styling(final_score):
+    """Returns (score_color, perf_label, dash_offset) for a final score."""
+    score_color = "#10b981" if final_score >= 90 else "#f59e0b" if final_score >= 70 else "#ef4444"
+    perf_label = "EXCELLENT" if final_score >= 90 else "GOOD" if final_score >= 70 else "NEEDS IMPROVEMENT"
+    # Progress circle math
+    dash_offset = 283 - (final_score / 100 * 283)
+    return score_color, perf_label, dash_offset
 
-**REQUIRED SCHEMA:**
-{{
-  "_reasoning_trace": ["Step 1: Analyzed setup...", "Step 2: Found issue X at timestamp...", "Step 3: Verified rule Y..."],
-  "meta": {{"tutor_id": "str", "group_id": "str", "session_date": "str", "session_summary": "str"}},
-  "positive_feedback": [{{"category": "str", "subcategory": "str", "text": "str", "cite": "str", "timestamp": "str"}}],
-  "areas_for_improvement": [{{"category": "str", "subcategory": "str", "text": "str", "cite": "str", "timestamp": "str"}}],
-  "flags": [{{"level": "Yellow/Red", "subcategory": "str", "reason": "str", "cite": "str", "timestamp": "str"}}],
-  "scoring": {{
-    "setup": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
-    "attitude": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
-    "preparation": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
-    "curriculum": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
-    "teaching": [{{"subcategory": "str", "rating": 0, "reason": "str"}}],
-    "averages": {{"setup": 0, "attitude": 0, "preparation": 0, "curriculum": 0, "teaching": 0}},
-    "final_weighted_score": 0
-  }},
-  "action_plan": ["string", "string", "string"]
-}}
+def generate_html_report_from_json(json_path, data=None):
+    """Generates a premium, fixed-style professional HTML report from JSON data.
 
-**RULES:**
-- **CHAIN OF THOUGHT:** You MUST populate the `_reasoning_trace` array FIRST with your step-by-step analysis. This is your "scratchpad" to ensure accuracy.
-- Category Keys: **S** (Setup), **A** (Attitude), **P** (Preparation), **C** (Curriculum), **T** (Teaching), **F** (Feedback).
-- Scoring Logic: 5 (Perfect) down to 1 (Critical). Apply weighted formula: (Setup 25%, Attitude 20%, Prep 15%, Curr 15%, Teach 25%).
-- Math Verification: Re-calculate category averages and sum them based on weights before outputting the final score.
-- **POSITIVE FEEDBACK:** You MUST include at least **3** specific positive observations in the `positive_feedback` array.
-- language English or Arabic do not put language used in area of improvement.
-- if the find with not storng and clraer evidence, do not include it.
+    Pass data when the report was just written from it: the disk read and the up-to-date
+    check are skipped, and json_path is only used to name the .html.
+    """
+    html_path = os.path.splitext(json_path)[0] + ".html"
+    try:
+        if data is None and os.path.exists(html_path) and os.path.getmtime(html_path) >= os.path.getmtime(json_path):
+            print(f"[SKIP] HTML up to date: {html_path}")
+            return
+    except OSError:
+        pass
+    print(f"\n--- Generating Premium HTML Report: {html_path} ---")
+    try:
+        if data is None:
+            with open(json_path, 'rb') as f:
+                data = _json_loads(f.read())
+        
+        # Extract data from JSON
+        final_score = data.get('scoring', {}).get('final_weighted_score', 0)
+        cat_avg = data.get('scoring', {}).get('averages', {})
+        # (label, score out of 5, bar width %) computed once per category
+        cat_rows = []
+        for label, key in REPORT_CATEGORIES:
+            score = cat_avg.get(key, 0)
+            cat_rows.append((label, score, min(100.0, max(0.0, score / 5 * 100))))
 
----
+        # Score-based styling
+        score_color, perf_label, dash_offset = _score_styling(final_score)
 
-### **PHASE 1: THE AUDIT PROTOCOL (Relaxed Enforcement)**
-Check the session against these specific criteria. If a violation is found, it **MUST** be listed in "areas_for_improvement" or "flags".
-Note the exact timestamp from the transcript where the issue occurs.
+        # Helper to render lists
+        def render_feedback(items, css_class):
+            parts = []
+            for item in items:
+                cat = item.get('category', '?')
+                sub = item.get('subcategory', 'General')
+                text = item.get('text', '')
+                cite = item.get('cite', '')
+                time = item.get('timestamp', '')
+                parts.append(f'<div class="feedback-box {css_class}"><strong>[{cat}] {sub}:</strong><p>{text}</p>')
+                if cite:
+                    parts.append(f'<small class="cite">{cite}</small>')
+                if time:
+                    parts.append(f'<small class="timestamp">⏱️ {time}</small>')
+                parts.append('</div>')
+            return "".join(parts)
 
-**IMPORTANT: 1-HOUR SESSION CONTEXT**
-Do NOT report the following as issues:
-- Brief moments of silence (under 2 min) while student is coding/thinking.
-- Tutor briefly checking slides or materials (under 30 seconds).
-- One or two instances of minor audio lag that don't disrupt flow.
-- the session could be 1 hour and 30 minutes.with the wating time for the student. 
-**1. VISUAL COMPLIANCE (Check Frames)**
-*   **Camera (IGNORE FOR REPORTING):** Do NOT add any comments, improvements, or flags about camera angle, framing, or visibility.
-    - **Specifically, ignore and do not report "S - Camera Quality" findings.**
-*   **Dress Code (IGNORE FOR REPORTING):** Do NOT add any comments, improvements, or flags about the tutor's dress code/appearance.
-    - **Specifically, ignore and do not report "S - Dress Code" findings.**
-*   **Screen Sharing (CRITICAL):**
-    *   During the "Make/Coding" phase, the **STUDENT'S** screen must be shared.
-    *   *Violation:* If the tutor explicitly says "You don't have to share your screen,"for reviweing the homework or implmenting main the project at the end of the session .
-*   **Zoom Tools Usage (MANDATORY CHECK):**
-    *   If the tutor repeatedly uses verbal directions **more than 3 times** like “look above” instead of Zoom annotations (arrow/highlighter), log:
-      **C - Tools and Methodology: Inefficient use of Zoom annotation tools**.
+        def render_flags(items):
+            parts = []
+            for item in items:
+                level = item.get('level', 'Yellow')
+                # Determine class based on level
+                css_class = "f-box-red" if "Red" in level else "f-box-yellow"
+                sub = item.get('subcategory', '')
+                reason = item.get('reason', '')
+                cite = item.get('cite', '')
+                time = item.get('timestamp', '')
+                parts.append(f'<div class="feedback-box {css_class}">🚩 <strong>{level} Flag: {sub}</strong><p>{reason}</p>')
+                if cite:
+                    parts.append(f'<small class="cite">{cite}</small>')
+                if time:
+                    parts.append(f'<small class="timestamp">⏱️ {time}</small>')
+                parts.append('</div>')
+            return "".join(parts)
+
+        meta = data.get('meta', {})
+        category_rows = "\n".join(
+            HTML_CATEGORY_ROW_TEMPLATE.format(label=label, score=score, pct=pct)
+            for label, score, pct in cat_rows
+        )
+        html_content = HTML_REPORT_TEMPLATE.format_map({
+            "score_color": score_color,
+            "dash_offset": dash_offset,
+            "final_score": final_score,
+            "perf_label": perf_label,
+            "category_rows": category_rows,
+            "tutor_id": meta.get('tutor_id', 'N/A'),
+            "session_date": meta.get('session_date', 'N/A'),
+            "session_summary": meta.get('session_summary', 'N/A'),
+            "audit_summary": meta.get('session_summary', 'Analysis completed successfully.'),
+            "positive_html": render_feedback(data.get('positive_feedback', []), 'p-box'),
+            "improvement_html": render_feedback(data.get('areas_for_improvement', []), 'i-box'),
+            "flags_html": render_flags(data.get('flags', [])),
+            "action_items": "".join([f"<li>{x}</li>" for x in data.get('action_plan', [])]),
+        })
+        
+        _write_text_file(html_path, html_content)
+        print(f"[SUCCESS] Premium Dashboard HTML Report created: {html_path}")
+    except Exception as e:
+        print(f"Error creating HTML from JSON: {e}")
+        import traceback
+        traceback.print_exc()
 
-**2. AUDITORY COMPLIANCE (Check Transcript + Audio)**
-*   **Dead Air (Silence):** Flag if silence exceeds **6 minutes** without tutor engagement or check-in. 
-*   **Rapport & Warmth (MANDATORY CHECK):**
-    * If the tutor does NOT smile, greet warmly, or initiate light friendly conversation log:
-      **A - Friendliness: Lack of warm rapport-building at session start**.
-*   **Language:** Arabic is ALLOWED.
-*   **Internet & Audio Stability (MANDATORY CHECK):**
-    - if it is more than 3 time Actively listen for lag, delayed responses, repeated “can you hear me?”, audio cuts, or desync.
-    - If connectivity issues affect flow **for more than 2 minutes** more than 3 times, log:
-      **S - Internet Quality: Internet/audio lags disrupted session flow for more than 3 minutes**.
+# ============================================================================
+# RAG ANALYSIS LOGIC
+# ============================================================================
 
-**3. PREPARATION QUALITY (MANDATORY CHECK):**
-*   **Materials Readiness:**
-    * If slides are disorganized, contain typos, or seem hastily prepared, log:
-      **P - Material Readiness: Materials were not well-organized or prepared in advance**.
-    * If the tutor lacks resources/materials for the session topic, log:
-      **P - Resource Planning: Required materials or setup were missing or not prepared**.
-*   **Lesson Planning & Roadmap:**
-    * If the tutor does not provide a clear lesson plan, roadmap, or learning objectives, log:
-      **P - Lesson Planning: No clear lesson plan or learning objectives communicated**.
-    * If the pacing is erratic (rushing parts, spending too long on others), log:
-      **P - Session Pacing: Poor time management and pacing of lesson content**.
-*   **Technical Setup Verification:**
-    * If the tutor failed to test tools/platforms before the session or has technical issues that could have been prevented, log:
-      **P - Technical Preparation: Technical tools or platforms were not tested/verified beforehand**.
+def recalculate_score(json_text, data=None):
+    """Recalculates score from JSON data (pass data when json_text was already parsed)."""
+    try:
+        if data is None:
+            data = _json_loads(json_text)
+        if "scoring" in data:
+            scoring = data["scoring"]
+            weighted = []
+            new_averages = {}
+            
+            for cat, weight in SCORE_CATEGORY_WEIGHTS.items():
+                if cat in scoring and isinstance(scoring[cat], list):
+                    ratings = [float(x["rating"]) for x in scoring[cat] if "rating" in x]
+                    avg = statistics.fmean(ratings) if ratings else 0
+                    new_averages[cat] = round(avg, 1)
+                    weighted.append(avg * weight)
+            
+            # (avg / 5) * 100 * weight, with the constant factor applied once
+            total_score = math.fsum(weighted) * 20
 
-**4. TEACHING QUALITY (MANDATORY DEEP CHECK):**
-*   **Teaching Mode Balance:**
-    * If teaching is mostly one-directional (explaining without questioning) for >10 minutes, log:
-      **T - Student Engagement: Session was largely lecture-based with limited student interaction**.
-*   **Guided Thinking vs Direct Answers:**
-    * If the tutor provides full solutions, syntax, or logic immediately without prompting the student to think or respond first, log:
-      **T - Teaching Methodology: Over-reliance on direct answers instead of guided discovery**.
-*   **Check-for-Understanding (MANDATORY):**
-    * If the tutor explains a concept without asking the student to confirm understanding, log:
-      **T - Student Engagement: Lack of comprehension-check questions during explanation**.
+            if "averages" not in scoring: scoring["averages"] = {}
+            scoring["averages"].update(new_averages)
+            scoring["final_weighted_score"] = round(total_score, 1)
+            return _json_dumps_compact(data), data
+        return json_text, {}
+    except Exception as e:
+        print(f"[WARNING] Score recalculation failed: {e}")
+        return json_text, {}
 
-**4. PROCEDURAL COMPLIANCE (Check Transcript + Audio)**
-*   **Opening/Closing:** Roadmap explained? Summary provided? Homework assigned?
-*   **Platform:** Correct tool used ?
-*   **Tool Language:** If tools appear in Arabic when English is required, log:
-      **P - Project software & slides: Tool language not set to English as required**.
+def apply_json_patch(document, operations):
+    """Applies RFC 6902 add/remove/replace operations to a deep copy of document.
 
-**5. PROJECT COMPLETION VS EXPLANATION (MANDATORY CHECK):**
-*   **FIRST 50 MINUTES EXEMPTION:** During the first 50 minutes of the session, it is ACCEPTABLE for the tutor to implement examples to demonstrate concepts. This is NOT a violation.
-*   **AFTER 50 MINUTES:** Verify if project was fully implemented by student, partially, or only explained verbally.
-*   If explained only (after 50 min), log:
-    **C - Slides and Project Completion: Project was explained but not implemented by the student during the session**.
-*   If tutor implements while student observes (after 50 min), log:
-    **T - Project Implementation & Activities: Tutor-led implementation limited hands-on student practice**.
+    Raises KeyError, IndexError or ValueError when an operation does not fit the document.
+    """
+    result = copy.deepcopy(document)
+    for operation in operations:
+        tokens = [t.replace("~1", "/").replace("~0", "~") for t in operation["path"].split("/")[1:]]
+        if not tokens:
+            raise ValueError("patching the whole document is not supported")
+        parent = result
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last, op = tokens[-1], operation["op"]
+        if isinstance(parent, list):
+            if op == "add" and last == "-":
+                parent.append(operation["value"])
+                continue
+            index = int(last)
+            if not 0 <= index < len(parent) + (op == "add"):
+                raise IndexError(f"{operation['path']} is out of range")
+            if op == "add":
+                parent.insert(index, operation["value"])
+            elif op == "remove":
+                del parent[index]
+            elif op == "replace":
+                parent[index] = operation["value"]
+            else:
+                raise ValueError(f"unsupported patch op {op!r}")
+        elif op == "add":
+            parent[last] = operation["value"]
+        elif op == "remove":
+            del parent[last]
+        elif op == "replace":
+            if last not in parent:
+                raise KeyError(operation["path"])
+            parent[last] = operation["value"]
+        else:
+            raise ValueError(f"unsupported patch op {op!r}")
+    return result
+
+def _decode_audit_patch(text):
+    """Turns a Step 2 patch response (AUDIT_PATCH_SCHEMA) into RFC 6902 operations."""
+    operations = []
+    for item in _json_loads(text):
+        operation = {"op": item["op"], "path": item["path"]}
+        if item["op"] != "remove":
+            operation["value"] = _json_loads(item["value_json"])
+        operations.append(operation)
+    return operations
+
+def _frame_fingerprint(path):
+    """64-bit difference hash (dHash) of a frame, or its content digest when Pillow is not installed.
+
+    dHash ignores byte-level differences from re-encoding, so frames re-extracted from the
+    same video keep their fingerprint.
+    """
+    bits = _dhash(path)
+    return _file_digest(path) if bits is None else f"{bits:016x}"
 
-**6. CONCEPT ACCURACY & MISCONCEPTIONS (CRITICAL CHECK):**
-*   If the tutor explains a concept incorrectly or in a misleading way, log:
-    **C - Knowledge About Subject: Concept explained inaccurately or misleadingly**.
-*   **Examples include (but are not limited to):**
-    - Incorrect definition of widget roles (e.g., layout vs content widgets)
-    - Misuse or misinterpretation of properties 
-    - Logical inaccuracies 
-### **FINAL COMPLIANCE GATE (REQUIRED)**
-Before producing the final JSON output, explicitly ask yourself:
-“Did I check Setup, Attitude, Preparation, Curriculum, Teaching, and Feedback for at least ONE potential issue each?”
-If any category has zero findings, re-scan audio, frames, and transcript to confirm that the category is genuinely perfect — otherwise add the missing issue.
-if the find with not storng and clraer evidence, do not include it.
+@functools.lru_cache(maxsize=8)
+def _existing_pdfs(pdf_paths):
+    # Path-sorted: uploads keep this order, so the prompt lists them deterministically
+    return tuple(sorted(pdf for pdf in pdf_paths if os.path.exists(pdf)))
 
----
+def reference_pdf_paths():
+    """Returns the reference PDFs that exist (--pdfs, else PDF_REFERENCE_FILES), checked once per set."""
+    return _existing_pdfs(tuple(getattr(args, "pdfs", None) or PDF_REFERENCE_FILES))
 
-### **PHASE 2: JSON GENERATION RULES**
+def resolve_session_paths(session_dir):
+    """Returns (video_path, transcript_path, output_report_path) for a Sessions/<id> folder.
 
-***1. THE "LIST ALL" RULE:**
-*   **DO NOT SUMMARIZE.** You must list **EVERY** single valid area for improvement found.
-*   Check the transcript for timestamps and listen for the audio to validate the findings.
-*   **EVIDENCE FILTERING:** Only include findings with STRONG, CLEAR, and SPECIFIC evidence.
-*   **EVIDENCE LANGUAGE:** Quote the specific evidence exactly as spoken/written in the session, in its original language (Arabic or English). Do NOT translate quotes.
+    transcript_path is "" when the folder has no transcript, so the default one is not used.
+    """
+    session_id = os.path.basename(os.path.normpath(session_dir))
+    videos, transcripts = [], []
+    with os.scandir(session_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.') or not entry.is_file():
+                continue
+            lower_name = name.lower()
+            if lower_name.endswith('.mp4'):
+                videos.append(entry.path)
+            elif lower_name.endswith('.txt') and 'report' not in lower_name:
+                transcripts.append(entry.path)
+    if not videos:
+        raise FileNotFoundError(f"No .mp4 video found in {session_dir}")
+    output_report_path = os.path.join(session_dir, f"Quality_Report_RAG_{session_id}.txt")
+    return sorted(videos)[0], (sorted(transcripts)[0] if transcripts else ""), output_report_path
+
+def session_report_key(video_path, start_time, transcript_path):
+    """Cache key for a session's final report, computable before any upload or model call.
+
+    Covers the transcript bytes, fingerprints of the cached frames, the reference PDFs,
+    prompts, schema, generation settings, the consistency run count and the audit
+    patch/skip settings. Returns None while the frames on disk are
+    incomplete (the key is only meaningful for the frames that will be uploaded).
+    """
+    frames_dir = os.path.join(os.path.dirname(video_path), TEMP_FRAMES_DIRNAME)
+    frame_count = get_frame_timeline(video_path, start_time)[3]
+    try:
+        with os.scandir(frames_dir) as entries:
+            frames = sorted((e.path for e in entries if e.name.endswith('.jpg') and e.is_file()), key=_frame_index)
+    except OSError:
+        return None
+    if not frames or len(frames) < frame_count:
+        return None
+    return _response_cache_key(
+        MODEL_NAME, MODEL_TEMPERATURE, MODEL_TOP_P, MODEL_TOP_K,
+        getattr(args, "seed", DEFAULT_SEED), getattr(args, "media_resolution", DEFAULT_MEDIA_RESOLUTION),
+        getattr(args, "thinking_level", DEFAULT_THINKING_LEVEL), getattr(args, "audit_thinking_level", AUDIT_THINKING_LEVEL),
+        getattr(args, "max_output_tokens", None),
+        getattr(args, "use_google_search", False), getattr(args, "include_audio", False), getattr(args, "single_pass", False),
+        max(1, getattr(args, "consistency_runs", None) or 1),
+        AUDIT_AS_PATCH, AUDIT_SKIP_BELOW_SCORE, AUDIT_SKIP_FINDINGS_SCORE, AUDIT_SKIP_MIN_FINDINGS,
+        SYSTEM_INSTRUCTION, NO_AUDIO_NOTE, COMBINED_PROMPT_TEMPLATE, AUDIT_PROMPT_TEMPLATE, AUDIT_REPORT_SCHEMA, start_time,
+        [_file_digest(pdf) for pdf in reference_pdf_paths()],
+        _file_digest(transcript_path) if transcript_path else None,
+        [_frame_fingerprint(frame) for frame in frames],
+    )
+
+def save_final_reports(output_report_path, final_json_text, final_data, source_path=None):
+    """Writes the final .json (compact), .txt (pretty) and .html reports.
+
+    source_path names a file that already holds exactly final_json_text (the kept step's
+    report); the .json is then hard-linked to it instead of being encoded and written again.
+    """
+    json_report_path = os.path.splitext(output_report_path)[0] + ".json"
+    if source_path:
+        _replace_with_link(source_path, json_report_path)
+    else:
+        _replace_text_file(json_report_path, final_json_text)
+    # The .txt report is the human-readable copy; everything else stays compact
+    _replace_text_file(output_report_path, _json_dumps_pretty(final_data) if final_data else final_json_text)
 
+    print(f"[SUCCESS] Final Structured Reports saved (.json and .txt)")
+    generate_html_report_from_json(json_report_path, final_data or None)
 
-**2. FORMATTING RULE:**
-*   For the `"text"` field in feedback lists, use the exact format: `[Category Letter] - [Subcategory]: [Description ] - [Evidence: Specific example with 1-2 timestamps only]`
-*   **CRITICAL:** Include ONLY 1-2 representative timestamps per feedback item. DO NOT list 50+ timestamps.
-*   **EVIDENCE REQUIREMENT:** ONLY include findings with STRONG, CLEAR, and SPECIFIC evidence. If a finding lacks concrete proof or is based on assumptions, DO NOT include it.
-*   **Category Keys:** **S** = Setup, **A** = Attitude, **P** = Preparation, **C** = Curriculum, **T** = Teaching, **F** = Feedback.
+def write_usage_record(output_report_path, usage_record):
+    """Writes <report>_usage.json and the tagged USAGE: stderr line for batch drivers.
 
----
+    Also removes a stale <report>_error.json left by an earlier failed run.
+    """
+    base = os.path.splitext(output_report_path)[0]
+    usage_text = _json_dumps_compact(usage_record)
+    _replace_text_file(base + "_usage.json", usage_text)
+    print(f"USAGE: {usage_text}", file=sys.stderr)
+    try:
+        os.remove(base + "_error.json")
+    except OSError:
+        pass
 
-### **PHASE 3: RIGOROUS SCORING LOGIC**
-**You must calculate the score based strictly on the findings from Phase 2. Do not guess.**
+def perform_rag_analysis(video_path, output_report_path, transcript_path=None):
+    uploaded_files = []
+    context_cache = None
+    # Every live call is billed, including retried and discarded ones
+    token_usage = collections.Counter()
+    # Recorded with any failure; step1_saved is set once a valid Step 1 draft is in the response
+    # cache, so a rerun resumes from it (never under --no_response_cache)
+    stage = "setup"
+    step1_saved = False
+    try:
+        # 1. SETUP & EXTRACTION
+        if transcript_path is None:
+            transcript_path = TRANSCRIPT_PATH
+        start_time = DEFAULT_START_TIME
+        transcript_exists = os.path.exists(transcript_path)
+        if transcript_exists:
+            start_time = get_start_time_from_transcript(transcript_path)
 
-**Step A: Determine Sub-Category Ratings (0-5)**
-For **EACH** sub-category in the JSON `scoring` object, apply this specific deduction logic:
-*   **5 (Perfect):** 0 Issues found.
-*   **4 (Good):** **1-4 "Areas for Improvement"**from the same sub-category.
-*   **3 (Fair):**5-6 "Areas for Improvement"** from the same sub-category.
-*   **2 (Weak):** 3+  Yellow Flags from the same subcategory  **OR** **6+ "Areas for Improvement"** from the same sub-category.
-*   **1 (Critical):** **10+ "Areas for Improvement"** from the same sub-category..
-*   **0 (Zero):** No show/Total failure.
+        # Identical inputs (e.g. a rerun after a crash in Step 2) reuse the cached responses;
+        # an unchanged session with its frames already on disk skips uploads and calls entirely
+        use_cache = not (args.no_response_cache if hasattr(args, 'no_response_cache') else False)
+        force_frames = args.force_frames if hasattr(args, 'force_frames') else False
+        report_key = None
+        if use_cache and not force_frames:
+            report_key = session_report_key(video_path, start_time, transcript_path if transcript_exists else None)
+            cached_report = _load_cached_response("report", report_key) if report_key else None
+            if cached_report is not None:
+                print(f"[CACHE] Session inputs unchanged; reusing the final report ({report_key[:12]})")
+                save_final_reports(output_report_path, cached_report.text, _json_loads(cached_report.text))
+                # No call was billed; the zero record still replaces any earlier run's usage/error files
+                zero_row = {"in": 0, "out": 0, "thoughts": 0}
+                write_usage_record(output_report_path, {
+                    "step1": zero_row, "step2": zero_row,
+                    "total": {"in": 0, "out": 0},
+                    "cost_usd": 0.0,
+                    "batch": False,
+                    "cached": True,
+                })
+                return
+            
+        # The transcript is the canonical record of what was said, so audio is only extracted
+        # when there is no transcript or --include_audio asks for it (e.g. to judge lag/tone).
+        include_audio = (args.include_audio if hasattr(args, 'include_audio') else False) or not transcript_exists
+
+        # Kept uploads of this session's frames/audio from an earlier run skip extraction and upload
+        media_key = None
+        reused_media = []
+        if not force_frames and _keep_uploaded_files():
+            media_key = session_media_key(video_path, start_time, include_audio)
+            reused_media = reuse_session_media(media_key)
+
+        # Frames are extracted in the background and uploaded as soon as each one is written
+        frame_queue = queue.Queue()
+        frame_thread = None
+        if not reused_media:
+            frame_thread = threading.Thread(
+                target=extract_resources,
+                args=(video_path, start_time, frame_queue),
+                kwargs={"force": force_frames},
+                daemon=True,
+            )
+            frame_thread.start()
 
-**Step B: Apply the Weighted Formula**
-Calculate the `final_weighted_score` using these exact weights:
-- **Setup (25%):** `(Setup Avg ÷ 5) × 100 × 0.25`
-- **Attitude (20%):** `(Attitude Avg ÷ 5) × 100 × 0.20`
-- **Preparation (15%):** `(Preparation Avg ÷ 5) × 100 × 0.15`
-- **Curriculum (15%):** `(Curriculum Avg ÷ 5) × 100 × 0.15`
-- **Teaching (25%):** `(Teaching Avg ÷ 5) × 100 × 0.25`
+        # Audio runs alongside the frames and joins the upload stream once it is written
+        audio_futures = []
+        audio_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if include_audio and not reused_media:
+            def extract_audio_item():
+                # Next to the video (like the frames), so concurrent sessions never share it
+                audio = extract_audio(video_path, os.path.join(os.path.dirname(video_path), TEMP_AUDIO_BASENAME))
+                return (*audio, None) if audio else None
 
-**Step C: MANDATORY MATH VERIFICATION (SELF-AUDIT)**
-Before finalizing the JSON, you MUST internaly verify your calculations and facts:
-1) **EVIDENCE CHECK:** Ensure EVERY "area_for_improvement" and "flag" has specific evidence (timestamp/quote). Remove any that do not.
-2) **SCORE CHECK:** Re-calculate category averages and valid weights. The final score must match the individual ratings perfectly.
-3) **POSITIVE CHECK:** Ensure at least 3 distinct positive highlights are included.
-4) **LANGUAGE CHECK:** Arabic is ALLOWED. Do not flag uses of Arabic.
-5) **FORMAT CHECK:** Ensure "text" fields are concise  and evidence is clear.
+            audio_futures.append(audio_pool.submit(extract_audio_item))
 
-**Remove any comment that lacks evidence. and recale the score don't be like a robot**
-Hard constraints:
-- Return ONLY valid JSON matching the existing schema.
-- Do NOT include any camera angle/framing/visibility/camera quality findings.
-- Do NOT include generic session feedback items (category F / session feedback).
-- Keep all "text" fields concise using the format: `[Category Letter] - [Subcategory]: [Description ] - [Evidence: ...]`
-- Comments from the removed Comments Bank PDF should NOT be included.
+        # 2. UPLOAD EVERYTHING (PDFs and transcript start immediately)
+        print("\n--- Uploading Resources (Parallel) ---")
+        files_to_upload = []
+        
+        # Reference PDFs are identical across sessions; still-live uploads from earlier runs are reused
+        reference_files, pdfs_to_upload = reuse_reference_uploads(reference_pdf_paths())
+        for pdf in pdfs_to_upload:
+            files_to_upload.append((pdf, "application/pdf"))
+        
+        # With GEMINI_DELETE_UPLOADED_FILES=false the transcript upload outlives the run, so an
+        # unchanged transcript is reused the same way (frames are small enough that checking
+        # each one would cost about as much as uploading it)
+        reused_transcripts, transcripts_to_upload = [], []
+        if transcript_exists:
+            transcripts_to_upload = [transcript_path]
+            if _keep_uploaded_files():
+                reused_transcripts, transcripts_to_upload = reuse_reference_uploads(transcripts_to_upload)
+        for path in transcripts_to_upload:
+            files_to_upload.append((path, "text/plain"))
+            
+        streamed_files, streamed_count = None, 0
+        if frame_thread is not None:
+            _, _, _, frame_count = get_frame_timeline(video_path, start_time)
+            streamed_files = iter_with_deferred(iter_queued_frames(frame_queue, frame_count), audio_futures)
+            streamed_count = frame_count + len(audio_futures)
+        uploaded_files = upload_files_parallel(files_to_upload, streamed_files=streamed_files, streamed_count=streamed_count)
+        if frame_thread is not None:
+            frame_thread.join()
+        audio_pool.shutdown()
+        if media_key and not reused_media:
+            remember_session_media(media_key, [
+                t for t in uploaded_files if (t[0].mime_type or "").startswith(("image", "audio"))
+            ])
+        new_reference_files = [t for t in uploaded_files if t[1] in pdfs_to_upload]
+        remember_reference_uploads(new_reference_files)
+        if _keep_uploaded_files():
+            remember_reference_uploads([t for t in uploaded_files if t[1] in transcripts_to_upload])
+        if _reference_cache_enabled():
+            # Shared with later runs, so kept out of the end-of-run cleanup
+            ref_by_path = {t[1]: t for t in reference_files + new_reference_files}
+            reference_files = [ref_by_path[p] for p in reference_pdf_paths() if p in ref_by_path]
+            uploaded_files = [t for t in uploaded_files if t[1] not in pdfs_to_upload]
+        session_files = reference_files + reused_transcripts + uploaded_files + reused_media
+        
+        # Categorize resources. session_files is a list of (file_object, original_path) tuples
+        # already in deterministic order (upload_files_parallel keeps submission order: PDFs
+        # by path, transcript, frames by index, audio), so the buckets need no sorting
+        buckets = {"pdf": [], "text": [], "image": [], "audio": []}
+        for t in session_files:
+            mime_type = t[0].mime_type or ""
+            if mime_type.endswith("pdf"):
+                buckets["pdf"].append(t)
+            elif mime_type.startswith("text"):
+                buckets["text"].append(t)
+            elif mime_type.startswith("image"):
+                buckets["image"].append(t)
+            elif mime_type.startswith("audio"):
+                buckets["audio"].append(t)
+        pdf_objs = buckets["pdf"]
+        transcript_objs = buckets["text"]
+        frame_objs = buckets["image"]
+        audio_objs = buckets["audio"]
+        
+        print(f"Resources: {len(pdf_objs)} PDFs, {len(transcript_objs)} Transcripts, {len(frame_objs)} Frames, {len(audio_objs)} Audio")
+        # Server-side processing is polled in the background while the config, prompts and
+        # cache keys are built; the first live model call waits for it (cached reruns never do)
+        files_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        files_active = files_pool.submit(wait_for_files_active, session_files)
+        files_pool.shutdown(wait=False)
 
-"""
+        # 3. INITIALIZE MODEL (Optimized for Gemini 3 Flash)
+        print("\n--- Initializing Knowledge Base Chat ---")
+        
+        # Model configuration with seed for determinism
+        # NOTE: Gemini 3.0 Flash uses thinking_level or disabled thinking
+        # "minimal" ensures the closest behavior to deterministic output.
+        gen_config_kwargs = dict(
+            temperature=MODEL_TEMPERATURE,
+            top_p=MODEL_TOP_P,
+            top_k=MODEL_TOP_K,
+            candidate_count=1,
+            response_mime_type="application/json",
+            response_schema=AUDIT_REPORT_SCHEMA,
+            system_instruction=SYSTEM_INSTRUCTION if audio_objs else SYSTEM_INSTRUCTION + NO_AUDIO_NOTE,
+            seed=args.seed if hasattr(args, 'seed') else DEFAULT_SEED,
+            media_resolution=args.media_resolution if hasattr(args, 'media_resolution') else DEFAULT_MEDIA_RESOLUTION,
+        )
+        
+        # Apply Thinking Config whenever a thinking_level is set (default "minimal")
+        current_thinking_level = args.thinking_level if hasattr(args, 'thinking_level') else DEFAULT_THINKING_LEVEL
+        if current_thinking_level:
+            # Without a thinking_config Gemini 3 thinks dynamically (up to "high"), which is
+            # slower and less deterministic than the documented "minimal" default
+            try:
+                gen_config_kwargs["thinking_config"] = types.ThinkingConfig(thinking_level=current_thinking_level)
+            except Exception:
+                # Older google-genai releases have no thinking_level; keep the model default
+                pass
+        
+        # Enable Google Search (Community Search) if requested
+        if hasattr(args, 'use_google_search') and args.use_google_search:
+            print("--- Googling Search (Community Search) ENABLED ---")
+            gen_config_kwargs["tools"] = [types.Tool(google_search=types.GoogleSearch())]
+            
+        if args.max_output_tokens is not None:
+            gen_config_kwargs["max_output_tokens"] = args.max_output_tokens
+
+        generation_config = types.GenerateContentConfig(**gen_config_kwargs)
+        
+        # 4. STEP 1: INITIAL GENERATION
+        print("\n--- Step 1: Generating Initial Analysis JSON ---")
+        combined_prompt = render_combined_prompt(start_time=start_time)
+        step1_prompt_parts = [combined_prompt]
+        if getattr(args, "single_pass", False):
+            step1_prompt_parts.append(render_single_pass_note(start_time=start_time))
         # Extract file objects from tuples for content list
         pdf_files = [t[0] for t in pdf_objs]
         transcript_files = [t[0] for t in transcript_objs]
         frame_files = [t[0] for t in frame_objs]
         audio_files = [t[0] for t in audio_objs]
+        resource_files = pdf_files + transcript_files + frame_files + audio_files
+
+        # Contents go static to dynamic: reference PDFs, session files, then the prompt (which
+        # embeds the start time and, in Step 2, the draft). Without an explicit cache the
+        # request then shares its longest possible prefix with other calls, so Gemini's
+        # implicit prefix caching can apply; rules mode caches exactly the PDF prefix.
+        # Live calls reference one server-side context cache instead of re-sending the files;
+        # it is created on the first live call so fully cached reruns never build it.
+        # "rules" mode caches only the reference PDFs (reused across sessions, never deleted
+        # here) and sends the session files with each request. With GEMINI_DELETE_UPLOADED_FILES=false
+        # the session cache is kept for SESSION_CONTEXT_CACHE_TTL_SEC and reused by later runs
+        cache_mode = str(os.environ.get("GEMINI_CONTEXT_CACHE", "true")).lower()
+        # --batch jobs can queue for hours, far past any context cache TTL, so they always send the files
+        use_batch = getattr(args, "batch", False)
+        generate = generate_content_batched if use_batch else generate_content_streamed
+        cache_pending = cache_mode != "false" and not use_batch
+        rules_cache = kept_cache = None
+
+        def request_args(config_kwargs=None):
+            """Returns (files, config) for a live generate_content call (config_kwargs defaults to gen_config_kwargs)."""
+            nonlocal context_cache, rules_cache, kept_cache, cache_pending
+            files_active.result()
+            if cache_pending:
+                cache_pending = False
+                if cache_mode == "rules":
+                    rules_cache = get_rules_context_cache(pdf_objs, gen_config_kwargs) if pdf_objs else None
+                elif _keep_uploaded_files():
+                    # Outlives the run like the uploads (expires on its TTL, not deleted at cleanup)
+                    kept_cache = get_session_context_cache(pdf_objs + transcript_objs + frame_objs + audio_objs, gen_config_kwargs)
+                else:
+                    context_cache = create_context_cache(resource_files, gen_config_kwargs)
+            if context_cache is not None or kept_cache is not None:
+                return [], _cached_generation_config(config_kwargs or gen_config_kwargs, context_cache or kept_cache)
+            if rules_cache is not None:
+                session_only = transcript_files + frame_files + audio_files
+                return session_only, _cached_generation_config(config_kwargs or gen_config_kwargs, rules_cache)
+            if config_kwargs is None:
+                return resource_files, generation_config
+            return resource_files, types.GenerateContentConfig(**config_kwargs)
         
+        input_hashes = sorted(_file_digest(path) for _, path in session_files) if use_cache else []
+
         # 4. STEP 1: INITIAL GENERATION
         print("\n--- Step 1: Generating Initial Analysis JSON ---")
+        stage = "step1"
         
-        response_1 = _call_genai_with_backoff(
-            lambda: client.models.generate_content(
-                model=MODEL_NAME,
-                contents=[combined_prompt] + pdf_files + transcript_files + frame_files + audio_files,
-                config=generation_config,
-            ),
-            what="models.generate_content(step1)",
+        consistency_runs = max(1, getattr(args, "consistency_runs", None) or 1)
+        # The cached Step 1 entry is the draft that goes on to Step 2 (the median one with
+        # --consistency_runs), so a run that dies before Step 2 resumes from the same draft
+        step1_key = _response_cache_key(
+            MODEL_NAME, step1_prompt_parts, input_hashes, gen_config_kwargs,
+            *([consistency_runs] if consistency_runs > 1 else []),
         )
+        response_1 = _load_cached_response("step1", step1_key) if use_cache else None
+        step1_cached = response_1 is not None
+        # --consistency_runs N: N-1 extra Step 1 drafts (other seeds) are generated in parallel with
+        # the main one; the draft closest to the median score goes on to Step 2
+        consistency_futures = []
+        if step1_cached:
+            print(f"[CACHE] Reusing Step 1 response ({step1_key[:12]})")
+        else:
+            extra_runs = consistency_runs - 1
+            if extra_runs:
+                print(f"[INFO] Generating {extra_runs} extra Step 1 draft(s) in parallel for consistency")
+                consistency_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(extra_runs, MAX_CONSISTENCY_WORKERS), thread_name_prefix="gemini-step1",
+                )
+                for run in range(1, extra_runs + 1):
+                    run_config_kwargs = dict(gen_config_kwargs)
+                    if run_config_kwargs.get("seed") is not None:
+                        run_config_kwargs["seed"] += CONSISTENCY_SEED_STRIDE * run
+                    # request_args stays on this thread: it may create the shared context cache
+                    run_files, run_config = request_args(run_config_kwargs)
+                    consistency_futures.append(consistency_executor.submit(
+                        _call_genai_with_backoff,
+                        functools.partial(
+                            generate_content_batched if use_batch else client.models.generate_content,
+                            model=MODEL_NAME, contents=run_files + step1_prompt_parts, config=run_config,
+                        ),
+                        what=f"models.generate_content(step1-run{run + 1})",
+                    ))
+                consistency_executor.shutdown(wait=False)
+            request_files, request_config = request_args()
+            step1_started = time.monotonic()
+            response_1 = _call_genai_with_backoff(
+                lambda: generate(
+                    model=MODEL_NAME,
+                    contents=request_files + step1_prompt_parts,
+                    config=request_config,
+                ),
+                what="models.generate_content(step1)",
+            )
+        _add_usage(token_usage, 1, response_1)
+        # response_schema makes the text bare JSON, so it is validated as-is
         initial_json = response_1.text.strip()
         
-        # Extract JSON from markdown or raw text
-        if "```json" in initial_json:
-            initial_json = initial_json.split("```json")[1].split("```")[0].strip()
-        elif "```" in initial_json:
-            initial_json = initial_json.split("```")[1].split("```")[0].strip()
-        
         # Validate initial JSON
         is_valid_initial, initial_validation = validate_json_response(initial_json)
         retry_count = 0
+        step1_config_kwargs = gen_config_kwargs
         
         while not is_valid_initial and retry_count < MAX_EMPTY_JSON_RETRIES:
             retry_count += 1
             print(f"[WARNING] Invalid Initial JSON: {initial_validation}")
             print(f"[RETRY] Regenerating Step 1 (retry {retry_count}/{MAX_EMPTY_JSON_RETRIES})...")
             
+            # A draft cut off by max_output_tokens would be cut off again at the same cap
+            if _finish_reason(response_1) == "MAX_TOKENS":
+                step1_config_kwargs = _doubled_output_cap(step1_config_kwargs) or step1_config_kwargs
+                print(f"[WARNING] Step 1 hit max_output_tokens; retrying with max_output_tokens={step1_config_kwargs.get('max_output_tokens')}")
+            # Same seed and sampling would decode the same failed output again
+            retry_config_kwargs = dict(step1_config_kwargs)
+            if retry_config_kwargs.get("seed") is not None:
+                retry_config_kwargs["seed"] += retry_count
+            request_files, request_config = request_args(retry_config_kwargs)
+            step1_started = time.monotonic()
             response_1 = _call_genai_with_backoff(
-                lambda: client.models.generate_content(
+                lambda: generate(
                     model=MODEL_NAME,
-                    contents=[combined_prompt + "\n\nCRITICAL: Return a complete, valid JSON object."]
-                    + pdf_files
-                    + transcript_files
-                    + frame_files
-                    + audio_files,
-                    config=generation_config,
+                    contents=request_files + step1_prompt_parts + [STEP1_RETRY_NOTE],
+                    config=request_config,
                 ),
                 what="models.generate_content(step1-retry)",
             )
+            _add_usage(token_usage, 1, response_1)
             initial_json = response_1.text.strip()
-            if "```json" in initial_json:
-                initial_json = initial_json.split("```json")[1].split("```")[0].strip()
-            elif "```" in initial_json:
-                initial_json = initial_json.split("```")[1].split("```")[0].strip()
             is_valid_initial, initial_validation = validate_json_response(initial_json)
         
+        # Set when --consistency_runs picks a draft: drafts are rescored before the pick
+        data_step1 = None
+        if consistency_futures:
+            drafts = []
+            if is_valid_initial:
+                drafts.append(recalculate_score(initial_json, initial_validation))
+            for future in consistency_futures:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    print(f"[WARNING] Extra Step 1 draft failed: {e}")
+                    continue
+                _add_usage(token_usage, 1, response)
+                draft_text = (response.text or "").strip()
+                draft_valid, draft_data = validate_json_response(draft_text)
+                if draft_valid:
+                    drafts.append(recalculate_score(draft_text, draft_data))
+            if drafts:
+                analyses = [(text, data, data.get("scoring", {}).get("final_weighted_score", 0)) for text, data in drafts]
+                initial_json, data_step1, median_score, all_scores, variance = select_best_analysis_by_median(analyses, serialize=True)
+                initial_validation = data_step1
+                is_valid_initial = True
+                print(f"[CONSISTENCY] Step 1 scores {all_scores}: median {median_score:.1f}, range {variance:.1f}; "
+                      f"keeping the draft scored {data_step1.get('scoring', {}).get('final_weighted_score', 0)}")
+
+        if is_valid_initial and use_cache and not step1_cached:
+            _store_cached_response("step1", step1_key, response_1._replace(text=initial_json))
+        step1_saved = is_valid_initial and use_cache
+
         if not is_valid_initial:
              print(f"[ERROR] Step 1 Failed: {initial_validation}")
              # Proceed to Step 2 anyway if possible, or fail? 
@@ -1288,232 +2975,338 @@ Hard constraints:
              # However, let's try to proceed with what we have to avoid full crash.
 
         # Process Step 1 Result
-        initial_json, data_step1 = recalculate_score(initial_json)
+        if data_step1 is None:
+            initial_json, data_step1 = recalculate_score(initial_json, initial_validation if is_valid_initial else None)
         score_step1 = data_step1.get("scoring", {}).get("final_weighted_score", 0)
         
         step1_report_path = os.path.splitext(output_report_path)[0] + "_Step1.json"
-        with open(step1_report_path, 'w', encoding='utf-8') as f:
-            f.write(initial_json)
+        # Step reports are replaced, never rewritten in place: the final .json may be a hard link to one
+        _replace_text_file(step1_report_path, initial_json)
         print(f"[SUCCESS] Step 1 Analysis Saved (Score: {score_step1}): {step1_report_path}")
-
-        # Delay between steps to avoid hitting API rate limits
-        step_delay = int(os.environ.get("GEMINI_STEP_DELAY_SEC", "30"))
-        print(f"\n--- Waiting {step_delay}s before Step 2 (rate-limit cooldown) ---")
-        time.sleep(step_delay)
+        stage = "step2"
 
         # 5. STEP 2: SELF-AUDIT (RESTORED)
-        print("\n--- Step 2: Deep Audit & Verification (With Full Context) ---")
-        
-        audit_prompt = f"""
-You are the **Senior Quality Compliance Auditor**.
-Your task is to **AUDIT and CORRECT** the "Draft Analysis JSON" provided below.
-
-**THE DRAFT MAY CONTAIN ERRORS. DO NOT TRUST IT BLINDLY.**
-You have access to the **ACTUAL** session evidence (Audio, Frames, Transcript).
-You must verify every single claim in the draft against this evidence.
-
-**AUDIT PROTOCOL:**
-1.  **VERIFY EVIDENCE:**
-    - If the draft says "Issue X at 10:00", **check the transcript/audio at 10:00**.
-    - If the evidence does NOT support the claim, **DELETE IT**.
-    - If the evidence is weak or ambiguous, **DELETE IT**.
-    - **CRITICAL:** Start Time is **{start_time}**. ANY issue cited before this timestamp is invalid and MUST be deleted.
-
-2.  **HUNT FOR MISSED ISSUES:**
-    - The draft might have missed something. Re-scan the "teaching" and "interaction" phases.
-    - Did the tutor check for understanding? Did they engage the student?
-    - If you find a new valid issue backed by strong evidence, **ADD IT**.
-
-3.  **STRICT SCORING CORRECTION:**
-    - Recalculate the score based *only* on the valid findings that remain.
-    - If you deleted issues, the score MUST go VALID (Up).
-    - If you added issues, the score MUST go DOWN.
-    - **Do not be lazy.** Do not just copy the draft score. Calculate it yourself.
-
-4.  **REFINEMENT:**
-    - **Language:** Arabic is ALLOWED. Remove any flags strictly about speaking Arabic.
-    - **Positive Highlights:** Ensure at least 3 distinct, true positives are listed.
-    - **Conciseness:** Merge repetitive points. Use "Consistently..." for recurring behaviors.
-    - **Evidence Format:** Ensure every finding has: `[Category] - [Subcategory]: [Description] - [Evidence: ...]`
-
-**INPUT DRAFT JSON:**
-{initial_json}
-
-**REQUIRED OUTPUT:**
-The clean, corrected, and finalized JSON.
-"""
-        response_2 = _call_genai_with_backoff(
-            lambda: client.models.generate_content(
-                model=MODEL_NAME,
-                contents=[audit_prompt] + pdf_files + transcript_files + frame_files + audio_files,
-                config=generation_config,
-            ),
-            what="models.generate_content(step2)",
+        step1_findings = len(data_step1.get("areas_for_improvement") or ()) + len(data_step1.get("flags") or ())
+        audit_skipped = is_valid_initial and (
+            getattr(args, "single_pass", False)
+            or score_step1 < AUDIT_SKIP_BELOW_SCORE
+            or (score_step1 <= AUDIT_SKIP_FINDINGS_SCORE and step1_findings >= AUDIT_SKIP_MIN_FINDINGS)
         )
-        final_json_text = response_2.text.strip()
+        if audit_skipped:
+            # The comparison below keeps the lower score, so the audit could not lift this one
+            # (with --single_pass the draft was already audited in the Step 1 call)
+            reason = "was audited in Step 1 (--single_pass)" if getattr(args, "single_pass", False) else "is already final"
+            print(f"\n--- Step 2 skipped: Step 1 score {score_step1} with {step1_findings} findings {reason} ---")
+            response_2 = None
+            step2_cached = step1_cached
+            final_json_text, data2, score2 = initial_json, data_step1, score_step1
+            is_valid = is_valid_initial
+        else:
+            print("\n--- Step 2: Deep Audit & Verification (With Full Context) ---")
         
-        # Extract JSON from markdown
-        if "```json" in final_json_text:
-            final_json_text = final_json_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in final_json_text:
-            final_json_text = final_json_text.split("```")[1].split("```")[0].strip()
-
-        # Validate Final JSON
-        is_valid, validation_result = validate_json_response(final_json_text)
+            def run_audit(as_patch):
+                """Returns (response, cache key, from cache) for one Step 2 request."""
+                audit_parts = audit_prompt_parts(start_time, initial_json, as_patch)
+                audit_config_kwargs = {**gen_config_kwargs, **_audit_config_overrides(
+                    initial_json, args.max_output_tokens, getattr(args, "audit_thinking_level", AUDIT_THINKING_LEVEL),
+                )}
+                if as_patch:
+                    audit_config_kwargs["response_schema"] = AUDIT_PATCH_SCHEMA
+                key = _response_cache_key(MODEL_NAME, audit_parts, input_hashes, audit_config_kwargs)
+                response = _load_cached_response("step2", key) if use_cache else None
+                if response is not None:
+                    print(f"[CACHE] Reusing Step 2 response ({key[:12]})")
+                    return response, key, True
+                if not step1_cached:
+                    # Delay between steps to avoid hitting API rate limits. It spaces the request
+                    # starts, so time spent generating Step 1 already counts toward it.
+                    step_delay = int(os.environ.get("GEMINI_STEP_DELAY_SEC", "30"))
+                    remaining = step_delay - (time.monotonic() - step1_started)
+                    if remaining > 0:
+                        print(f"\n--- Waiting {remaining:.0f}s before Step 2 (rate-limit cooldown) ---")
+                        time.sleep(remaining)
+                request_files, request_config = request_args(audit_config_kwargs)
+                response = _call_genai_with_backoff(
+                    lambda: generate(
+                        model=MODEL_NAME,
+                        contents=request_files + audit_parts,
+                        config=request_config,
+                    ),
+                    what="models.generate_content(step2)",
+                )
+                _add_usage(token_usage, 2, response)
+                # The cap is sized from the draft; an audit that outgrows it gets one retry at twice the cap
+                retry_config_kwargs = _doubled_output_cap(audit_config_kwargs, args.max_output_tokens)
+                if _finish_reason(response) == "MAX_TOKENS" and retry_config_kwargs:
+                    print(f"[WARNING] Step 2 hit max_output_tokens; retrying with max_output_tokens={retry_config_kwargs['max_output_tokens']}")
+                    request_files, request_config = request_args(retry_config_kwargs)
+                    response = _call_genai_with_backoff(
+                        lambda: generate(
+                            model=MODEL_NAME,
+                            contents=request_files + audit_parts,
+                            config=request_config,
+                        ),
+                        what="models.generate_content(step2-retry)",
+                    )
+                    _add_usage(token_usage, 2, response)
+                return response, key, False
+
+            # A patch needs a parsed draft to apply to
+            as_patch = AUDIT_AS_PATCH and is_valid_initial
+            response_2, step2_key, step2_cached = run_audit(as_patch)
+            final_json_text = response_2.text.strip()
+            if as_patch:
+                try:
+                    patch = _decode_audit_patch(final_json_text)
+                    final_json_text = _json_dumps_compact(apply_json_patch(data_step1, patch))
+                    print(f"[INFO] Step 2 returned {len(patch)} patch operation(s)")
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    print(f"[WARNING] Step 2 patch could not be applied ({e!r}); running the full audit")
+                    response_2, step2_key, step2_cached = run_audit(False)
+                    final_json_text = response_2.text.strip()
+
+            # Validate Final JSON
+            is_valid, validation_result = validate_json_response(final_json_text)
+            parsed_final = validation_result if is_valid else None
         
-        if not is_valid:
-            print(f"[ERROR] Step 2 Invalid JSON: {validation_result}. Falling back to Initial JSON.")
-            final_json_text = initial_json
-            is_valid = is_valid_initial
+            if not is_valid:
+                print(f"[ERROR] Step 2 Invalid JSON: {validation_result}. Falling back to Initial JSON.")
+                final_json_text = initial_json
+                parsed_final = data_step1 or None
+                is_valid = is_valid_initial
+            elif use_cache and not step2_cached:
+                _store_cached_response("step2", step2_key, response_2)
         
-        # --- SCORE RECALCULATION ---
-        # (Using global recalculate_score function)
+            # --- SCORE RECALCULATION ---
+            # (Using global recalculate_score function)
 
         
-        # Final Processing
-        final_json_text, data2 = recalculate_score(final_json_text)
-        score2 = data2.get("scoring", {}).get("final_weighted_score", 0)
+            # Final Processing
+            final_json_text, data2 = recalculate_score(final_json_text, parsed_final)
+            score2 = data2.get("scoring", {}).get("final_weighted_score", 0)
         
-        step2_report_path = os.path.splitext(output_report_path)[0] + "_Step2.json"
-        with open(step2_report_path, 'w', encoding='utf-8') as f:
-            f.write(final_json_text)
-        print(f"[SUCCESS] Step 2 Analysis Saved (Score: {score2}): {step2_report_path}")
+            step2_report_path = os.path.splitext(output_report_path)[0] + "_Step2.json"
+            _replace_text_file(step2_report_path, final_json_text)
+            print(f"[SUCCESS] Step 2 Analysis Saved (Score: {score2}): {step2_report_path}")
 
+        stage = "report"
         # DECISION: Keep Lower Score (Safe Mode)
         print(f"\n--- Score Comparison ---")
         print(f"Step 1 Score: {score_step1}")
-        print(f"Step 2 Score: {score2}")
+        print(f"Step 2 Score: {'skipped' if audit_skipped else score2}")
         
-        if score_step1 < score2:
+        if audit_skipped:
+             print(">>> Step 2 was skipped. Keeping Step 1 findings.")
+             final_source_path = step1_report_path
+             final_data = data_step1
+             final_score = score_step1
+        elif score_step1 < score2:
              print(">>> Step 1 is lower. Reverting to Step 1 findings as standard.")
              final_json_text = initial_json
+             final_source_path = step1_report_path
              final_data = data_step1
              final_score = score_step1
         else:
              print(">>> Step 2 is lower (or equal). Keeping Audit findings.")
              final_json_text = final_json_text
+             final_source_path = step2_report_path
              final_data = data2
              final_score = score2
 
         # Save Final Report
-        json_report_path = os.path.splitext(output_report_path)[0] + ".json"
-        with open(json_report_path, 'w', encoding='utf-8') as f:
-            f.write(final_json_text)
-        
-        with open(output_report_path, 'w', encoding='utf-8') as f:
-            f.write(final_json_text) 
-
-        print(f"[SUCCESS] Final Structured Reports saved (.json and .txt)")
-
-        # 6. GENERATE HTML
-        generate_html_report_from_json(json_report_path)
+        save_final_reports(output_report_path, final_json_text, final_data, final_source_path)
+        if use_cache and is_valid:
+            # First runs had no frames on disk at the start, so the key is computed now
+            report_key = report_key or session_report_key(video_path, start_time, transcript_path if transcript_exists else None)
+            if report_key:
+                _store_cached_response("report", report_key, ModelResponse(text=final_json_text, usage_metadata=None))
         
         # 7. CONSISTENCY TRACKING
         # Track scores across runs for the same session to detect variance
-        session_id = os.path.basename(os.path.dirname(output_report_path))  # e.g., "T-4092"
-        consistency_log_path = os.path.join(os.path.dirname(output_report_path), f"{session_id}_consistency_log.json")
-        
-        try:
-            if os.path.exists(consistency_log_path):
-                with open(consistency_log_path, 'r') as f:
-                    consistency_data = json.load(f)
-            else:
-                consistency_data = {"session_id": session_id, "runs": []}
-            
-            # Add this run
-            import datetime
-            consistency_data["runs"].append({
-                "timestamp": datetime.datetime.now().isoformat(),
-                "score": final_score,
-                "seed": args.seed,
-                "model": MODEL_NAME,
-                "temperature": MODEL_TEMPERATURE,
-                "thinking_level": args.thinking_level
-            })
+        if step1_cached and step2_cached:
+            # A fully cached rerun is not an independent sample of the model's score
+            print("\n[CACHE] Both steps were cached; not logging a new consistency run")
+        else:
+            report_dir = os.path.dirname(output_report_path)
+            session_id = os.path.basename(report_dir)  # e.g., "T-4092"
+            # Append-only JSON Lines, one run per line: a run writes one record, not the whole history
+            consistency_log_path = os.path.join(report_dir, f"{session_id}_consistency.jsonl")
+            try:
+                legacy_log_path = os.path.join(report_dir, f"{session_id}_consistency_log.json")
+                if not os.path.exists(consistency_log_path) and os.path.exists(legacy_log_path):
+                    # Carry the runs of the earlier whole-file JSON log over once
+                    with open(legacy_log_path, 'rb') as f:
+                        earlier_runs = _json_loads(f.read()).get("runs", [])
+                    _replace_text_file(consistency_log_path, "".join(_json_dumps_compact(r) + "\n" for r in earlier_runs))
             
-            # Calculate statistics
-            all_scores = [r["score"] for r in consistency_data["runs"]]
-            if len(all_scores) > 1:
-                median_score = compute_median_score(all_scores)
-                variance = max(all_scores) - min(all_scores)
-                consistency_data["statistics"] = {
-                    "total_runs": len(all_scores),
-                    "all_scores": all_scores,
-                    "median_score": round(median_score, 1),
-                    "min_score": min(all_scores),
-                    "max_score": max(all_scores),
-                    "variance": round(variance, 1),
-                    "is_reliable": variance <= SCORE_VARIANCE_THRESHOLD
+                # Add this run
+                run_record = {
+                    "timestamp": datetime.datetime.now().isoformat(),
+                    "score": final_score,
+                    "seed": args.seed,
+                    "model": MODEL_NAME,
+                    "temperature": MODEL_TEMPERATURE,
+                    "thinking_level": args.thinking_level
                 }
-                
-                # Print consistency warning if variance is high
-                if variance > SCORE_VARIANCE_THRESHOLD:
-                    print(f"\n[⚠️ CONSISTENCY WARNING] Score variance is HIGH: {variance:.1f} points")
-                    print(f"   Previous scores: {all_scores[:-1]}")
-                    print(f"   Current score:   {final_score}")
-                    print(f"   Median score:    {median_score:.1f}")
-                    print(f"   Recommended: Use median score ({median_score:.1f}) for reporting")
-                else:
-                    print(f"\n[✓ CONSISTENCY OK] Score variance: {variance:.1f} points (threshold: {SCORE_VARIANCE_THRESHOLD})")
-                    print(f"   Scores: {all_scores}")
+                with open(consistency_log_path, 'ab') as f:
+                    f.write((_json_dumps_compact(run_record) + "\n").encode("utf-8"))
             
-            # Save consistency log
-            with open(consistency_log_path, 'w') as f:
-                json.dump(consistency_data, f, indent=2)
+                # Calculate statistics
+                # Scores and their range are gathered in one pass over the log
+                all_scores = []
+                low = high = final_score
+                with open(consistency_log_path, 'rb') as f:
+                    for line in f:
+                        if line.strip():
+                            score = _json_loads(line)["score"]
+                            all_scores.append(score)
+                            low, high = min(low, score), max(high, score)
+                if len(all_scores) > 1:
+                    median_score = compute_median_score(all_scores)
+                    variance = high - low
                 
-        except Exception as e:
-            print(f"[WARNING] Consistency tracking failed: {e}")
+                    # Print consistency warning if variance is high
+                    if variance > SCORE_VARIANCE_THRESHOLD:
+                        print(f"\n[⚠️ CONSISTENCY WARNING] Score variance is HIGH: {variance:.1f} points")
+                        print(f"   Previous scores: {all_scores[:-1]}")
+                        print(f"   Current score:   {final_score}")
+                        print(f"   Median score:    {median_score:.1f}")
+                        print(f"   Recommended: Use median score ({median_score:.1f}) for reporting")
+                    else:
+                        print(f"\n[✓ CONSISTENCY OK] Score variance: {variance:.1f} points (threshold: {SCORE_VARIANCE_THRESHOLD})")
+                        print(f"   Scores: {all_scores}")
+                
+            except Exception as e:
+                print(f"[WARNING] Consistency tracking failed: {e}")
 
-        # Final Cost Details
-        in_1 = response_1.usage_metadata.prompt_token_count if response_1.usage_metadata else 0
-        out_1 = response_1.usage_metadata.candidates_token_count if response_1.usage_metadata else 0
-        in_2 = response_2.usage_metadata.prompt_token_count if response_2.usage_metadata else 0
-        out_2 = response_2.usage_metadata.candidates_token_count if response_2.usage_metadata else 0
-        
-        total_in = in_1 + in_2
-        total_out = out_1 + out_2
+        # Final Cost Details: one row per step, totals and cost reduced over the rows
+        step_usage = {
+            f"step{step}": {kind: token_usage[f"{kind}_{step}"] for kind in ("in", "out", "thoughts")}
+            for step in (1, 2)
+        }
+        total_in = sum(row["in"] for row in step_usage.values())
+        total_out = sum(row["out"] for row in step_usage.values())
         
         total_cost = (total_in / 1e6 * COST_PER_MILLION_INPUT_TOKENS) + (total_out / 1e6 * COST_PER_MILLION_OUTPUT_TOKENS)
+        if use_batch:
+            total_cost *= BATCH_COST_FACTOR
         print(f"Analysis complete. Total Tokens: {total_in + total_out}")
-        print(f"Step 1: In={in_1}, Out={out_1}")
-        print(f"Step 2: In={in_2}, Out={out_2}")
+        # Input tokens are dominated by the frames, so show the resolution they were billed at
+        print(f"Media Resolution: {gen_config_kwargs['media_resolution']}")
+        for step in (1, 2):
+            row = step_usage[f"step{step}"]
+            print(f"Step {step}: In={row['in']}, Out={row['out']} (thinking {row['thoughts']})")
         print(f"Total Cost: ${total_cost:.4f}")
 
+        # Same figures for batch drivers: a file next to the report and one tagged stderr line
+        write_usage_record(output_report_path, {
+            **step_usage,
+            "total": {"in": total_in, "out": total_out},
+            "cost_usd": round(total_cost, 6),
+            "batch": use_batch,
+            "cached": False,
+        })
+
     except Exception as e:
         print(f"Error in RAG analysis: {e}")
         import traceback
         traceback.print_exc()
-        import sys
-        sys.exit(1)
+        # Recorded next to the report and as one tagged stderr line; exit status 2 means the
+        # Step 1 draft is in the response cache (a rerun reuses it), 1 that nothing was
+        partial = step1_saved
+        error_text = _json_dumps_compact({
+            "stage": stage,
+            "error": f"{type(e).__name__}: {e}",
+            "partial": partial,
+            "step1_report": os.path.splitext(output_report_path)[0] + "_Step1.json" if partial else None,
+            "usage": dict(token_usage),
+        })
+        try:
+            _replace_text_file(os.path.splitext(output_report_path)[0] + "_error.json", error_text)
+        except OSError:
+            pass
+        print(f"ERROR: {error_text}", file=sys.stderr)
+        sys.exit(2 if partial else 1)
     finally:
+        delete_context_cache(context_cache)
         # Always delete uploaded Gemini files to avoid hitting per-project storage limits
         try:
             delete_uploaded_gemini_files(uploaded_files)
         except Exception:
             pass
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Parses command-line options and runs the analysis (one per --session_dir); importable so a batch driver can loop in-process."""
+    global args
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", default=VIDEO_FILE_PATH)
-    parser.add_argument("--output_report", default=OUTPUT_REPORT_TXT)
-    parser.add_argument("--transcript", default=TRANSCRIPT_PATH)
+    parser.add_argument("--session_dir", nargs="+", default=None, help="Session folder(s) or glob (Sessions/T-*); picks each one's .mp4 and transcript and writes the report there. Several sessions run one after another in this process, sharing the client, reference uploads and rules cache")
+    parser.add_argument("--input", default=None, help=f"Input video (default: {VIDEO_FILE_PATH})")
+    parser.add_argument("--output_report", default=None, help=f"Output report (default: {OUTPUT_REPORT_TXT})")
+    parser.add_argument("--transcript", default=None, help=f"Transcript path (default: {TRANSCRIPT_PATH})")
+    parser.add_argument("--pdfs", nargs="+", default=None, help="Reference PDFs (default: PDF_REFERENCE_FILES)")
     parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed for reproducibility")
     parser.add_argument("--thinking_level", type=str, default=DEFAULT_THINKING_LEVEL, help="Thinking level for Gemini 3 (minimal, low, high)")
+    parser.add_argument("--audit_thinking_level", type=str, default=AUDIT_THINKING_LEVEL, help="Thinking level for the Step 2 audit, which only rewrites the draft (thinking tokens are billed as output)")
     parser.add_argument("--media_resolution", type=str, default=DEFAULT_MEDIA_RESOLUTION, choices=["MEDIA_RESOLUTION_LOW", "MEDIA_RESOLUTION_MEDIUM", "MEDIA_RESOLUTION_HIGH"], help="Media resolution for vision processing (impacts token usage and latency)")
     parser.add_argument("--max_output_tokens", type=int, default=DEFAULT_MAX_OUTPUT_TOKENS, help="Maximum output tokens (None = model default)")
     parser.add_argument("--consistency_runs", type=int, default=DEFAULT_CONSISTENCY_RUNS, help="Number of analysis runs for consistency (1=single run, 3=high reliability)")
+    parser.add_argument("--include_audio", action="store_true", help="Also upload the session audio (always done when there is no transcript; the transcript is otherwise canonical)")
     parser.add_argument("--use_google_search", action="store_true", help="Enable Google Search grounding (Community Search) for factual verification")
-    args = parser.parse_args()
+    parser.add_argument("--force_frames", action="store_true", help="Discard partially extracted frames instead of resuming them")
+    parser.add_argument("--single_pass", action="store_true", help="Audit the draft inside the Step 1 call and skip the separate Step 2 audit (one model call, lower cost and latency)")
+    parser.add_argument("--batch", action="store_true", help="Run the model calls as Batch API jobs: half the cost, but each step may wait for hours (for unattended runs)")
+    parser.add_argument("--no_response_cache", action="store_true", help=f"Always call the model instead of reusing cached final reports and Step 1/Step 2 responses from {RESPONSE_CACHE_DIR}/")
+    args = parser.parse_args(argv)
+
+    # Globs are expanded here too, since cmd.exe passes them through unexpanded
+    session_dirs = []
+    for pattern in args.session_dir or ():
+        session_dirs.extend(sorted(p for p in glob.glob(pattern) if os.path.isdir(p)) if glob.has_magic(pattern) else [pattern])
+    if args.session_dir and not session_dirs:
+        parser.error(f"--session_dir {' '.join(args.session_dir)} matched no directories")
+    if len(session_dirs) > 1 and (args.input or args.transcript or args.output_report):
+        parser.error("--input, --transcript and --output_report apply to a single session")
+
+    video_path, transcript_path, output_report_path = VIDEO_FILE_PATH, TRANSCRIPT_PATH, OUTPUT_REPORT_TXT
+    if len(session_dirs) == 1:
+        video_path, transcript_path, output_report_path = resolve_session_paths(session_dirs[0])
+    video_path = args.input or video_path
+    transcript_path = args.transcript or transcript_path
+    output_report_path = args.output_report or output_report_path
     
     # Print configuration for reproducibility tracking
     print(f"=== CONFIGURATION ===")
     print(f"Model: {MODEL_NAME}")
     print(f"Temperature: {MODEL_TEMPERATURE} | Top_P: {MODEL_TOP_P} | Top_K: {MODEL_TOP_K}")
     print(f"Seed: {args.seed}")
-    print(f"Thinking Level: {args.thinking_level}")
+    print(f"Thinking Level: {args.thinking_level} (audit: {args.audit_thinking_level})")
     print(f"Media Resolution: {args.media_resolution}")
     print(f"Consistency Runs: {args.consistency_runs}")
     print(f"Google Search: {args.use_google_search}")
     print(f"=====================")
     
-    perform_rag_analysis(args.input, args.output_report, args.transcript)
\ No newline at end of file
+    if len(session_dirs) <= 1:
+        return perform_rag_analysis(video_path, output_report_path, transcript_path)
+
+    # A failed session (perform_rag_analysis exits with 1, or 2 once Step 1 is cached) does not
+    # stop the others; the worst status is returned. Quota exhaustion (42) stops the whole run.
+    failed = []
+    exit_code = 0
+    for index, session_dir in enumerate(session_dirs, 1):
+        print(f"\n=== Session {index}/{len(session_dirs)}: {session_dir} ===")
+        try:
+            session_video, session_transcript, session_report = resolve_session_paths(session_dir)
+            perform_rag_analysis(session_video, session_report, session_transcript)
+        except (SystemExit, OSError) as e:
+            code = e.code if isinstance(e, SystemExit) else 1
+            if code == 42:
+                raise
+            print(f"[ERROR] Session {session_dir} failed: {e!r}")
+            failed.append(session_dir)
+            exit_code = max(exit_code, code if isinstance(code, int) and code > 0 else 1)
+    print(f"\n=== {len(session_dirs) - len(failed)}/{len(session_dirs)} sessions analysed ===")
+    if exit_code:
+        sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()